@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import json
+import os
+import random
+
+
+# Species found in synthetic kraken2 reports. Keys: (ncbi_taxonomy_id, species_name, genus_taxid, genus_name, genome_size_mb)
+SPECIES = [
+    ('562', 'Escherichia coli', '561', 'Escherichia', 5.1),
+    ('28901', 'Salmonella enterica', '590', 'Salmonella', 4.8),
+    ('573', 'Klebsiella pneumoniae', '570', 'Klebsiella', 5.5),
+    ('1280', 'Staphylococcus aureus', '1279', 'Staphylococcus', 2.8),
+    ('287', 'Pseudomonas aeruginosa', '286', 'Pseudomonas', 6.6),
+    ('1773', 'Mycobacterium tuberculosis', '1763', 'Mycobacterium', 4.4),
+    ('1313', 'Streptococcus pneumoniae', '1301', 'Streptococcus', 2.1),
+    ('470', 'Acinetobacter baumannii', '469', 'Acinetobacter', 3.9),
+    ('1351', 'Enterococcus faecalis', '1350', 'Enterococcus', 3.0),
+    ('9606', 'Homo sapiens', '9605', 'Homo', 3100.0),
+]
+
+NANOQ_HEADER = 'reads,bases,n50,longest,shortest,mean_length,median_length,mean_quality,median_quality\n'
+KRAKEN_SPECIES_HEADER = 'percent_seqs_in_clade,num_seqs_in_clade,num_seqs_this_taxon,rank_code,ncbi_taxonomy_id,taxon_name\n'
+
+
+def generate_taxdump(taxdump_dir):
+    """
+    Write a minimal NCBI taxdump ('nodes.dmp', 'names.dmp', 'merged.dmp') covering the synthetic species,
+    so that genus lookups can be made without a real taxdump or taxonkit.
+
+    :param taxdump_dir: Directory to write the taxdump files to.
+    :type taxdump_dir: str
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(taxdump_dir, exist_ok=True)
+    nodes = [('1', '1', 'no rank'), ('2', '1', 'superkingdom')]
+    names = [('1', 'root'), ('2', 'Bacteria')]
+    for species_taxid, species_name, genus_taxid, genus_name, genome_size_mb in SPECIES:
+        nodes.append((genus_taxid, '2', 'genus'))
+        nodes.append((species_taxid, genus_taxid, 'species'))
+        names.append((genus_taxid, genus_name))
+        names.append((species_taxid, species_name))
+
+    with open(os.path.join(taxdump_dir, 'nodes.dmp'), 'w') as f:
+        for taxid, parent_taxid, rank in nodes:
+            f.write('\t|\t'.join([taxid, parent_taxid, rank, '']) + '\t|\n')
+    with open(os.path.join(taxdump_dir, 'names.dmp'), 'w') as f:
+        for taxid, name in names:
+            f.write('\t|\t'.join([taxid, name, '', 'scientific name']) + '\t|\n')
+    with open(os.path.join(taxdump_dir, 'merged.dmp'), 'w') as f:
+        pass
+
+
+def get_stub_genera():
+    """
+    :return: Genus details for each synthetic species, by taxid, in the form returned by `taxonomy.resolve_genera`.
+    :rtype: dict[str, dict[str, str]]
+    """
+    genera_by_taxid = {}
+    for species_taxid, species_name, genus_taxid, genus_name, genome_size_mb in SPECIES:
+        genera_by_taxid[species_taxid] = {'genus_taxon_name': genus_name, 'genus_ncbi_taxonomy_id': genus_taxid}
+
+    return genera_by_taxid
+
+
+def generate_run_id(rng, run_date, sequencer_type, instrument_num):
+    """
+    :param rng: Random number generator.
+    :type rng: random.Random
+    :param run_date: Run date.
+    :type run_date: datetime.date
+    :param sequencer_type: Sequencer type ('gridion' or 'promethion').
+    :type sequencer_type: str
+    :param instrument_num: Instrument position number.
+    :type instrument_num: int
+    :return: Run ID, in the format used by the sequencer type.
+    :rtype: str
+    """
+    flowcell_id = 'FA' + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(6))
+    run_hash = ''.join(rng.choice('0123456789abcdef') for _ in range(8))
+    if sequencer_type == 'promethion':
+        position = 'P2S_' + '{:05d}'.format(rng.randint(0, 99999)) + '-' + str(instrument_num)
+    else:
+        position = 'X' + str(instrument_num)
+
+    return '_'.join([run_date.strftime('%Y%m%d'), '{:02d}{:02d}'.format(rng.randint(0, 23), rng.randint(0, 59)), position, flowcell_id, run_hash])
+
+
+def generate_library(rng, library_output_dir, library_id, num_kraken_records):
+    """
+    Write a library's '_nanoq.csv' and '_kraken2_species.csv' files.
+
+    :param rng: Random number generator.
+    :type rng: random.Random
+    :param library_output_dir: Library output directory.
+    :type library_output_dir: str
+    :param library_id: Library ID.
+    :type library_id: str
+    :param num_kraken_records: Number of records in the kraken2 species report, in addition to 'unclassified'.
+    :type num_kraken_records: int
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(library_output_dir, exist_ok=True)
+    num_reads = rng.randint(1000, 500000)
+    mean_length = rng.randint(1500, 12000)
+    with open(os.path.join(library_output_dir, library_id + '_nanoq.csv'), 'w') as f:
+        f.write(NANOQ_HEADER)
+        f.write(','.join(str(x) for x in [
+            num_reads,
+            num_reads * mean_length,
+            int(mean_length * 1.4),
+            mean_length * rng.randint(5, 20),
+            rng.randint(50, 200),
+            mean_length,
+            int(mean_length * 0.9),
+            round(rng.uniform(9.0, 15.0), 1),
+            round(rng.uniform(9.0, 15.0), 1),
+        ]) + '\n')
+
+    unclassified_percent = rng.uniform(0.5, 10.0)
+    remaining_percent = 100.0 - unclassified_percent
+    with open(os.path.join(library_output_dir, library_id + '_kraken2_species.csv'), 'w') as f:
+        f.write(KRAKEN_SPECIES_HEADER)
+        num_seqs = int(num_reads * unclassified_percent / 100)
+        f.write(','.join(['{:.2f}'.format(unclassified_percent), str(num_seqs), str(num_seqs), 'U', '0', 'unclassified']) + '\n')
+        for record_num in range(num_kraken_records):
+            species_taxid, species_name, genus_taxid, genus_name, genome_size_mb = SPECIES[rng.randrange(len(SPECIES))]
+            percent = remaining_percent * rng.uniform(0.5, 0.9) if record_num == 0 else remaining_percent * rng.uniform(0.0, 0.5)
+            remaining_percent -= percent
+            num_seqs = int(num_reads * percent / 100)
+            f.write(','.join(['{:.2f}'.format(percent), str(num_seqs), str(num_seqs), 'S', species_taxid, species_name]) + '\n')
+
+
+def generate_analysis_by_run(dst_dir, num_runs=100, promethion_fraction=0.25, libraries_per_run=24, pipeline_versions=None, incomplete_fraction=0.05, num_kraken_records=20, seed=0):
+    """
+    Generate a synthetic 'analysis_by_run' tree, along with a taxdump, known species list,
+    excluded runs list and config file that refer to it.
+
+    :param dst_dir: Directory to generate the tree in. The 'analysis_by_run' dir and supporting files are created here.
+    :type dst_dir: str
+    :param num_runs: Number of runs.
+    :type num_runs: int
+    :param promethion_fraction: Fraction of runs named as PromethION runs. The rest are GridION runs.
+    :type promethion_fraction: float
+    :param libraries_per_run: Number of libraries (barcodes) per run.
+    :type libraries_per_run: int
+    :param pipeline_versions: Pipeline versions. Each run gets one output dir for each version, up to a random number of them.
+    :type pipeline_versions: Optional[list[str]]
+    :param incomplete_fraction: Fraction of runs whose analysis has not completed.
+    :type incomplete_fraction: float
+    :param num_kraken_records: Number of species records in each kraken2 species report.
+    :type num_kraken_records: int
+    :param seed: Random seed, so that the same parameters always generate the same tree.
+    :type seed: int
+    :return: Summary. Keys: ['config_path', 'num_runs', 'num_libraries', 'num_files']
+    :rtype: dict[str, object]
+    """
+    if pipeline_versions is None:
+        pipeline_versions = ['v0.1.0']
+    rng = random.Random(seed)
+    analysis_by_run_dir = os.path.join(dst_dir, 'analysis_by_run')
+    os.makedirs(analysis_by_run_dir, exist_ok=True)
+
+    num_libraries = 0
+    num_files = 0
+    run_date = datetime.date(2023, 1, 1)
+    run_ids = []
+    for run_num in range(num_runs):
+        run_date += datetime.timedelta(days=rng.choice([0, 0, 1]))
+        sequencer_type = 'promethion' if rng.random() < promethion_fraction else 'gridion'
+        run_id = generate_run_id(rng, run_date, sequencer_type, rng.randint(1, 5))
+        run_ids.append(run_id)
+        num_versions = rng.randint(1, len(pipeline_versions))
+        for pipeline_version in pipeline_versions[0:num_versions]:
+            routine_nanopore_qc_output_dir = os.path.join(analysis_by_run_dir, run_id, 'routine-nanopore-qc-' + pipeline_version + '-output')
+            for library_num in range(1, libraries_per_run + 1):
+                library_id = 'R' + '{:06d}'.format(run_num) + '-' + '{:03d}'.format(library_num)
+                generate_library(rng, os.path.join(routine_nanopore_qc_output_dir, library_id), library_id, num_kraken_records)
+                num_libraries += 1
+                num_files += 2
+            if rng.random() >= incomplete_fraction:
+                with open(os.path.join(routine_nanopore_qc_output_dir, 'analysis_complete.json'), 'w') as f:
+                    json.dump({'timestamp': run_date.isoformat()}, f)
+                num_files += 1
+
+    taxdump_dir = os.path.join(dst_dir, 'taxdump')
+    generate_taxdump(taxdump_dir)
+
+    known_species_path = os.path.join(dst_dir, 'known_species.csv')
+    with open(known_species_path, 'w') as f:
+        f.write('ncbi_taxonomy_id,species_name,genome_size_mb,gc_percent,refseq_assembly_accession\n')
+        for species_taxid, species_name, genus_taxid, genus_name, genome_size_mb in SPECIES:
+            if species_name != 'Homo sapiens':
+                f.write(','.join([species_taxid, species_name, str(genome_size_mb), '50.0', '']) + '\n')
+
+    excluded_runs_path = os.path.join(dst_dir, 'excluded_runs.csv')
+    with open(excluded_runs_path, 'w') as f:
+        f.write('#run_id\n')
+        for run_id in run_ids[0:max(1, num_runs // 50)]:
+            f.write(run_id + '\n')
+
+    config_path = os.path.join(dst_dir, 'config.json')
+    config = {
+        'analysis_by_run_dir': analysis_by_run_dir,
+        'excluded_runs_list': excluded_runs_path,
+        'known_species_list': known_species_path,
+        'taxdump_dir': taxdump_dir,
+        'scan_interval_seconds': 3600,
+        'output_dir': os.path.join(dst_dir, 'output'),
+    }
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    return {
+        'config_path': config_path,
+        'num_runs': num_runs,
+        'num_libraries': num_libraries,
+        'num_files': num_files,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic analysis_by_run tree')
+    parser.add_argument('dst_dir')
+    parser.add_argument('--runs', type=int, default=100, help='Number of runs (default: 100)')
+    parser.add_argument('--promethion-fraction', type=float, default=0.25, help='Fraction of PromethION runs (default: 0.25)')
+    parser.add_argument('--libraries-per-run', type=int, default=24, help='Libraries (barcodes) per run (default: 24)')
+    parser.add_argument('--pipeline-versions', default='v0.1.0', help='Comma-separated pipeline versions (default: v0.1.0)')
+    parser.add_argument('--incomplete-fraction', type=float, default=0.05, help='Fraction of runs whose analysis is incomplete (default: 0.05)')
+    parser.add_argument('--kraken-records', type=int, default=20, help='Species records per kraken2 report (default: 20)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate_analysis_by_run(
+        args.dst_dir,
+        num_runs=args.runs,
+        promethion_fraction=args.promethion_fraction,
+        libraries_per_run=args.libraries_per_run,
+        pipeline_versions=args.pipeline_versions.split(','),
+        incomplete_fraction=args.incomplete_fraction,
+        num_kraken_records=args.kraken_records,
+        seed=args.seed,
+    )
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
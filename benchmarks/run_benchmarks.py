@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import routine_nanopore_qc_collector.config
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.parsers as parsers
+import routine_nanopore_qc_collector.prefetch as prefetch
+import routine_nanopore_qc_collector.qc_metrics as qc_metrics
+import routine_nanopore_qc_collector.taxonomy as taxonomy
+
+import generate_analysis_by_run
+
+BENCHMARK_RESULTS_VERSION = 1
+
+
+def time_stage(stage_fn, num_repeats, setup_fn=None):
+    """
+    Time a benchmark stage.
+
+    :param stage_fn: Function that runs the stage once, returning the number of items processed.
+    :type stage_fn: Callable[[], int]
+    :param num_repeats: Number of times to run the stage.
+    :type num_repeats: int
+    :param setup_fn: Function run (untimed) before each repeat.
+    :type setup_fn: Optional[Callable[[], None]]
+    :return: Stage results. Keys: ['num_items', 'durations_seconds', 'min_seconds', 'median_seconds', 'items_per_second']
+    :rtype: dict[str, object]
+    """
+    durations_seconds = []
+    num_items = 0
+    for _ in range(num_repeats):
+        if setup_fn is not None:
+            setup_fn()
+        start_time = time.perf_counter()
+        num_items = stage_fn()
+        durations_seconds.append(time.perf_counter() - start_time)
+
+    min_seconds = min(durations_seconds)
+    stage_results = {
+        'num_items': num_items,
+        'durations_seconds': [round(d, 6) for d in durations_seconds],
+        'min_seconds': round(min_seconds, 6),
+        'median_seconds': round(statistics.median(durations_seconds), 6),
+        'items_per_second': round(num_items / min_seconds, 3) if min_seconds > 0 else None,
+    }
+    logging.info(json.dumps(dict({"event_type": "benchmark_stage_complete"}, **{k: v for k, v in stage_results.items() if k != 'durations_seconds'})))
+
+    return stage_results
+
+
+def find_source_files(config, suffix):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param suffix: File name suffix (eg. '_nanoq.csv').
+    :type suffix: str
+    :return: Paths to all files in the latest routine-nanopore-qc output dir of each run with the suffix.
+    :rtype: list[str]
+    """
+    paths = []
+    for run in core.discover_runs(config):
+        if run['routine_nanopore_qc_output_path'] is None:
+            continue
+        for library_id in os.listdir(run['routine_nanopore_qc_output_path']):
+            path = os.path.join(run['routine_nanopore_qc_output_path'], library_id, library_id + suffix)
+            if os.path.exists(path):
+                paths.append(path)
+
+    return paths
+
+
+def load_run_species_abundances(config, analysis_dirs):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_dirs: Analysis dirs, as yielded by `core.scan`.
+    :type analysis_dirs: list[dict[str, str]]
+    :return: For each run, the species abundance record and number of bases of each library that has a nanoq report and a kraken2 species report.
+    :rtype: list[tuple[list[dict[str, object]], list[Optional[int]]]]
+    """
+    runs = []
+    for analysis_dir in analysis_dirs:
+        run_id = os.path.basename(analysis_dir['path'])
+        output_path = core.find_latest_routine_nanopore_qc_output(analysis_dir['path'])
+        kraken_species_by_library_id = {}
+        num_bases_by_library_id = {}
+        for library_id in sorted(os.listdir(output_path)):
+            kraken_species_path = os.path.join(output_path, library_id, library_id + '_kraken2_species.csv')
+            nanoq_path = os.path.join(output_path, library_id, library_id + '_nanoq.csv')
+            if not os.path.exists(kraken_species_path) or not os.path.exists(nanoq_path):
+                continue
+            kraken_species_by_library_id[library_id] = parsers.parse_kraken_species(kraken_species_path, top_n=7)
+            nanoq_report = parsers.parse_nanoq(nanoq_path)
+            num_bases_by_library_id[library_id] = nanoq_report[0]['bases'] if len(nanoq_report) == 1 else None
+        run_taxids = set(record['ncbi_taxonomy_id'] for kraken_species in kraken_species_by_library_id.values() for record in kraken_species if record['rank_code'] != 'U')
+        genera_by_taxid = taxonomy.resolve_genera(config, run_taxids)
+        species_abundances = [core.collect_library_species_abundance(run_id, library_id, kraken_species, genera_by_taxid) for library_id, kraken_species in kraken_species_by_library_id.items()]
+        runs.append((species_abundances, list(num_bases_by_library_id.values())))
+
+    return runs
+
+
+def compute_inferred_metrics_per_library(config, species_abundance, num_bases):
+    """
+    Compute a library's inferred species and genus metrics one library at a time, with the `core` functions
+    that `qc_metrics.compute_inferred_metrics` replaced. Used as the baseline for the 'inferred_metrics' stages.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param species_abundance: Species abundance record for the library.
+    :type species_abundance: dict[str, object]
+    :param num_bases: Number of bases in the library, or None if unknown.
+    :type num_bases: Optional[int]
+    :return: Library QC fields, as returned for one library by `qc_metrics.compute_inferred_metrics`.
+    :rtype: dict[str, object]
+    """
+    species_name = core.infer_species(config, species_abundance)
+    if species_name is None:
+        return {}
+
+    library_metrics = {
+        'inferred_species_name': species_name,
+        'inferred_genus_name': core.infer_genus(config, species_abundance, species_name),
+        'inferred_species_percent': core.get_percent_reads_by_species_name(species_abundance, species_name),
+    }
+    library_metrics['inferred_genus_percent'] = core.get_percent_reads_by_genus_name(species_abundance, library_metrics['inferred_genus_name'])
+    known_species = config.get('known_species', {})
+    if species_name in known_species:
+        library_metrics['inferred_species_genome_size_mb'] = known_species[species_name]['genome_size_mb']
+        genome_size = library_metrics['inferred_species_genome_size_mb'] * 1000000
+        if num_bases is not None and all([num_bases, genome_size, library_metrics['inferred_species_percent']]):
+            library_metrics['inferred_species_estimated_depth'] = round((num_bases * (library_metrics['inferred_species_percent'] / 100)) / genome_size, 3)
+        if num_bases is not None and all([num_bases, genome_size, library_metrics['inferred_genus_percent']]):
+            library_metrics['inferred_genus_estimated_depth'] = round((num_bases * (library_metrics['inferred_genus_percent'] / 100)) / genome_size, 3)
+
+    return library_metrics
+
+
+def run_benchmarks(config, num_repeats=3, num_workers=1):
+    """
+    Time each stage of scanning and collection against the tree described by the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param num_repeats: Number of times to run each stage.
+    :type num_repeats: int
+    :param num_workers: Number of threads used by the collect stages.
+    :type num_workers: int
+    :return: Results by stage name.
+    :rtype: dict[str, dict[str, object]]
+    """
+    stages = {}
+    scan_state_path = os.path.join(config['output_dir'], 'scan_state.json')
+
+    def reset_outputs():
+        shutil.rmtree(config['output_dir'], ignore_errors=True)
+        core.create_output_dirs(config)
+
+    def reset_scan_state():
+        if os.path.exists(scan_state_path):
+            os.remove(scan_state_path)
+
+    reset_outputs()
+
+    def discover_runs_cold():
+        scan_state = core.load_scan_state(config)
+        num_runs = len(core.discover_runs(config, scan_state))
+        core.save_scan_state(config, scan_state)
+        return num_runs
+    stages['discover_runs_cold'] = time_stage(discover_runs_cold, num_repeats, reset_scan_state)
+    stages['discover_runs_warm'] = time_stage(discover_runs_cold, num_repeats)
+
+    discovered_runs = core.discover_runs(config, core.load_scan_state(config))
+    stages['find_runs'] = time_stage(lambda: len(core.find_runs(config, discovered_runs=discovered_runs)), num_repeats)
+    stages['find_analysis_dirs'] = time_stage(lambda: len([d for d in core.find_analysis_dirs(config) if d is not None]), num_repeats)
+
+    nanoq_paths = find_source_files(config, '_nanoq.csv')
+    kraken_species_paths = find_source_files(config, '_kraken2_species.csv')
+
+    def parse_all(parse_fn, paths):
+        for path in paths:
+            parse_fn(path)
+        return len(paths)
+    stages['parse_nanoq'] = time_stage(lambda: parse_all(parsers.parse_nanoq, nanoq_paths), num_repeats)
+    stages['parse_kraken_species'] = time_stage(lambda: parse_all(parsers.parse_kraken_species, kraken_species_paths), num_repeats)
+
+    analysis_dirs = [d for d in core.scan(config, discovered_runs=discovered_runs) if d is not None]
+
+    def prefetch_all():
+        num_libraries = 0
+        for analysis_dir in analysis_dirs:
+            output_path = core.find_latest_routine_nanopore_qc_output(analysis_dir['path'])
+            with os.scandir(output_path) as output_dir_contents:
+                library_ids = [entry.name for entry in output_dir_contents if entry.is_dir()]
+            prefetch.prefetch_source_files(config, output_path, library_ids, {})
+            num_libraries += len(library_ids)
+        return num_libraries
+    stages['prefetch_source_files'] = time_stage(prefetch_all, num_repeats)
+
+    # Inferred species and genus metrics, computed library by library (as before `qc_metrics`), and for each run at once.
+    run_species_abundances = load_run_species_abundances(config, analysis_dirs)
+    per_library_results = [[compute_inferred_metrics_per_library(config, species_abundance, library_num_bases) for species_abundance, library_num_bases in zip(species_abundances, num_bases)] for species_abundances, num_bases in run_species_abundances]
+    by_run_results = [qc_metrics.compute_inferred_metrics(config, qc_metrics.load_abundance_columns(species_abundances), num_bases) for species_abundances, num_bases in run_species_abundances]
+    if per_library_results != by_run_results:
+        logging.error(json.dumps({"event_type": "inferred_metrics_mismatch"}))
+
+    def compute_inferred_metrics_all(compute_fn):
+        num_libraries = 0
+        for species_abundances, num_bases in run_species_abundances:
+            num_libraries += len(compute_fn(species_abundances, num_bases))
+        return num_libraries
+    stages['inferred_metrics_per_library'] = time_stage(lambda: compute_inferred_metrics_all(lambda species_abundances, num_bases: [compute_inferred_metrics_per_library(config, species_abundance, library_num_bases) for species_abundance, library_num_bases in zip(species_abundances, num_bases)]), num_repeats)
+    stages['inferred_metrics_by_run'] = time_stage(lambda: compute_inferred_metrics_all(lambda species_abundances, num_bases: qc_metrics.compute_inferred_metrics(config, qc_metrics.load_abundance_columns(species_abundances), num_bases)), num_repeats)
+
+    def collect_all(force):
+        num_libraries = 0
+        if num_workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+            with executor:
+                for summary in executor.map(lambda d: core.collect_outputs(config, d, force), analysis_dirs):
+                    num_libraries += summary['num_libraries']
+        else:
+            for analysis_dir in analysis_dirs:
+                num_libraries += core.collect_outputs(config, analysis_dir, force)['num_libraries']
+        return num_libraries
+    stages['collect_outputs_cold'] = time_stage(lambda: collect_all(False), num_repeats, reset_outputs)
+    stages['collect_outputs_unchanged'] = time_stage(lambda: collect_all(False), num_repeats)
+    stages['collect_outputs_forced'] = time_stage(lambda: collect_all(True), num_repeats)
+
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scanning and collection against a synthetic analysis_by_run tree')
+    parser.add_argument('--runs', type=int, default=100, help='Number of runs (default: 100)')
+    parser.add_argument('--promethion-fraction', type=float, default=0.25, help='Fraction of PromethION runs (default: 0.25)')
+    parser.add_argument('--libraries-per-run', type=int, default=24, help='Libraries (barcodes) per run (default: 24)')
+    parser.add_argument('--pipeline-versions', default='v0.1.0', help='Comma-separated pipeline versions (default: v0.1.0)')
+    parser.add_argument('--incomplete-fraction', type=float, default=0.05, help='Fraction of runs whose analysis is incomplete (default: 0.05)')
+    parser.add_argument('--kraken-records', type=int, default=20, help='Species records per kraken2 report (default: 20)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to run each stage (default: 3)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of runs to collect concurrently (default: 1)')
+    parser.add_argument('--taxonomy', choices=['stub', 'native'], default='stub', help="'stub' to resolve genera from a fixed table, or 'native' to use the generated taxdump (default: stub)")
+    parser.add_argument('--work-dir', help='Directory to generate the tree in (default: a temporary dir, removed afterwards)')
+    parser.add_argument('-o', '--output', help='Write results to this file (default: stdout)')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module", "%(module)s", "function_name": "%(funcName)s", "line_num", %(lineno)d, "message": %(message)s}',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        encoding='utf-8',
+        level=getattr(logging, args.log_level.upper()),
+    )
+
+    if args.taxonomy == 'stub':
+        stub_genera = generate_analysis_by_run.get_stub_genera()
+        taxonomy.resolve_genera = lambda config, taxids: {taxid: stub_genera[taxid] for taxid in taxids if taxid in stub_genera}
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='routine-nanopore-qc-collector-benchmark-')
+    try:
+        parameters = {
+            'runs': args.runs,
+            'promethion_fraction': args.promethion_fraction,
+            'libraries_per_run': args.libraries_per_run,
+            'pipeline_versions': args.pipeline_versions.split(','),
+            'incomplete_fraction': args.incomplete_fraction,
+            'kraken_records': args.kraken_records,
+            'seed': args.seed,
+            'repeats': args.repeats,
+            'workers': args.workers,
+            'taxonomy': args.taxonomy,
+        }
+        generate_start_time = time.perf_counter()
+        tree = generate_analysis_by_run.generate_analysis_by_run(
+            work_dir,
+            num_runs=args.runs,
+            promethion_fraction=args.promethion_fraction,
+            libraries_per_run=args.libraries_per_run,
+            pipeline_versions=parameters['pipeline_versions'],
+            incomplete_fraction=args.incomplete_fraction,
+            num_kraken_records=args.kraken_records,
+            seed=args.seed,
+        )
+        tree['generate_seconds'] = round(time.perf_counter() - generate_start_time, 6)
+        config = routine_nanopore_qc_collector.config.load_config(tree['config_path'])
+
+        stages = {}
+        if args.taxonomy == 'native':
+            stages['load_taxonomy'] = time_stage(lambda: len(taxonomy.load_taxonomy(config['taxdump_dir'])['parents']), args.repeats)
+        stages.update(run_benchmarks(config, args.repeats, args.workers))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'benchmark_results_version': BENCHMARK_RESULTS_VERSION,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'tree': {k: v for k, v in tree.items() if k != 'config_path'},
+        'stages': stages,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
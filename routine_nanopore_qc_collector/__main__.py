@@ -1,21 +1,263 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import datetime
 import json
 import logging
 import os
 import time
 
+import routine_nanopore_qc_collector.api as api
 import routine_nanopore_qc_collector.config
 import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.export as export
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.metrics as metrics
+import routine_nanopore_qc_collector.qc_index as qc_index
+import routine_nanopore_qc_collector.rebuild
+import routine_nanopore_qc_collector.runs_index as runs_index
+import routine_nanopore_qc_collector.samplesheet as samplesheet
+import routine_nanopore_qc_collector.scheduler as scheduler
+import routine_nanopore_qc_collector.watch as watch
 
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
 
+
+def positive_int(value):
+    """
+    Parse a command-line argument that must be a whole number of at least 1.
+
+    :param value: Argument value.
+    :type value: str
+    :return: The parsed value.
+    :rtype: int
+    :raises argparse.ArgumentTypeError: If the value isn't a whole number of at least 1.
+    """
+    try:
+        parsed_value = int(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("invalid int value: '" + value + "'")
+    if parsed_value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got " + value)
+
+    return parsed_value
+
+
+def collect_outputs(config, analysis_dir):
+    """
+    Collect outputs for a run, if no other node is collecting it. See `leases`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_dir: Analysis dir to collect.
+    :type analysis_dir: dict[str, str]
+    :return: Summary returned by `core.collect_outputs`, or None if the run is being collected by another node.
+    :rtype: Optional[dict[str, object]]
+    """
+    run_id = os.path.basename(analysis_dir['path'])
+    with leases.lease(config, 'run-' + run_id) as acquired:
+        if not acquired:
+            logging.info(json.dumps({"event_type": "run_leased_elsewhere", "sequencing_run_id": run_id}))
+            return None
+        collect_outputs_summary = core.collect_outputs(config, analysis_dir)
+    api.update_run(config, run_id)
+
+    return collect_outputs_summary
+
+
+def update_runs(config, discovered_runs):
+    """
+    Bring the read API's runs and the runs index up to date with the discovered runs. With several nodes,
+    whichever node holds the 'runs-index' lease updates the runs index.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param discovered_runs: Runs, as returned by `core.discover_runs`.
+    :type discovered_runs: list[core.RunRecord]
+    :return: None
+    :rtype: NoneType
+    """
+    runs = core.find_runs(config, discovered_runs=discovered_runs)
+    api.update_runs(runs)
+    with leases.lease(config, 'runs-index') as acquired:
+        if acquired:
+            runs_index.update_runs_index(config, runs)
+
+
+def collect_concurrently(config, analysis_dirs, num_workers, scheduler_state=None):
+    """
+    Collect outputs for several runs at once, using a pool of worker threads. Runs are only
+    taken from `analysis_dirs` when a worker is free, so that they start in the order given.
+    If interrupted (Ctrl-C), runs that haven't started yet are left unstarted, runs that are
+    in progress are allowed to finish, and then the KeyboardInterrupt is re-raised.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_dirs: Analysis dirs, as yielded by `core.scan` or `scheduler.iter_queue`.
+    :type analysis_dirs: Iterator[Optional[dict[str, str]]]
+    :param num_workers: Maximum number of runs to collect at once.
+    :type num_workers: int
+    :param scheduler_state: Scheduler state, as returned by `scheduler.init_scheduler_state`. If supplied, the result of each run is recorded in it.
+    :type scheduler_state: Optional[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='collect')
+    analysis_dirs_by_future = {}
+    analysis_dirs = (analysis_dir for analysis_dir in analysis_dirs if analysis_dir is not None)
+    try:
+        while True:
+            for analysis_dir in analysis_dirs:
+                analysis_dirs_by_future[executor.submit(collect_outputs, config, analysis_dir)] = analysis_dir
+                if len(analysis_dirs_by_future) >= num_workers:
+                    break
+            if len(analysis_dirs_by_future) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(analysis_dirs_by_future, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                analysis_dir = analysis_dirs_by_future.pop(future)
+                run_id = os.path.basename(analysis_dir['path'])
+                collect_outputs_summary = None
+                error = None
+                try:
+                    collect_outputs_summary = future.result()
+                except Exception as e:
+                    error = e
+                    logging.error(json.dumps({"event_type": "collect_outputs_failed", "sequencing_run_id": run_id, "error": repr(e)}))
+                if scheduler_state is not None:
+                    scheduler.record_result(config, scheduler_state, analysis_dir, collect_outputs_summary, error)
+    except KeyboardInterrupt as e:
+        logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
+        num_in_progress = len([future for future in analysis_dirs_by_future if future.running()])
+        logging.info(json.dumps({"event_type": "waiting_for_workers", "num_runs_in_progress": num_in_progress}))
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+
+    executor.shutdown(wait=True)
+
+
+def collect_and_record(config, scheduler_state, analysis_dir):
+    """
+    Collect outputs for a run, and record the result in the scheduler state, so that failed
+    or incomplete runs are retried. Errors are logged rather than raised.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scheduler_state: Scheduler state, as returned by `scheduler.init_scheduler_state`. Updated in place.
+    :type scheduler_state: dict[str, object]
+    :param analysis_dir: Analysis dir to collect.
+    :type analysis_dir: dict[str, str]
+    :return: None
+    :rtype: NoneType
+    """
+    try:
+        collect_outputs_summary = collect_outputs(config, analysis_dir)
+    except Exception as e:
+        logging.error(json.dumps({"event_type": "collect_outputs_failed", "sequencing_run_id": os.path.basename(analysis_dir['path']), "error": repr(e)}))
+        scheduler.record_result(config, scheduler_state, analysis_dir, error=e)
+        return
+    scheduler.record_result(config, scheduler_state, analysis_dir, collect_outputs_summary)
+
+
+def query(args):
+    """
+    Query the QC index, and print matching library-qc records to stdout, one json object per line.
+
+    :param args: Command-line args.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: NoneType
+    """
+    qc_index_path = args.qc_index
+    if qc_index_path is None:
+        if not args.config:
+            logging.error(json.dumps({"event_type": "query_failed", "reason": "Either --config or --qc-index is required"}))
+            exit(1)
+        config = routine_nanopore_qc_collector.config.load_config(args.config)
+        qc_index_path = qc_index.get_qc_index_path(config)
+
+    try:
+        records = qc_index.query_library_qc(
+            qc_index_path,
+            run_id=args.run_id,
+            library_id=args.library_id,
+            species_name=args.species,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            min_depth=args.min_depth,
+            max_depth=args.max_depth,
+            limit=args.limit,
+        )
+    except FileNotFoundError as e:
+        logging.error(json.dumps({"event_type": "query_failed", "reason": "QC index not found", "qc_index_path": os.path.abspath(qc_index_path)}))
+        exit(1)
+    for record in records:
+        print(json.dumps(record))
+
+
+def rebuild(args):
+    """
+    Re-collect outputs for all runs in a date range or list of run IDs, overwriting existing outputs.
+
+    :param args: Command-line args.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: NoneType
+    """
+    if not args.config:
+        logging.error(json.dumps({"event_type": "rebuild_failed", "reason": "--config is required"}))
+        exit(1)
+    config = routine_nanopore_qc_collector.config.load_config(args.config)
+    core.create_output_dirs(config)
+
+    run_ids = None
+    if args.run_ids is not None:
+        run_ids = set(run_id.strip() for run_id in args.run_ids.split(',') if run_id.strip() != '')
+    if args.run_ids_file is not None:
+        run_ids = run_ids or set()
+        with open(args.run_ids_file, 'r') as f:
+            run_ids.update(line.strip() for line in f if line.strip() != '' and not line.startswith('#'))
+
+    selection = {
+        'run_ids': sorted(run_ids) if run_ids is not None else None,
+        'start_date': args.start_date,
+        'end_date': args.end_date,
+    }
+    scan_state = core.load_scan_state(config)
+    discovered_runs = core.discover_runs(config, scan_state)
+    core.save_scan_state(config, scan_state)
+    runs = routine_nanopore_qc_collector.rebuild.select_runs(discovered_runs, run_ids, args.start_date, args.end_date)
+    try:
+        routine_nanopore_qc_collector.rebuild.rebuild(config, runs, args.workers, selection, args.checkpoint)
+    except KeyboardInterrupt as e:
+        exit(130)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config')
     parser.add_argument('--log-level')
+    parser.add_argument('--workers', type=positive_int, default=1, help='Number of runs to collect concurrently (default: 1)')
+    parser.add_argument('--watch', action='store_true', help='Collect runs as soon as their analysis completes, with a full scan every scan_interval_seconds')
+    subparsers = parser.add_subparsers(dest='command')
+    query_parser = subparsers.add_parser('query', help='Query library QC records across all collected runs')
+    query_parser.add_argument('--qc-index', help='Path to QC index (default: qc_index_path from config)')
+    query_parser.add_argument('--run-id')
+    query_parser.add_argument('--library-id')
+    query_parser.add_argument('--species', help='Inferred species name')
+    query_parser.add_argument('--start-date', help='Earliest run date (YYYY-MM-DD)')
+    query_parser.add_argument('--end-date', help='Latest run date (YYYY-MM-DD)')
+    query_parser.add_argument('--min-depth', type=float, help='Minimum inferred species estimated depth')
+    query_parser.add_argument('--max-depth', type=float, help='Maximum inferred species estimated depth (exclusive)')
+    query_parser.add_argument('--limit', type=int)
+    rebuild_parser = subparsers.add_parser('rebuild', help='Re-collect outputs for a date range or list of runs, overwriting existing outputs')
+    rebuild_parser.add_argument('--run-ids', help='Comma-separated list of run IDs')
+    rebuild_parser.add_argument('--run-ids-file', help='File with one run ID per line')
+    rebuild_parser.add_argument('--start-date', help='Earliest run date (YYYY-MM-DD)')
+    rebuild_parser.add_argument('--end-date', help='Latest run date (YYYY-MM-DD)')
+    rebuild_parser.add_argument('--checkpoint', help='Path to checkpoint file (default: rebuild_checkpoint.json in output_dir)')
     args = parser.parse_args()
 
     config = {}
@@ -34,7 +276,15 @@ def main():
     )
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
+    if args.command == 'query':
+        query(args)
+        return
+    elif args.command == 'rebuild':
+        rebuild(args)
+        return
+
     quit_when_safe = False
+    scheduler_state = scheduler.init_scheduler_state()
 
     while(True):
         try:
@@ -52,29 +302,60 @@ def main():
                     logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
 
             core.create_output_dirs(config)
+            metrics.start_http_server(config)
+            api.start_http_server(config)
 
             scan_start_timestamp = datetime.datetime.now()
 
-            runs = core.find_runs(config)
-            runs_output_file = os.path.join(config['output_dir'], 'runs.json')
-            with open(runs_output_file, 'w') as f:
-                json.dump(runs, f, indent=2)
-            logging.info(json.dumps({"event_type": "write_runs_file_complete", "runs_file": runs_output_file}))
+            scan_state = core.load_scan_state(config)
 
-            for run in core.scan(config):
-                if run is not None:
+            discovered_runs = core.discover_runs(config, scan_state)
+
+            update_runs(config, discovered_runs)
+            samplesheet.update_samplesheet_index(config)
+
+            # Runs are collected in priority order (newest first), rather than in the order they were found.
+            # While the queue is worked through, runs are periodically re-discovered, so that newly completed
+            # runs don't wait for the whole queue.
+            refreshed_discovered_runs = []
+            def find_analysis_dirs():
+                refreshed_discovered_runs[:] = core.discover_runs(config, scan_state)
+                return core.scan(config, discovered_runs=refreshed_discovered_runs)
+            scheduler.enqueue(config, scheduler_state, core.scan(config, discovered_runs=discovered_runs))
+            if args.workers > 1:
+                try:
+                    collect_concurrently(config, scheduler.iter_queue(scheduler_state, config, find_analysis_dirs), args.workers, scheduler_state)
+                except KeyboardInterrupt as e:
+                    core.save_scan_state(config, scan_state)
+                    exit(0)
+            else:
+                for run in scheduler.iter_queue(scheduler_state, config, find_analysis_dirs):
                     try:
                         config = routine_nanopore_qc_collector.config.load_config(args.config)
                         logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
                     except json.decoder.JSONDecodeError as e:
                         logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-                    core.collect_outputs(config, run)
-                if quit_when_safe:
-                    exit(0)
+                    collect_and_record(config, scheduler_state, run)
+                    if quit_when_safe:
+                        core.save_scan_state(config, scan_state)
+                        exit(0)
+            if len(refreshed_discovered_runs) > 0:
+                discovered_runs = refreshed_discovered_runs
+                update_runs(config, discovered_runs)
+            core.save_scan_state(config, scan_state)
+            with leases.lease(config, 'ensure-exported') as acquired:
+                if acquired:
+                    export.ensure_exported(config)
+            if leases.is_enabled(config) and api.is_loaded():
+                # Pick up runs collected by other nodes since the last scan.
+                api.load_index(config)
             scan_complete_timestamp = datetime.datetime.now()
             scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
             scan_duration_seconds = scan_duration_delta.total_seconds()
             logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+            metrics.set_gauge('scan_duration_seconds', scan_duration_seconds)
+            metrics.set_gauge('last_scan_complete_timestamp_seconds', time.time())
+            metrics.write_textfile(config)
 
             if quit_when_safe:
                 exit(0)
@@ -86,7 +367,29 @@ def main():
                     config['scan_interval_seconds'] = DEFAULT_SCAN_INTERVAL_SECONDS
             else:
                     config['scan_interval_seconds'] = DEFAULT_SCAN_INTERVAL_SECONDS
-            time.sleep(config['scan_interval_seconds'])
+            # If any runs are waiting to be retried, the next scan starts when the first retry is due.
+            seconds_until_next_scan = config['scan_interval_seconds']
+            seconds_until_next_retry = scheduler.get_seconds_until_next_retry(scheduler_state)
+            if seconds_until_next_retry is not None and seconds_until_next_retry < seconds_until_next_scan:
+                seconds_until_next_scan = seconds_until_next_retry
+            if args.watch:
+                # Between full scans, collect each run as soon as its analysis completes.
+                # The full scan remains as a reconciliation step, in case any events are missed.
+                for run in watch.watch_for_completed_runs(config, scan_state, discovered_runs, seconds_until_next_scan):
+                    try:
+                        config = routine_nanopore_qc_collector.config.load_config(args.config)
+                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
+                    except json.decoder.JSONDecodeError as e:
+                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+                    samplesheet.update_samplesheet_index(config)
+                    collect_and_record(config, scheduler_state, run)
+                    # Only the run that completed is refreshed. Other changes are picked up by the next full scan.
+                    core.update_discovered_run(config, scan_state, discovered_runs, run['path'])
+                    update_runs(config, discovered_runs)
+                    core.save_scan_state(config, scan_state)
+                    metrics.write_textfile(config)
+            else:
+                time.sleep(seconds_until_next_scan)
         except KeyboardInterrupt as e:
             logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
             quit_when_safe = True
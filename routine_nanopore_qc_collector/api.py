@@ -0,0 +1,472 @@
+import bisect
+import datetime
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+import routine_nanopore_qc_collector.metrics as metrics
+import routine_nanopore_qc_collector.qc_index as qc_index
+
+
+DEFAULT_PAGE_LIMIT = 1000
+MAX_PAGE_LIMIT = 10000
+
+# Responses smaller than this are never compressed.
+GZIP_MIN_BYTES = 1024
+
+# Maximum number of encoded responses kept. The cache is cleared when it is full, and whenever the index changes.
+RESPONSE_CACHE_SIZE = 256
+
+_index = None
+_index_lock = threading.Lock()
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+_http_servers = {}
+
+
+def init_index():
+    """
+    :return: Empty in-memory index. Keys: ['generation', 'run_ids', 'runs', 'library_qc', 'species_abundance', 'run_ids_by_species'].
+             'run_ids' is every run ID with runs or records in the index, sorted. 'runs', 'library_qc' and 'species_abundance' are keyed by run ID.
+             'run_ids_by_species' holds the IDs of runs with libraries of each inferred species.
+    :rtype: dict[str, object]
+    """
+    return {
+        'generation': 0,
+        'run_ids': [],
+        'runs': {},
+        'library_qc': {},
+        'species_abundance': {},
+        'run_ids_by_species': {},
+    }
+
+
+def is_loaded():
+    """
+    :return: Whether the index has been loaded (ie. the API server is running).
+    :rtype: bool
+    """
+    return _index is not None
+
+
+def add_run_id(index, run_id):
+    """
+    :param index: In-memory index. Updated in place.
+    :type index: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: None
+    :rtype: NoneType
+    """
+    position = bisect.bisect_left(index['run_ids'], run_id)
+    if position == len(index['run_ids']) or index['run_ids'][position] != run_id:
+        index['run_ids'].insert(position, run_id)
+
+
+def set_run_records(index, run_id, library_qc_records, species_abundance_records):
+    """
+    Replace a run's library-qc and species-abundance records in the index.
+
+    :param index: In-memory index. Updated in place.
+    :type index: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param library_qc_records: Library QC records, as returned by `qc_index.get_run_records`.
+    :type library_qc_records: list[dict[str, object]]
+    :param species_abundance_records: Species abundance records, as returned by `qc_index.get_run_records`.
+    :type species_abundance_records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    for record in index['library_qc'].get(run_id, []):
+        species_run_ids = index['run_ids_by_species'].get(record.get('inferred_species_name', None), None)
+        if species_run_ids is not None:
+            species_run_ids.discard(run_id)
+    for record in library_qc_records:
+        index['run_ids_by_species'].setdefault(record.get('inferred_species_name', None), set()).add(run_id)
+    index['library_qc'][run_id] = library_qc_records
+    index['species_abundance'][run_id] = species_abundance_records
+    add_run_id(index, run_id)
+
+
+def group_by_run_id(records):
+    """
+    :param records: Records with a 'run_id'.
+    :type records: list[dict[str, object]]
+    :return: Records, grouped by run ID, in their original order.
+    :rtype: dict[str, list[dict[str, object]]]
+    """
+    records_by_run_id = {}
+    for record in records:
+        records_by_run_id.setdefault(record['run_id'], []).append(record)
+
+    return records_by_run_id
+
+
+def load_index(config):
+    """
+    (Re-)load the in-memory index of library-qc and species-abundance records from the QC index.
+    The runs loaded previously (see `update_runs`) are kept.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    global _index
+    load_start_timestamp = time.perf_counter()
+    library_qc_by_run_id = group_by_run_id(qc_index.get_run_records(config, 'library_qc'))
+    species_abundance_by_run_id = group_by_run_id(qc_index.get_run_records(config, 'species_abundance'))
+    index = init_index()
+    for run_id in set(library_qc_by_run_id.keys()) | set(species_abundance_by_run_id.keys()):
+        set_run_records(index, run_id, library_qc_by_run_id.get(run_id, []), species_abundance_by_run_id.get(run_id, []))
+
+    with _index_lock:
+        if _index is not None:
+            index['runs'] = _index['runs']
+            for run_id in index['runs']:
+                add_run_id(index, run_id)
+            index['generation'] = _index['generation'] + 1
+        _index = index
+    clear_response_cache()
+
+    logging.info(json.dumps({"event_type": "api_index_loaded", "num_runs": len(library_qc_by_run_id), "load_duration_seconds": round(time.perf_counter() - load_start_timestamp, 3)}))
+
+
+def update_run(config, run_id):
+    """
+    Refresh a run's records in the in-memory index from the QC index, after the run has been collected.
+    Has no effect if the index hasn't been loaded.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: None
+    :rtype: NoneType
+    """
+    if _index is None:
+        return
+    library_qc_records = qc_index.get_run_records(config, 'library_qc', run_id)
+    species_abundance_records = qc_index.get_run_records(config, 'species_abundance', run_id)
+    with _index_lock:
+        set_run_records(_index, run_id, library_qc_records, species_abundance_records)
+        _index['generation'] += 1
+    clear_response_cache()
+
+
+def update_runs(runs):
+    """
+    Replace the runs in the in-memory index. Has no effect if the index hasn't been loaded.
+
+    :param runs: Runs, as returned by `core.find_runs`.
+    :type runs: list[dict[str, str]]
+    :return: None
+    :rtype: NoneType
+    """
+    if _index is None:
+        return
+    runs_by_run_id = {}
+    for run in runs:
+        indexed_run = {'run_id': run['run_id'], 'run_date': qc_index.get_run_date(run['run_id'])}
+        indexed_run.update(run)
+        runs_by_run_id[run['run_id']] = indexed_run
+    with _index_lock:
+        if runs_by_run_id == _index['runs']:
+            return
+        for run_id in set(_index['runs'].keys()) - set(runs_by_run_id.keys()):
+            if run_id not in _index['library_qc'] and run_id not in _index['species_abundance']:
+                _index['run_ids'].remove(run_id)
+        for run_id in runs_by_run_id:
+            add_run_id(_index, run_id)
+        _index['runs'] = runs_by_run_id
+        _index['generation'] += 1
+    clear_response_cache()
+
+
+def parse_date(value):
+    """
+    :param value: Date (YYYY-MM-DD).
+    :type value: str
+    :return: The date, unchanged.
+    :rtype: str
+    :raises ValueError: If the date isn't in YYYY-MM-DD format.
+    """
+    datetime.date.fromisoformat(value)
+    if len(value) != 10:
+        raise ValueError("Invalid date: " + value)
+
+    return value
+
+
+# Query parameters accepted by each endpoint, with the function used to parse them.
+QUERY_PARAMETERS = {
+    '/runs': {
+        'run_id': str,
+        'sequencer_type': str,
+        'start_date': parse_date,
+        'end_date': parse_date,
+    },
+    '/library-qc': {
+        'run_id': str,
+        'library_id': str,
+        'species': str,
+        'start_date': parse_date,
+        'end_date': parse_date,
+        'min_depth': float,
+        'max_depth': float,
+    },
+    '/species-abundance': {
+        'run_id': str,
+        'library_id': str,
+        'start_date': parse_date,
+        'end_date': parse_date,
+    },
+}
+
+
+def parse_query(endpoint, query_string):
+    """
+    :param endpoint: Endpoint path (eg. '/library-qc').
+    :type endpoint: str
+    :param query_string: URL query string.
+    :type query_string: str
+    :return: Filters (by parameter name), offset and limit.
+    :rtype: tuple[dict[str, object], int, int]
+    :raises ValueError: If a parameter is unknown, repeated or invalid.
+    """
+    filters = {}
+    offset = 0
+    limit = DEFAULT_PAGE_LIMIT
+    for name, values in urllib.parse.parse_qs(query_string, keep_blank_values=True, strict_parsing=False).items():
+        if len(values) > 1:
+            raise ValueError("Parameter given more than once: " + name)
+        if name == 'offset':
+            offset = int(values[0])
+        elif name == 'limit':
+            limit = int(values[0])
+        elif name in QUERY_PARAMETERS[endpoint]:
+            filters[name] = QUERY_PARAMETERS[endpoint][name](values[0])
+        else:
+            raise ValueError("Unknown parameter: " + name)
+    if offset < 0 or limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise ValueError("offset must be at least 0, and limit must be between 1 and " + str(MAX_PAGE_LIMIT))
+
+    return filters, offset, limit
+
+
+def is_run_in_date_range(run_id, filters):
+    """
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param filters: Filters, as returned by `parse_query`.
+    :type filters: dict[str, object]
+    :return: Whether the run's date is within 'start_date' and 'end_date' (inclusive), if set. Runs without a date are excluded by either.
+    :rtype: bool
+    """
+    if 'start_date' not in filters and 'end_date' not in filters:
+        return True
+    run_date = qc_index.get_run_date(run_id)
+    if run_date is None:
+        return False
+
+    return filters.get('start_date', run_date) <= run_date <= filters.get('end_date', run_date)
+
+
+def is_library_qc_match(record, filters):
+    """
+    :param record: Library QC record.
+    :type record: dict[str, object]
+    :param filters: Filters, as returned by `parse_query`.
+    :type filters: dict[str, object]
+    :return: Whether the record matches the library ID, species and depth filters, with the same semantics as `qc_index.query_library_qc`.
+    :rtype: bool
+    """
+    if 'library_id' in filters and record.get('library_id', None) != filters['library_id']:
+        return False
+    if 'species' in filters and record.get('inferred_species_name', None) != filters['species']:
+        return False
+    if 'min_depth' in filters or 'max_depth' in filters:
+        depth = record.get('inferred_species_estimated_depth', None)
+        if depth is None:
+            return False
+        if 'min_depth' in filters and not depth >= filters['min_depth']:
+            return False
+        if 'max_depth' in filters and not depth < filters['max_depth']:
+            return False
+
+    return True
+
+
+def find_records(endpoint, filters):
+    """
+    :param endpoint: Endpoint path (eg. '/library-qc').
+    :type endpoint: str
+    :param filters: Filters, as returned by `parse_query`.
+    :type filters: dict[str, object]
+    :return: All matching records, ordered by run ID (and library ID), and the generation of the index they were found in.
+    :rtype: tuple[list[dict[str, object]], int]
+    """
+    matches = []
+    with _index_lock:
+        generation = _index['generation']
+        if 'run_id' in filters:
+            run_ids = [filters['run_id']]
+        elif endpoint == '/library-qc' and 'species' in filters:
+            run_ids = sorted(_index['run_ids_by_species'].get(filters['species'], set()))
+        else:
+            run_ids = _index['run_ids']
+        for run_id in run_ids:
+            if not is_run_in_date_range(run_id, filters):
+                continue
+            if endpoint == '/runs':
+                run = _index['runs'].get(run_id, None)
+                if run is not None and ('sequencer_type' not in filters or run.get('sequencer_type', None) == filters['sequencer_type']):
+                    matches.append(run)
+            elif endpoint == '/library-qc':
+                matches.extend(record for record in _index['library_qc'].get(run_id, []) if is_library_qc_match(record, filters))
+            else:
+                matches.extend(record for record in _index['species_abundance'].get(run_id, []) if 'library_id' not in filters or record.get('library_id', None) == filters['library_id'])
+
+    return matches, generation
+
+
+def clear_response_cache():
+    """
+    :return: None
+    :rtype: NoneType
+    """
+    with _response_cache_lock:
+        _response_cache.clear()
+
+
+def get_response(path):
+    """
+    Build (or fetch from the cache) the response to a request.
+
+    :param path: Request path, including the query string (eg. '/library-qc?species=Escherichia%20coli').
+    :type path: str
+    :return: HTTP status, JSON body and ETag.
+    :rtype: tuple[int, bytes, str]
+    """
+    with _response_cache_lock:
+        cached_response = _response_cache.get(path, None)
+    if cached_response is not None and cached_response[0] == _index['generation']:
+        return cached_response[1]
+
+    endpoint, _, query_string = path.partition('?')
+    if endpoint not in QUERY_PARAMETERS:
+        return 404, json.dumps({'error': 'Not found'}).encode('utf-8'), None
+    try:
+        filters, offset, limit = parse_query(endpoint, query_string)
+    except ValueError as e:
+        return 400, json.dumps({'error': str(e)}).encode('utf-8'), None
+
+    matches, generation = find_records(endpoint, filters)
+    page = {
+        'total': len(matches),
+        'offset': offset,
+        'limit': limit,
+        'next_offset': offset + limit if offset + limit < len(matches) else None,
+        'records': matches[offset:offset + limit],
+    }
+    body = json.dumps(page).encode('utf-8')
+    response = (200, body, '"' + hashlib.sha256(body).hexdigest()[0:32] + '"')
+    with _response_cache_lock:
+        if len(_response_cache) >= RESPONSE_CACHE_SIZE:
+            _response_cache.clear()
+        _response_cache[path] = (generation, response)
+
+    return response
+
+
+def is_etag_match(if_none_match, etag):
+    """
+    :param if_none_match: Value of the If-None-Match request header.
+    :type if_none_match: Optional[str]
+    :param etag: ETag of the current response, without any encoding suffix.
+    :type etag: str
+    :return: Whether the client's copy is current.
+    :rtype: bool
+    """
+    if if_none_match is None:
+        return False
+    for client_etag in if_none_match.split(','):
+        client_etag = client_etag.strip()
+        if client_etag.startswith('W/'):
+            client_etag = client_etag[2:]
+        if client_etag == '*' or client_etag == etag or client_etag == etag[0:-1] + '-gzip"':
+            return True
+
+    return False
+
+
+class ApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve library-qc, species-abundance and runs records from the in-memory index at '/library-qc',
+    '/species-abundance' and '/runs'.
+    """
+    def do_GET(self):
+        request_start_timestamp = time.perf_counter()
+        endpoint = self.path.split('?')[0]
+        status, body, etag = get_response(self.path)
+        headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if etag is not None:
+            gzip_accepted = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if gzip_accepted and len(body) >= GZIP_MIN_BYTES:
+                headers['ETag'] = etag[0:-1] + '-gzip"'
+            else:
+                headers['ETag'] = etag
+            if is_etag_match(self.headers.get('If-None-Match', None), etag):
+                status = 304
+                body = b''
+            elif 'ETag' in headers and headers['ETag'] != etag:
+                headers['Content-Encoding'] = 'gzip'
+                body = gzip.compress(body, mtime=0)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        metrics.increment_counter('api_requests_total', endpoint=endpoint if endpoint in QUERY_PARAMETERS else 'other', status=str(status))
+        metrics.observe('api_request_duration_seconds', time.perf_counter() - request_start_timestamp, endpoint=endpoint if endpoint in QUERY_PARAMETERS else 'other')
+
+    def log_message(self, format, *args):
+        logging.debug(json.dumps({"event_type": "api_request", "client_address": self.client_address[0], "request": self.requestline}))
+
+
+def start_http_server(config):
+    """
+    Load the in-memory index, and start serving it over HTTP on 'api_port' (if set in the config), in a background thread.
+    The server listens on 'api_address' (default: '127.0.0.1'). Calling this again with the same address and port has no effect.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    api_port = config.get('api_port', None)
+    if api_port is None:
+        return
+    server_address = (config.get('api_address', '127.0.0.1'), int(api_port))
+    if server_address in _http_servers:
+        return
+
+    try:
+        server = http.server.ThreadingHTTPServer(server_address, ApiRequestHandler)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "start_api_server_failed", "address": server_address[0], "port": server_address[1], "error": repr(e)}))
+        return
+    if _index is None:
+        load_index(config)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='api-server', daemon=True).start()
+    _http_servers[server_address] = server
+    logging.info(json.dumps({"event_type": "api_server_started", "address": server_address[0], "port": server_address[1]}))
@@ -1,5 +1,15 @@
 import json
 import csv
+import logging
+import os
+import threading
+import types
+
+import routine_nanopore_qc_collector.metrics as metrics
+
+
+_reference_file_cache = {}
+_reference_file_cache_lock = threading.Lock()
 
 
 def get_excluded_runs(config):
@@ -98,28 +108,101 @@ def get_known_species(config):
     return known_species
 
 
+def freeze(value):
+    """
+    Make an immutable copy of parsed reference data. Dicts become read-only mappings and sets
+    become frozensets. Objects that appear more than once (eg. a species keyed by both taxid
+    and name) are frozen once, and shared.
+
+    :param value: Parsed reference data.
+    :type value: object
+    :return: Immutable copy of the data.
+    :rtype: object
+    """
+    frozen_by_id = {}
+
+    def freeze_value(value):
+        if id(value) in frozen_by_id:
+            return frozen_by_id[id(value)]
+        if isinstance(value, dict):
+            frozen = types.MappingProxyType({k: freeze_value(v) for k, v in value.items()})
+        elif isinstance(value, (set, frozenset)):
+            frozen = frozenset(value)
+        elif isinstance(value, list):
+            frozen = tuple(freeze_value(v) for v in value)
+        else:
+            return value
+        frozen_by_id[id(value)] = frozen
+        return frozen
+
+    return freeze_value(value)
+
+
+def get_cached_reference(config, path_key, parse_fn):
+    """
+    Get the parsed contents of a reference file named in the config. Files are only re-parsed
+    when their size or modification time changes. The result is an immutable snapshot (see `freeze`),
+    so it can be shared between config reloads and threads without being changed mid-run.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param path_key: Config key with the path to the reference file (eg. 'known_species_list').
+    :type path_key: str
+    :param parse_fn: Function that parses the file, given the config.
+    :type parse_fn: Callable[[dict[str, object]], object]
+    :return: Immutable parsed contents of the reference file.
+    :rtype: object
+    """
+    path = os.path.abspath(config[path_key])
+    stat = os.stat(path)
+    cache_key = (path_key, path)
+    with _reference_file_cache_lock:
+        cached = _reference_file_cache.get(cache_key, None)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['value']
+
+    value = freeze(parse_fn(config))
+    with _reference_file_cache_lock:
+        _reference_file_cache[cache_key] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'value': value,
+        }
+    logging.info(json.dumps({"event_type": "reference_file_loaded", "config_key": path_key, "reference_file": path}))
+
+    return value
+
+
+@metrics.timed('load_config')
 def load_config(config_path: str) -> dict[str, object]:
     """
+    Load the config file, along with the reference files it names. Reference files are
+    cached between calls (see `get_cached_reference`), and are only re-parsed when they change.
+
+    :param config_path: Path to the config file.
+    :type config_path: str
+    :return: Application config. The 'excluded_runs', 'projects' and 'known_species' entries are immutable.
+    :rtype: dict[str, object]
     """
     with open(config_path, 'r') as f:
         config = json.load(f)
 
     if 'excluded_runs_list' in config:
-        excluded_runs = get_excluded_runs(config)
+        excluded_runs = get_cached_reference(config, 'excluded_runs_list', get_excluded_runs)
         config['excluded_runs'] = excluded_runs
     else:
-        config['excluded_runs'] = set()
+        config['excluded_runs'] = frozenset()
 
     if 'projects_definition_file' in config:
-        projects = get_projects(config)
+        projects = get_cached_reference(config, 'projects_definition_file', get_projects)
         config['projects'] = projects
     else:
-        config['projects'] = {}
+        config['projects'] = types.MappingProxyType({})
 
     if 'known_species_list' in config:
-        known_species = get_known_species(config)
+        known_species = get_cached_reference(config, 'known_species_list', get_known_species)
         config['known_species'] = known_species
     else:
-        config['known_species'] = {}
+        config['known_species'] = types.MappingProxyType({})
 
     return config
@@ -1,4 +1,6 @@
+import bisect
 import collections
+import concurrent.futures
 import csv
 import glob
 import json
@@ -7,11 +9,41 @@ import os
 import re
 import shutil
 import subprocess
+import time
 
-from typing import Iterator, Optional
+from typing import Iterator, Optional, TypedDict
 
+import routine_nanopore_qc_collector.export as export
+import routine_nanopore_qc_collector.fingerprint as fingerprint
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.metrics as metrics
 import routine_nanopore_qc_collector.parsers as parsers
+import routine_nanopore_qc_collector.prefetch as prefetch
+import routine_nanopore_qc_collector.qc_index as qc_index
+import routine_nanopore_qc_collector.qc_metrics as qc_metrics
 import routine_nanopore_qc_collector.samplesheet as samplesheet
+import routine_nanopore_qc_collector.species_baselines as species_baselines
+import routine_nanopore_qc_collector.taxonomy as taxonomy
+import routine_nanopore_qc_collector.writers as writers
+
+
+GRIDION_RUN_ID_REGEX = re.compile("\\d{8}_\\d{4}_X\\d_[A-Z0-9]{8}_[a-z0-9]{8}$")
+PROMETHION_RUN_ID_REGEX = re.compile("\\d{8}_\\d{4}_P2S_\\d+-\\w_[A-Z0-9]{8}_[a-z0-9]{8}$")
+
+# Runs whose outputs this process has collected, or found to be up to date, by run ID. Keys: ['collection_state', 'num_libraries']
+_collected_runs = {}
+
+
+class RunRecord(TypedDict):
+    """
+    A sequencing run found in the analysis_by_run dir.
+    """
+    run_id: str
+    path: str
+    sequencer_type: str
+    excluded: bool
+    routine_nanopore_qc_output_path: Optional[str]
+    analysis_complete: bool
 
 
 def create_output_dirs(config):
@@ -22,17 +54,37 @@ def create_output_dirs(config):
         base_outdir,
         os.path.join(base_outdir, 'library-qc'),
         os.path.join(base_outdir, 'species-abundance'),
+        os.path.join(base_outdir, 'manifests'),
     ]
     for output_dir in output_dirs:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)    
 
 
+@metrics.timed('write_json')
+def write_json(dst_path, data):
+    """
+    Write data to a json file atomically. The data is written to a temporary file in the same
+    directory, which is then renamed to the destination, so readers never see a partial file.
+
+    :param dst_path: Path to write to.
+    :type dst_path: str
+    :param data: Data to write.
+    :type data: object
+    :return: None
+    :rtype: NoneType
+    """
+    with writers.atomic_writer(dst_path) as f:
+        json.dump(data, f, indent=2)
+
+
 def find_latest_routine_nanopore_qc_output(analysis_dir):
     """
     """
     routine_nanopore_qc_output_dir_glob = "routine-nanopore-qc-v*-output"
     routine_nanopore_qc_output_dirs = glob.glob(os.path.join(analysis_dir, routine_nanopore_qc_output_dir_glob))
+    # glob results are in arbitrary order, so order by pipeline version (eg. 'v0.10.0' after 'v0.9.1').
+    routine_nanopore_qc_output_dirs.sort(key=lambda d: [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', os.path.basename(d))])
     latest_routine_nanopore_qc_output_dir = None
     if len(routine_nanopore_qc_output_dirs) > 0:
         latest_routine_nanopore_qc_output_dir = os.path.abspath(routine_nanopore_qc_output_dirs[-1])
@@ -40,95 +92,437 @@ def find_latest_routine_nanopore_qc_output(analysis_dir):
     return latest_routine_nanopore_qc_output_dir
 
 
-def find_analysis_dirs(config, check_complete=True):
+def load_scan_state(config):
     """
+    Load the persisted scan state from 'scan_state.json' in the output dir.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Scan state. Keys: ['runs']. 'runs' is keyed by run ID; see `get_run_status` for the per-run keys.
+    :rtype: dict[str, object]
     """
-    gridion_run_id_regex = "\\d{8}_\\d{4}_X\\d_[A-Z0-9]{8}_[a-z0-9]{8}$"
-    promethion_run_id_regex = "\\d{8}_\\d{4}_P2S_\\d+-\\w_[A-Z0-9]{8}_[a-z0-9]{8}$"
-    analysis_by_run_dir = config['analysis_by_run_dir']
-    subdirs = os.scandir(analysis_by_run_dir)
-    
-    for subdir in subdirs:
-        run_id = subdir.name
-        matches_gridion_regex = re.match(gridion_run_id_regex, run_id)
-        matches_promethion_regex = re.match(promethion_run_id_regex, run_id)
-        sequencer_type = None
-        if matches_gridion_regex:
-            sequencer_type = 'gridion'
-        elif matches_promethion_regex:
-            sequencer_type = 'promethion'
-        not_excluded = run_id not in config['excluded_runs']
-        ready_to_collect = False
-        if check_complete:
-            latest_routine_nanopore_qc_output = find_latest_routine_nanopore_qc_output(subdir)
-            if latest_routine_nanopore_qc_output is not None and os.path.exists(latest_routine_nanopore_qc_output):
-                routine_nanopore_qc_analysis_complete = os.path.exists(os.path.join(latest_routine_nanopore_qc_output, 'analysis_complete.json'))
-                ready_to_collect = routine_nanopore_qc_analysis_complete
+    scan_state = {'runs': {}}
+    scan_state_path = os.path.join(config['output_dir'], 'scan_state.json')
+    if os.path.exists(scan_state_path):
+        try:
+            with open(scan_state_path, 'r') as f:
+                scan_state = json.load(f)
+        except json.decoder.JSONDecodeError as e:
+            logging.warning(json.dumps({"event_type": "load_scan_state_failed", "scan_state_file": scan_state_path}))
+
+    scan_state['modified'] = False
+
+    return scan_state
+
+
+def save_scan_state(config, scan_state):
+    """
+    Write the scan state to 'scan_state.json' in the output dir, if it has been modified since it was loaded.
+    The file is written under the 'scan-state' lease.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `load_scan_state`.
+    :type scan_state: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    if not scan_state.get('modified', True):
+        return
+
+    scan_state_path = os.path.join(config['output_dir'], 'scan_state.json')
+    with leases.lease(config, 'scan-state', wait_seconds=None):
+        with writers.atomic_writer(scan_state_path) as f:
+            json.dump({'runs': scan_state['runs']}, f)
+    scan_state['modified'] = False
+
+    logging.debug(json.dumps({"event_type": "write_scan_state_complete", "scan_state_file": scan_state_path}))
+
+
+def get_run_status(scan_state, run_dir_path):
+    """
+    Determine the latest routine-nanopore-qc output dir for a run, and whether its analysis is complete.
+    Results are cached in the scan state along with directory mtimes, and only re-checked when the run
+    directory (for a new output dir) or an incomplete output dir (for 'analysis_complete.json') has changed.
+
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param run_dir_path: Path to the run's analysis directory.
+    :type run_dir_path: str
+    :return: Run status. Keys: ['run_dir_path', 'run_dir_mtime_ns', 'routine_nanopore_qc_output_path', 'output_dir_mtime_ns', 'analysis_complete']
+    :rtype: dict[str, object]
+    """
+    run_id = os.path.basename(run_dir_path)
+    run_dir_path = os.path.abspath(run_dir_path)
+    run_dir_mtime_ns = os.stat(run_dir_path).st_mtime_ns
+    cached_run_status = scan_state['runs'].get(run_id, None)
+    if cached_run_status is not None and cached_run_status.get('run_dir_path', None) is None:
+        # Scan states written before multiple analysis roots were supported don't record the run dir path.
+        cached_run_status = dict(cached_run_status, run_dir_path=run_dir_path)
+        scan_state['runs'][run_id] = cached_run_status
+        scan_state['modified'] = True
+    if cached_run_status is not None and cached_run_status['run_dir_path'] == run_dir_path and cached_run_status['run_dir_mtime_ns'] == run_dir_mtime_ns:
+        if cached_run_status['analysis_complete'] or cached_run_status['routine_nanopore_qc_output_path'] is None:
+            return cached_run_status
+        try:
+            output_dir_mtime_ns = os.stat(cached_run_status['routine_nanopore_qc_output_path']).st_mtime_ns
+        except FileNotFoundError as e:
+            output_dir_mtime_ns = None
+        if output_dir_mtime_ns == cached_run_status['output_dir_mtime_ns']:
+            return cached_run_status
+
+    run_status = {
+        'run_dir_path': run_dir_path,
+        'run_dir_mtime_ns': run_dir_mtime_ns,
+        'routine_nanopore_qc_output_path': None,
+        'output_dir_mtime_ns': None,
+        'analysis_complete': False,
+    }
+    latest_routine_nanopore_qc_output = find_latest_routine_nanopore_qc_output(run_dir_path)
+    if latest_routine_nanopore_qc_output is not None and os.path.exists(latest_routine_nanopore_qc_output):
+        run_status['routine_nanopore_qc_output_path'] = latest_routine_nanopore_qc_output
+        run_status['output_dir_mtime_ns'] = os.stat(latest_routine_nanopore_qc_output).st_mtime_ns
+        run_status['analysis_complete'] = os.path.exists(os.path.join(latest_routine_nanopore_qc_output, 'analysis_complete.json'))
+
+    scan_state['runs'][run_id] = run_status
+    scan_state['modified'] = True
+
+    return run_status
+
+
+def prune_scan_state(scan_state, run_ids):
+    """
+    Remove runs that no longer exist from the scan state.
+
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param run_ids: IDs of all runs currently present.
+    :type run_ids: set[str]
+    :return: None
+    :rtype: NoneType
+    """
+    for run_id in list(scan_state['runs'].keys()):
+        if run_id not in run_ids:
+            scan_state['runs'].pop(run_id)
+            scan_state['modified'] = True
+
+
+def get_sequencer_type(run_id):
+    """
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: 'gridion' or 'promethion', or None if the run ID doesn't match either format.
+    :rtype: Optional[str]
+    """
+    if GRIDION_RUN_ID_REGEX.match(run_id):
+        return 'gridion'
+    elif PROMETHION_RUN_ID_REGEX.match(run_id):
+        return 'promethion'
+
+    return None
+
+
+def get_analysis_roots(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Analysis roots, from 'analysis_by_run_dir', which may be a single path or a list of paths. Duplicates are removed.
+    :rtype: list[str]
+    """
+    analysis_roots = config['analysis_by_run_dir']
+    if isinstance(analysis_roots, str):
+        analysis_roots = [analysis_roots]
+
+    return list(dict.fromkeys(os.path.abspath(analysis_root) for analysis_root in analysis_roots))
+
+
+def discover_root_runs(config, analysis_root, scan_state):
+    """
+    Find all sequencing runs in one analysis root, with a single pass over its contents.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_root: Path to an analysis_by_run dir.
+    :type analysis_root: str
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :return: Runs, in directory order.
+    :rtype: list[RunRecord]
+    """
+    runs = []
+    with os.scandir(analysis_root) as subdirs:
+        for subdir in subdirs:
+            run_id = subdir.name
+            sequencer_type = get_sequencer_type(run_id)
+            is_directory = subdir.is_dir()
+            if sequencer_type is None or not is_directory:
+                logging.debug(json.dumps({
+                    "event_type": "directory_skipped",
+                    "analysis_directory_path": os.path.abspath(subdir.path),
+                    "conditions_checked": {
+                        "is_directory": is_directory,
+                        "matches_nanopore_run_id_format": sequencer_type is not None,
+                    }
+                }))
+                continue
+
+            run = {
+                'run_id': run_id,
+                'path': os.path.abspath(subdir.path),
+                'sequencer_type': sequencer_type,
+                'excluded': run_id in config['excluded_runs'],
+                'routine_nanopore_qc_output_path': None,
+                'analysis_complete': False,
+            }
+            if not run['excluded']:
+                run_status = get_run_status(scan_state, subdir.path)
+                run['routine_nanopore_qc_output_path'] = run_status['routine_nanopore_qc_output_path']
+                run['analysis_complete'] = run_status['analysis_complete']
+            runs.append(run)
+
+    return runs
+
+
+def get_cached_root_runs(config, analysis_root, scan_state):
+    """
+    Rebuild the runs in an analysis root from the scan state, for use when the root can't be scanned in time.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_root: Path to an analysis_by_run dir.
+    :type analysis_root: str
+    :param scan_state: Scan state, as returned by `load_scan_state`.
+    :type scan_state: dict[str, object]
+    :return: Runs last seen in the root.
+    :rtype: list[RunRecord]
+    """
+    runs = []
+    for run_id, run_status in scan_state['runs'].items():
+        if os.path.dirname(run_status.get('run_dir_path', None) or '') != analysis_root:
+            continue
+        runs.append({
+            'run_id': run_id,
+            'path': run_status['run_dir_path'],
+            'sequencer_type': get_sequencer_type(run_id),
+            'excluded': run_id in config['excluded_runs'],
+            'routine_nanopore_qc_output_path': run_status['routine_nanopore_qc_output_path'],
+            'analysis_complete': run_status['analysis_complete'],
+        })
+
+    return runs
+
+
+@metrics.timed('discover_runs')
+def discover_runs(config, scan_state=None):
+    """
+    Find all sequencing runs in the analysis_by_run dirs ('analysis_by_run_dir' in the config, which may be a list).
+    The result is shared by `find_runs` (for 'runs.json') and `find_analysis_dirs` (for collection).
+
+    Each root is scanned in its own thread, so that a slow mount doesn't hold up the others. If
+    'analysis_root_timeout_seconds' is set, roots that take longer than that are not waited for, and the runs
+    last recorded for them in the scan state are used instead. Runs found in more than one root are
+    only included once: from the first root (in config order) in which their analysis is complete,
+    or otherwise from the first root in which they were found.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: Optional[dict[str, object]]
+    :return: Runs, sorted by run ID.
+    :rtype: list[RunRecord]
+    """
+    logging.info(json.dumps({"event_type": "discover_runs_start"}))
+    if scan_state is None:
+        scan_state = {'runs': {}}
+
+    analysis_roots = get_analysis_roots(config)
+    analysis_root_timeout_seconds = config.get('analysis_root_timeout_seconds', None)
+    deadline = None
+    if analysis_root_timeout_seconds is not None:
+        deadline = time.monotonic() + float(analysis_root_timeout_seconds)
+
+    def discover_root_runs_timed(analysis_root, root_scan_state):
+        start_time = time.monotonic()
+        root_runs = discover_root_runs(config, analysis_root, root_scan_state)
+        duration_seconds = time.monotonic() - start_time
+        metrics.set_gauge('analysis_root_scan_duration_seconds', duration_seconds, analysis_root=analysis_root)
+        metrics.set_gauge('analysis_root_runs', len(root_runs), analysis_root=analysis_root)
+        logging.info(json.dumps({"event_type": "discover_root_runs_complete", "analysis_root": analysis_root, "num_runs": len(root_runs), "duration_seconds": round(duration_seconds, 3)}))
+        return root_runs
+
+    # Each root updates its own copy of the scan state, so that a root that is still being scanned after
+    # its timeout can't modify the scan state while it is being saved. For each run, the status from the
+    # root that the run is taken from is merged back in.
+    root_scan_states = {analysis_root: {'runs': dict(scan_state['runs']), 'modified': False} for analysis_root in analysis_roots}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(analysis_roots), thread_name_prefix='discover')
+    futures = [executor.submit(discover_root_runs_timed, analysis_root, root_scan_states[analysis_root]) for analysis_root in analysis_roots]
+    executor.shutdown(wait=False)
+
+    runs_by_run_id = {}
+    root_scan_states_by_run_id = {}
+    for analysis_root, future in zip(analysis_roots, futures):
+        root_scan_state = root_scan_states[analysis_root]
+        try:
+            timeout_seconds = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            root_runs = future.result(timeout=timeout_seconds)
+        except concurrent.futures.TimeoutError as e:
+            root_runs = get_cached_root_runs(config, analysis_root, scan_state)
+            root_scan_state = scan_state
+            metrics.increment_counter('analysis_root_timeouts_total', analysis_root=analysis_root)
+            logging.warning(json.dumps({"event_type": "discover_root_runs_timeout", "analysis_root": analysis_root, "timeout_seconds": analysis_root_timeout_seconds, "num_cached_runs": len(root_runs)}))
+        except OSError as e:
+            root_runs = get_cached_root_runs(config, analysis_root, scan_state)
+            root_scan_state = scan_state
+            metrics.increment_counter('errors_total', stage='discover_root_runs')
+            logging.error(json.dumps({"event_type": "discover_root_runs_failed", "analysis_root": analysis_root, "error": repr(e), "num_cached_runs": len(root_runs)}))
+
+        for run in root_runs:
+            existing_run = runs_by_run_id.get(run['run_id'], None)
+            if existing_run is not None:
+                logging.warning(json.dumps({"event_type": "duplicate_run_found", "sequencing_run_id": run['run_id'], "analysis_directory_paths": [existing_run['path'], run['path']]}))
+                if existing_run['analysis_complete'] or not run['analysis_complete']:
+                    continue
+            runs_by_run_id[run['run_id']] = run
+            root_scan_states_by_run_id[run['run_id']] = root_scan_state
+
+    for run_id, root_scan_state in root_scan_states_by_run_id.items():
+        run_status = root_scan_state['runs'].get(run_id, None)
+        if run_status is not None and run_status is not scan_state['runs'].get(run_id, None):
+            scan_state['runs'][run_id] = run_status
+            scan_state['modified'] = True
+
+    runs = sorted(runs_by_run_id.values(), key=lambda run: run['run_id'])
+    prune_scan_state(scan_state, set(runs_by_run_id.keys()))
+
+    metrics.set_gauge('runs_discovered', len([run for run in runs if run['excluded']]), status='excluded')
+    metrics.set_gauge('runs_discovered', len([run for run in runs if not run['excluded'] and run['analysis_complete']]), status='analysis_complete')
+    metrics.set_gauge('runs_discovered', len([run for run in runs if not run['excluded'] and not run['analysis_complete']]), status='analysis_incomplete')
+    logging.info(json.dumps({"event_type": "discover_runs_complete", "num_runs": len(runs), "num_analysis_roots": len(analysis_roots)}))
+
+    return runs
+
+
+def update_discovered_run(config, scan_state, discovered_runs, run_dir_path):
+    """
+    Refresh a single run in the result of `discover_runs`, eg. after it was found to be complete while watching,
+    without re-discovering the other runs. Only that run's entry in the scan state is checked.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param discovered_runs: Runs, as returned by `discover_runs`. Updated in place, and kept sorted by run ID.
+    :type discovered_runs: list[RunRecord]
+    :param run_dir_path: Path to the run's analysis directory.
+    :type run_dir_path: str
+    :return: The updated run, or None if it isn't a run dir.
+    :rtype: Optional[RunRecord]
+    """
+    run_id = os.path.basename(run_dir_path)
+    sequencer_type = get_sequencer_type(run_id)
+    if sequencer_type is None or not os.path.isdir(run_dir_path):
+        return None
+
+    run = {
+        'run_id': run_id,
+        'path': os.path.abspath(run_dir_path),
+        'sequencer_type': sequencer_type,
+        'excluded': run_id in config['excluded_runs'],
+        'routine_nanopore_qc_output_path': None,
+        'analysis_complete': False,
+    }
+    if not run['excluded']:
+        run_status = get_run_status(scan_state, run_dir_path)
+        run['routine_nanopore_qc_output_path'] = run_status['routine_nanopore_qc_output_path']
+        run['analysis_complete'] = run_status['analysis_complete']
+
+    position = bisect.bisect_left([discovered_run['run_id'] for discovered_run in discovered_runs], run_id)
+    if position < len(discovered_runs) and discovered_runs[position]['run_id'] == run_id:
+        existing_run = discovered_runs[position]
+        # As in `discover_runs`, a run found in another root is only replaced if this copy's analysis is complete and that one's isn't.
+        if existing_run['path'] == run['path'] or (run['analysis_complete'] and not existing_run['analysis_complete']):
+            discovered_runs[position] = run
         else:
-            ready_to_collect = True
+            run = existing_run
+    else:
+        discovered_runs.insert(position, run)
+
+    return run
+
+
+def find_analysis_dirs(config, check_complete=True, scan_state=None, discovered_runs=None):
+    """
+    Find analysis directories that are ready to be collected.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param check_complete: Only yield analysis dirs whose analysis is complete.
+    :type check_complete: bool
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: Optional[dict[str, object]]
+    :param discovered_runs: Runs, as returned by `discover_runs`. Discovered here if not supplied.
+    :type discovered_runs: Optional[list[RunRecord]]
+    :return: Analysis dir (Keys: ['path', 'sequencer_type', 'routine_nanopore_qc_output_path']), or None for skipped runs.
+    :rtype: Iterator[Optional[dict[str, str]]]
+    """
+    if discovered_runs is None:
+        discovered_runs = discover_runs(config, scan_state)
 
+    for run in discovered_runs:
         conditions_checked = {
-            "is_directory": subdir.is_dir(),
-            "matches_nanopore_run_id_format": ((matches_gridion_regex is not None) or (matches_promethion_regex is not None)),
-            "not_excluded": not_excluded,
-            "ready_to_collect": ready_to_collect,
+            "is_directory": True,
+            "matches_nanopore_run_id_format": True,
+            "not_excluded": not run['excluded'],
+            "ready_to_collect": run['analysis_complete'] or not check_complete,
         }
         conditions_met = list(conditions_checked.values())
 
-        analysis_directory_path = os.path.abspath(subdir.path)
         analysis_dir = {
-            "path": analysis_directory_path,
-            "sequencer_type": sequencer_type,
+            "path": run['path'],
+            "sequencer_type": run['sequencer_type'],
+            "routine_nanopore_qc_output_path": run['routine_nanopore_qc_output_path'],
         }
         if all(conditions_met):
             logging.info(json.dumps({
                 "event_type": "analysis_directory_found",
-                "sequencing_run_id": run_id,
-                "analysis_directory_path": analysis_directory_path
+                "sequencing_run_id": run['run_id'],
+                "analysis_directory_path": run['path']
             }))
 
             yield analysis_dir
         else:
             logging.debug(json.dumps({
                 "event_type": "directory_skipped",
-                "analysis_directory_path": os.path.abspath(subdir.path),
+                "analysis_directory_path": run['path'],
                 "conditions_checked": conditions_checked
             }))
             yield None
 
             
-def find_runs(config):
+def find_runs(config, scan_state=None, discovered_runs=None):
     """
     Finda all runs that have routine sequence QC data.
 
     :param config: Application config.
     :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: Optional[dict[str, object]]
+    :param discovered_runs: Runs, as returned by `discover_runs`. Discovered here if not supplied.
+    :type discovered_runs: Optional[list[RunRecord]]
     :return: List of runs. Keys: ['run_id', 'sequencer_type']
     :rtype: list[dict[str, str]]
     """
     logging.info(json.dumps({"event_type": "find_runs_start"}))
-    runs = []
-    all_analysis_dirs = sorted(list(os.listdir(config['analysis_by_run_dir'])))
-    all_run_ids = filter(lambda x: re.match('\\d{8}_\\d{4}_', x) != None, all_analysis_dirs)
-    for run_id in all_run_ids:
-        if run_id in config['excluded_runs']:
-            continue
-
-        sequencer_type = None
-        if re.match('\\d{8}_\\d{4}_X', run_id):
-            sequencer_type = 'gridion'
-        elif re.match('\\d{8}_\\d{4}_P', run_id):
-            sequencer_type = 'promethion'
+    if discovered_runs is None:
+        discovered_runs = discover_runs(config, scan_state)
 
-        analysis_dir = os.path.join(config['analysis_by_run_dir'], run_id)
-        latest_routine_nanopore_qc_output_dir = find_latest_routine_nanopore_qc_output(analysis_dir)
-        
-        if os.path.exists(os.path.join(latest_routine_nanopore_qc_output_dir, 'analysis_complete.json')):
-            run = {
-                'run_id': run_id,
-                'sequencer_type': sequencer_type,
-            }
-            runs.append(run)
+    runs = []
+    for run in discovered_runs:
+        if not run['excluded'] and run['analysis_complete']:
+            runs.append({
+                'run_id': run['run_id'],
+                'sequencer_type': run['sequencer_type'],
+            })
 
     logging.info(json.dumps({
         "event_type": "find_runs_complete"
@@ -137,17 +531,21 @@ def find_runs(config):
     return runs
 
 
-def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, str]]]:
+def scan(config: dict[str, object], scan_state: Optional[dict[str, object]]=None, discovered_runs: Optional[list[RunRecord]]=None) -> Iterator[Optional[dict[str, str]]]:
     """
     Scanning involves looking for all existing runs and...
 
     :param config: Application config.
     :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `load_scan_state`. Updated in place.
+    :type scan_state: Optional[dict[str, object]]
+    :param discovered_runs: Runs, as returned by `discover_runs`. Discovered here if not supplied.
+    :type discovered_runs: Optional[list[RunRecord]]
     :return: A run directory to analyze, or None
     :rtype: Iterator[Optional[dict[str, object]]]
     """
     logging.info(json.dumps({"event_type": "scan_start"}))
-    for analysis_dir in find_analysis_dirs(config):    
+    for analysis_dir in find_analysis_dirs(config, scan_state=scan_state, discovered_runs=discovered_runs):    
         yield analysis_dir
 
 
@@ -240,85 +638,318 @@ def get_percent_reads_by_genus_name(species_abundance, genus_name):
     return percent_reads
 
 
-def add_genus(kraken_species_record):
+def add_genus(kraken_species_record, genera_by_taxid=None):
     """
+    Add 'genus_taxon_name' and 'genus_ncbi_taxonomy_id' to a kraken species record.
+
+    :param kraken_species_record: Parsed row from a kraken2 species report.
+    :type kraken_species_record: dict[str, object]
+    :param genera_by_taxid: Pre-resolved genera, as returned by `taxonomy.resolve_genera`. If None, the taxid is resolved individually.
+    :type genera_by_taxid: Optional[dict[str, dict[str, str]]]
+    :return: The kraken species record, with genus fields added.
+    :rtype: dict[str, object]
     """
     taxid = kraken_species_record['ncbi_taxonomy_id']
     if taxid != '0':
-        echo_cmd = [
-            'echo',
-            taxid,
-        ]
-        taxonkit_cmd = [
-            'taxonkit',
-            'reformat',
-            '-F',
-            '-I', '1',
-            '-f', '"{g}|{s}"',
-            '-t',
-        ]
-        try:
-            echo_result = subprocess.run(echo_cmd, text=True, capture_output=True, check=True)
-            taxonkit_result = subprocess.run(taxonkit_cmd, input=echo_result.stdout, text=True, capture_output=True, check=True)
-        except subprocess.CalledProcessError as e:
+        if genera_by_taxid is None:
+            genera_by_taxid = taxonomy.resolve_genera_taxonkit([taxid])
+        if taxid in genera_by_taxid:
+            kraken_species_record.update(genera_by_taxid[taxid])
+        else:
             logging.error(json.dumps({"event_type": "add_genus_failed", "ncbi_taxonomy_id": taxid}))
-        taxonkit_output = list(map(lambda x: x.strip('"'), taxonkit_result.stdout.strip().split('\t')[1:]))
-        genus_name = taxonkit_output[0].split('|')[0]
-        genus_taxid = taxonkit_output[1].split('|')[0]
-        kraken_species_record['genus_taxon_name'] = genus_name
-        kraken_species_record['genus_ncbi_taxonomy_id'] = genus_taxid
+            metrics.increment_counter('errors_total', stage='add_genus')
+            kraken_species_record['genus_taxon_name'] = None
+            kraken_species_record['genus_ncbi_taxonomy_id'] = None
     
     return kraken_species_record
     
     
-def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str, str]]):
+def collect_library_species_abundance(run_id, library_id, kraken_species, genera_by_taxid):
+    """
+    Build a library's species-abundance record from the top records of its kraken2 species report.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param library_id: Library ID.
+    :type library_id: str
+    :param kraken_species: Top records from the library's kraken2 species report.
+    :type kraken_species: list[dict[str, object]]
+    :param genera_by_taxid: Genus details by taxid, as returned by `taxonomy.resolve_genera`.
+    :type genera_by_taxid: dict[str, dict[str, str]]
+    :return: Species abundance record.
+    :rtype: dict[str, object]
+    """
+    library_species_abundance = {'library_id': library_id}
+    abundance_num = 1
+    for kraken_species_record in kraken_species:
+        if kraken_species_record['rank_code'] == 'U':
+            library_species_abundance['unclassified_fraction_total_reads'] = round(kraken_species_record['percent_seqs_in_clade'] / 100, 6)
+        else:
+            kraken_species_record = add_genus(kraken_species_record, genera_by_taxid)
+            if 'genus_taxon_name' in kraken_species_record:
+                logging.info(json.dumps({"event_type": "add_genus_complete", "sequencing_run_id": run_id, "library_id": library_id, "species": kraken_species_record['taxon_name'], "genus": kraken_species_record['genus_taxon_name']}))
+            library_species_abundance['abundance_' + str(abundance_num) + '_name'] = kraken_species_record['taxon_name']
+            library_species_abundance['abundance_' + str(abundance_num) + '_genus_name'] = kraken_species_record['genus_taxon_name']
+            library_species_abundance['abundance_' + str(abundance_num) + '_genus_taxid'] = kraken_species_record['genus_ncbi_taxonomy_id']
+            library_species_abundance['abundance_' + str(abundance_num) + '_fraction_total_reads'] = round(kraken_species_record['percent_seqs_in_clade'] / 100, 6)
+            abundance_num += 1
+
+    return library_species_abundance
+
+
+def collect_library_qc(config, run_id, library_id, nanoq_report, species_abundance, inferred_metrics=None, project_metrics=None):
+    """
+    Build a library's library-qc record from its nanoq report and species abundance.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param library_id: Library ID.
+    :type library_id: str
+    :param nanoq_report: Parsed nanoq report, or None if the library has no nanoq report.
+    :type nanoq_report: Optional[list[dict[str, object]]]
+    :param species_abundance: Species abundance record for the library.
+    :type species_abundance: dict[str, object]
+    :param inferred_metrics: Inferred species and genus metrics for the library, as computed for the whole run by `qc_metrics.compute_inferred_metrics`. If None, they are computed for this library alone.
+    :type inferred_metrics: Optional[dict[str, object]]
+    :param project_metrics: Project metrics for the library, as computed for the whole run by `qc_metrics.compute_project_metrics`. If None, no project fields are added.
+    :type project_metrics: Optional[dict[str, object]]
+    :return: Library QC record.
+    :rtype: dict[str, object]
+    """
+    library_qc = {}
+    if nanoq_report is None:
+        return library_qc
+
+    if len(nanoq_report) == 1:
+        nanoq = nanoq_report[0]
+        library_qc['library_id'] = library_id
+        library_qc['num_reads'] = nanoq['reads']
+        library_qc['num_bases'] = nanoq['bases']
+        library_qc['read_n50'] = nanoq['n50']
+        library_qc['longest_read'] = nanoq['longest']
+        library_qc['shortest_read'] = nanoq['shortest']
+        library_qc['median_read_length'] = nanoq['median_length']
+        library_qc['median_quality'] = nanoq['median_quality']
+
+    if inferred_metrics is None:
+        inferred_metrics = qc_metrics.compute_inferred_metrics(config, qc_metrics.load_abundance_columns([species_abundance]), [library_qc.get('num_bases', None)])[0]
+
+    if 'inferred_species_name' in inferred_metrics:
+        inferred_species = inferred_metrics['inferred_species_name']
+        logging.debug(json.dumps({'event_type': 'library_species_inferred', 'sequencing_run_id': run_id, 'library_id': library_id, 'inferred_species': inferred_species}))
+        if inferred_metrics['inferred_species_percent'] is None:
+            logging.error(json.dumps({"event_type": "collect_library_qc_metric_failed", "metric": "inferred_species_percent", 'library_id': library_id, 'inferred_species': inferred_species}))
+        if 'inferred_species_genome_size_mb' not in inferred_metrics:
+            logging.debug(json.dumps({'event_type': 'library_species_inference_failed', 'sequencing_run_id': run_id, 'library_id': library_id, 'inferred_species': inferred_species}))
+        library_qc.update(inferred_metrics)
+
+    if project_metrics is not None:
+        library_qc.update(project_metrics)
+
+    return library_qc
+
+
+def load_output_records(output_path):
+    """
+    Load the records from an existing output file, keyed by library ID.
+
+    :param output_path: Path to a '_species_abundance' or '_library_qc' output file, in any output format.
+    :type output_path: str
+    :return: Records by library ID. Records without a library ID are omitted.
+    :rtype: dict[str, dict[str, object]]
+    """
+    records_by_library_id = {}
+    try:
+        records = writers.read_records(output_path)
+    except (OSError, EOFError, json.decoder.JSONDecodeError) as e:
+        return records_by_library_id
+
+    for record in records:
+        if 'library_id' in record:
+            records_by_library_id[record['library_id']] = record
+
+    return records_by_library_id
+
+
+@metrics.timed('collect_outputs')
+def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str, str]], force: bool=False):
     """
     Collect all routine sequence QC outputs for a specific analysis dir.
 
+    Each run's outputs are accompanied by a manifest (see `fingerprint`) recording the pipeline
+    output dir and version, the known species list hash, and the size and mtime (and, when verifying, the
+    SHA-256) of each library's source files. Only libraries whose source files have changed are re-collected. Source files are
+    only compared when the pipeline output dir has changed since the run was last collected, unless
+    'verify_source_fingerprints' is enabled.
+
     :param config: Application config.
     :type config: dict[str, object]
     :param analysis_dir: Analysis dir. Keys: ['path', 'sequencer_type']
     :type analysis_dir: dict[str, str]
-    :return: 
-    :rtype: 
+    :param force: Re-collect outputs even if they already exist.
+    :type force: bool
+    :return: Summary of the collection. Keys: ['sequencing_run_id', 'num_libraries', 'num_libraries_collected', 'incomplete_library_ids', 'species_abundance_written', 'library_qc_written']
+    :rtype: dict[str, object]
     """
     run_id = os.path.basename(analysis_dir['path'])
     logging.info(json.dumps({"event_type": "collect_outputs_start", "sequencing_run_id": run_id, "analysis_dir_path": analysis_dir['path']}))
 
-    libraries_by_library_id = {}
-    latest_routine_nanopore_qc_output_path = find_latest_routine_nanopore_qc_output(analysis_dir['path'])
-    routine_nanopore_qc_output_dir_contents = os.listdir(latest_routine_nanopore_qc_output_path)
-    for library_output_dir in routine_nanopore_qc_output_dir_contents:
-        if os.path.isdir(os.path.join(latest_routine_nanopore_qc_output_path, library_output_dir)):
-            library_id = os.path.basename(library_output_dir)
-            libraries_by_library_id[library_id] = {}
-    
+    latest_routine_nanopore_qc_output_path = analysis_dir.get('routine_nanopore_qc_output_path', None)
+    if latest_routine_nanopore_qc_output_path is None:
+        latest_routine_nanopore_qc_output_path = find_latest_routine_nanopore_qc_output(analysis_dir['path'])
+    output_dir_mtime_ns = os.stat(latest_routine_nanopore_qc_output_path).st_mtime_ns
+    known_species_hash = fingerprint.get_known_species_hash(config)
+    library_projects = samplesheet.get_library_projects(config, run_id)
+    library_projects_hash = fingerprint.get_library_projects_hash(library_projects)
+    verify_source_fingerprints = config.get('verify_source_fingerprints', False)
+
+    # By default, outputs are assumed to be current if the pipeline output dir hasn't changed since they were collected.
+    # Runs already found to be up to date by this process are skipped without touching the manifest or the outputs.
+    collection_state = (config['output_dir'], latest_routine_nanopore_qc_output_path, output_dir_mtime_ns, known_species_hash, library_projects_hash)
+    collected_run = _collected_runs.get(run_id, None)
+    if not force and not verify_source_fingerprints and collected_run is not None and collected_run['collection_state'] == collection_state:
+        metrics.increment_counter('runs_collected_total', result='up_to_date')
+        logging.info(json.dumps({"event_type": "collect_outputs_complete", "sequencing_run_id": run_id, "analysis_dir_path": analysis_dir['path'], "outputs_up_to_date": True}))
+        return {
+            'sequencing_run_id': run_id,
+            'num_libraries': collected_run['num_libraries'],
+            'num_libraries_collected': 0,
+            'incomplete_library_ids': [],
+            'species_abundance_written': False,
+            'library_qc_written': False,
+        }
+
+    species_abundance_dst_file = writers.get_output_path(config, os.path.join(config['output_dir'], "species-abundance"), run_id + "_species_abundance")
+    library_qc_dst_file = writers.get_output_path(config, os.path.join(config['output_dir'], "library-qc"), run_id + "_library_qc")
+    species_abundance_exists = os.path.exists(species_abundance_dst_file)
+    library_qc_exists = os.path.exists(library_qc_dst_file)
+    manifest = None
+    if not force:
+        manifest = fingerprint.load_manifest(config, run_id)
+
+    # Otherwise, the same check is made against the manifest. Library source files are only compared when it fails,
+    # or on every collection with 'verify_source_fingerprints' enabled. Files added to a library dir don't change the
+    # output dir's mtime, so runs with incomplete libraries are always re-checked.
+    outputs_up_to_date = (
+        species_abundance_exists and library_qc_exists and manifest is not None
+        and manifest['routine_nanopore_qc_output_path'] == latest_routine_nanopore_qc_output_path
+        and manifest['output_dir_mtime_ns'] == output_dir_mtime_ns
+        and manifest['known_species_hash'] == known_species_hash
+        and manifest.get('library_projects_hash', None) == library_projects_hash
+        and len(fingerprint.get_incomplete_library_ids(manifest['libraries'])) == 0
+        and not verify_source_fingerprints
+    )
+    if outputs_up_to_date:
+        if qc_index.ensure_run_indexed(config, run_id, analysis_dir.get('sequencer_type', None), library_qc_dst_file, species_abundance_dst_file):
+            export.export_run(config, run_id)
+        _collected_runs[run_id] = {'collection_state': collection_state, 'num_libraries': len(manifest['libraries'])}
+        metrics.increment_counter('runs_collected_total', result='up_to_date')
+        logging.info(json.dumps({"event_type": "collect_outputs_complete", "sequencing_run_id": run_id, "analysis_dir_path": analysis_dir['path'], "outputs_up_to_date": True}))
+        return {
+            'sequencing_run_id': run_id,
+            'num_libraries': len(manifest['libraries']),
+            'num_libraries_collected': 0,
+            'incomplete_library_ids': [],
+            'species_abundance_written': False,
+            'library_qc_written': False,
+        }
+
+    library_ids = []
+    with os.scandir(latest_routine_nanopore_qc_output_path) as routine_nanopore_qc_output_dir_contents:
+        for library_output_dir in routine_nanopore_qc_output_dir_contents:
+            if library_output_dir.is_dir():
+                library_ids.append(library_output_dir.name)
+
+    previous_source_fingerprints = {}
+    if manifest is not None:
+        previous_source_fingerprints = manifest['libraries']
+    # Source files are fingerprinted for all libraries at once.
+    source_files_by_library_id = prefetch.prefetch_source_files(config, latest_routine_nanopore_qc_output_path, library_ids, previous_source_fingerprints)
+    source_fingerprints = {}
+    for library_id in library_ids:
+        source_fingerprints[library_id] = {
+            source_type: source_file['fingerprint'] for source_type, source_file in source_files_by_library_id[library_id].items()
+        }
+
+    if manifest is None:
+        # Without a manifest, there is nothing to compare against. Outputs that already exist were
+        # collected before manifests were introduced, and are adopted as-is.
+        species_abundance_library_ids = set() if species_abundance_exists and not force else set(library_ids)
+        library_qc_library_ids = set() if library_qc_exists and not force else set(library_ids)
+    else:
+        species_abundance_library_ids = set()
+        library_qc_library_ids = set()
+        for library_id in library_ids:
+            previous_library_fingerprints = previous_source_fingerprints.get(library_id, None)
+            if previous_library_fingerprints is None or not species_abundance_exists or not fingerprint.same_content(source_fingerprints[library_id]['kraken2_species'], previous_library_fingerprints['kraken2_species']):
+                species_abundance_library_ids.add(library_id)
+            if previous_library_fingerprints is None or not library_qc_exists or not fingerprint.same_content(source_fingerprints[library_id]['nanoq'], previous_library_fingerprints['nanoq']):
+                library_qc_library_ids.add(library_id)
+        # Library QC depends on the species abundance, on the genome sizes in the known species list,
+        # and on the libraries' projects from the samplesheet.
+        library_qc_library_ids |= species_abundance_library_ids
+        if manifest['known_species_hash'] != known_species_hash or manifest.get('library_projects_hash', None) != library_projects_hash:
+            library_qc_library_ids = set(library_ids)
+    removed_library_ids = set(previous_source_fingerprints.keys()) - set(library_ids)
+    incomplete_library_ids = fingerprint.get_incomplete_library_ids(source_fingerprints)
+    if len(incomplete_library_ids) > 0:
+        logging.warning(json.dumps({"event_type": "incomplete_libraries_found", "sequencing_run_id": run_id, "library_ids": incomplete_library_ids}))
+    if len(species_abundance_library_ids | library_qc_library_ids | removed_library_ids) > 0:
+        logging.info(json.dumps({
+            "event_type": "source_changes_detected",
+            "sequencing_run_id": run_id,
+            "species_abundance_library_ids": sorted(species_abundance_library_ids),
+            "library_qc_library_ids": sorted(library_qc_library_ids),
+            "removed_library_ids": sorted(removed_library_ids),
+        }))
+
+    # Existing outputs are only read if they are going to be re-written.
+    species_abundance_changed = len(species_abundance_library_ids) > 0 or len(removed_library_ids) > 0 or not species_abundance_exists
+    library_qc_changed = len(library_qc_library_ids) > 0 or len(removed_library_ids) > 0 or not library_qc_exists
+
     # species-abundance
-    species_abundance_by_library_id = {library_id: {'library_id': library_id} for library_id in libraries_by_library_id.keys()}
-    species_abundance_dst_file = os.path.join(config['output_dir'], "species-abundance", run_id + "_species_abundance.json")
-    if not os.path.exists(species_abundance_dst_file):
-        for library_id in species_abundance_by_library_id.keys():
-            kraken_species_src_file = os.path.join(latest_routine_nanopore_qc_output_path, library_id, library_id + '_kraken2_species.csv')
-            if os.path.exists(kraken_species_src_file):
-                kraken_species = parsers.parse_kraken_species(kraken_species_src_file)
-                library_species_abundance = {'library_id': library_id}
-                abundance_num = 1
-                for kraken_species_record in kraken_species[0:7]:
-                    if kraken_species_record['rank_code'] == 'U':
-                        library_species_abundance['unclassified_fraction_total_reads'] = round(kraken_species_record['percent_seqs_in_clade'] / 100, 6)
-                    else:
-                        kraken_species_record = add_genus(kraken_species_record)
-                        if 'genus_taxon_name' in kraken_species_record:
-                            logging.info(json.dumps({"event_type": "add_genus_complete", "sequencing_run_id": run_id, "library_id": library_id, "species": kraken_species_record['taxon_name'], "genus": kraken_species_record['genus_taxon_name']}))
-                        library_species_abundance['abundance_' + str(abundance_num) + '_name'] = kraken_species_record['taxon_name']
-                        library_species_abundance['abundance_' + str(abundance_num) + '_genus_name'] = kraken_species_record['genus_taxon_name']
-                        library_species_abundance['abundance_' + str(abundance_num) + '_genus_taxid'] = kraken_species_record['genus_ncbi_taxonomy_id']
-                        library_species_abundance['abundance_' + str(abundance_num) + '_fraction_total_reads'] = round(kraken_species_record['percent_seqs_in_clade'] / 100, 6)
-                        abundance_num += 1
-                species_abundance_by_library_id[library_id] = library_species_abundance
-
-        with open(species_abundance_dst_file, 'w') as f:
-            json.dump(list(species_abundance_by_library_id.values()), f, indent=2)
+    existing_species_abundance_by_library_id = {}
+    if (species_abundance_changed or library_qc_changed) and species_abundance_exists and not force:
+        existing_species_abundance_by_library_id = load_output_records(species_abundance_dst_file)
+    species_abundance_by_library_id = {}
+    for library_id in library_ids:
+        species_abundance_by_library_id[library_id] = existing_species_abundance_by_library_id.get(library_id, {'library_id': library_id})
+
+    species_abundance_written = False
+    if species_abundance_changed:
+        # Only the top species are read from each kraken2 species report, unless it was already read to be hashed.
+        kraken_species_library_ids = [library_id for library_id in library_ids if library_id in species_abundance_library_ids]
+        kraken_species_reports = prefetch.parse_source_files(
+            config,
+            [source_files_by_library_id[library_id]['kraken2_species'] for library_id in kraken_species_library_ids],
+            lambda path, content: parsers.parse_kraken_species(path, top_n=7, content=content),
+        )
+        kraken_species_by_library_id = {}
+        for library_id, kraken_species in zip(kraken_species_library_ids, kraken_species_reports):
+            species_abundance_by_library_id[library_id] = {'library_id': library_id}
+            if kraken_species is not None:
+                kraken_species_by_library_id[library_id] = kraken_species
+
+        # Resolve the genus for every taxid in the run at once, rather than once per record.
+        run_taxids = set()
+        for kraken_species in kraken_species_by_library_id.values():
+            for kraken_species_record in kraken_species:
+                if kraken_species_record['rank_code'] != 'U':
+                    run_taxids.add(kraken_species_record['ncbi_taxonomy_id'])
+        genera_by_taxid = taxonomy.resolve_genera(config, run_taxids)
+
+        # Records are written out as they are collected.
+        def generate_species_abundance():
+            for library_id in library_ids:
+                if library_id in kraken_species_by_library_id:
+                    species_abundance_by_library_id[library_id] = collect_library_species_abundance(run_id, library_id, kraken_species_by_library_id[library_id], genera_by_taxid)
+                yield species_abundance_by_library_id[library_id]
+
+        writers.write_output(config, species_abundance_dst_file, generate_species_abundance())
+        qc_index.upsert_species_abundance(config, run_id, list(species_abundance_by_library_id.values()))
+        species_abundance_written = True
 
         logging.info(json.dumps({
             "event_type": "write_species_abundance_complete",
@@ -327,58 +958,38 @@ def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str,
         }))
 
     # library-qc
-    library_qc_dst_file = os.path.join(config['output_dir'], "library-qc", run_id + "_library_qc.json")
-    if not os.path.exists(library_qc_dst_file):
-        for library_id in libraries_by_library_id:
-            nanoq_path = os.path.join(latest_routine_nanopore_qc_output_path, library_id, library_id + '_nanoq.csv')
-            if os.path.exists(nanoq_path):
-                nanoq_report = parsers.parse_nanoq(nanoq_path)
-                if len(nanoq_report) == 1:
-                    nanoq = nanoq_report[0]
-                    libraries_by_library_id[library_id]['library_id'] = library_id
-                    libraries_by_library_id[library_id]['num_reads'] = nanoq['reads']
-                    libraries_by_library_id[library_id]['num_bases'] = nanoq['bases']
-                    libraries_by_library_id[library_id]['read_n50'] = nanoq['n50']
-                    libraries_by_library_id[library_id]['longest_read'] = nanoq['longest']
-                    libraries_by_library_id[library_id]['shortest_read'] = nanoq['shortest']
-                    libraries_by_library_id[library_id]['median_read_length'] = nanoq['median_length']
-                    libraries_by_library_id[library_id]['median_quality'] = nanoq['median_quality']
-
-                inferred_species = None
-                inferred_species = infer_species(config, species_abundance_by_library_id[library_id])
-                inferred_genus = None
-                inferred_genus = infer_genus(config, species_abundance_by_library_id[library_id], inferred_species)
-                if inferred_species is not None:
-                    logging.debug(json.dumps({'event_type': 'library_species_inferred', 'sequencing_run_id': run_id, 'library_id': library_id, 'inferred_species': inferred_species}))
-                    libraries_by_library_id[library_id]['inferred_species_name'] = inferred_species
-                    libraries_by_library_id[library_id]['inferred_genus_name'] = inferred_genus
-                    percent_inferred_species = get_percent_reads_by_species_name(species_abundance_by_library_id[library_id], inferred_species)
-                    if percent_inferred_species is None:
-                        logging.error(json.dumps({"event_type": "collect_library_qc_metric_failed", "metric": "inferred_species_percent", 'library_id': library_id, 'inferred_species': inferred_species}))
-                    libraries_by_library_id[library_id]['inferred_species_percent'] = percent_inferred_species
-                    percent_inferred_genus = get_percent_reads_by_genus_name(species_abundance_by_library_id[library_id], inferred_genus)
-                    if percent_inferred_genus is None:
-                        logging.error(json.dumps({"event_type": "collect_library_qc_metric_failed", "metric": "inferred_genus_percent", 'library_id': library_id, 'inferred_genus': inferred_genus}))
-                    libraries_by_library_id[library_id]['inferred_genus_percent'] = percent_inferred_genus
-                    if 'known_species' in config and inferred_species in config['known_species']:
-                        inferred_species_genome_size = config['known_species'][inferred_species]['genome_size_mb']
-                        libraries_by_library_id[library_id]['inferred_species_genome_size_mb'] = inferred_species_genome_size
-                    else:
-                        logging.debug(json.dumps({'event_type': 'library_species_inference_failed', 'sequencing_run_id': run_id, 'library_id': library_id, 'inferred_species': inferred_species}))
-
-                    if all(k in libraries_by_library_id[library_id] for k in ['num_bases', 'inferred_species_genome_size_mb', 'inferred_species_percent']):
-                        num_bases = libraries_by_library_id[library_id]['num_bases']
-                        genome_size = libraries_by_library_id[library_id]['inferred_species_genome_size_mb'] * 1000000
-                        species_percent = libraries_by_library_id[library_id]['inferred_species_percent']
-                        if all([num_bases, genome_size, species_percent]):
-                            libraries_by_library_id[library_id]['inferred_species_estimated_depth'] = round((num_bases * (species_percent / 100)) / genome_size, 3)
-                        if 'inferred_genus_percent' in libraries_by_library_id[library_id]:
-                            genus_percent = libraries_by_library_id[library_id]['inferred_genus_percent']
-                        if all([num_bases, genome_size, genus_percent]):
-                            libraries_by_library_id[library_id]['inferred_genus_estimated_depth'] = round((num_bases * (genus_percent / 100)) / genome_size, 3)
-
-        with open(library_qc_dst_file, 'w') as f:
-            json.dump(list(libraries_by_library_id.values()), f, indent=2)
+    existing_libraries_by_library_id = {}
+    if library_qc_changed and library_qc_exists and not force:
+        existing_libraries_by_library_id = load_output_records(library_qc_dst_file)
+    libraries_by_library_id = {}
+    for library_id in library_ids:
+        libraries_by_library_id[library_id] = existing_libraries_by_library_id.get(library_id, {})
+
+    library_qc_written = False
+    if library_qc_changed:
+        # Inferred species and genus metrics are computed for all of the run's libraries at once.
+        qc_library_ids = [library_id for library_id in library_ids if library_id in library_qc_library_ids]
+        nanoq_reports = prefetch.parse_source_files(
+            config,
+            [source_files_by_library_id[library_id]['nanoq'] for library_id in qc_library_ids],
+            lambda path, content: parsers.parse_nanoq(path, content=content),
+        )
+        nanoq_reports_by_library_id = dict(zip(qc_library_ids, nanoq_reports))
+        columns_by_rank = qc_metrics.load_abundance_columns([species_abundance_by_library_id[library_id] for library_id in qc_library_ids])
+        num_bases = [nanoq_report[0]['bases'] if nanoq_report is not None and len(nanoq_report) == 1 else None for nanoq_report in nanoq_reports_by_library_id.values()]
+        inferred_metrics = qc_metrics.compute_inferred_metrics(config, columns_by_rank, num_bases)
+        inferred_metrics_by_library_id = dict(zip(qc_library_ids, inferred_metrics))
+        project_metrics = qc_metrics.compute_project_metrics(config, columns_by_rank, num_bases, [library_projects.get(library_id, None) for library_id in qc_library_ids])
+        project_metrics_by_library_id = dict(zip(qc_library_ids, project_metrics))
+
+        for library_id in qc_library_ids:
+            libraries_by_library_id[library_id] = collect_library_qc(config, run_id, library_id, nanoq_reports_by_library_id[library_id], species_abundance_by_library_id[library_id], inferred_metrics_by_library_id[library_id], project_metrics_by_library_id[library_id])
+        if species_baselines.is_enabled(config):
+            species_baselines.update_run_library_qc(config, run_id, [libraries_by_library_id[library_id] for library_id in qc_library_ids], removed_library_ids)
+
+        writers.write_output(config, library_qc_dst_file, (libraries_by_library_id[library_id] for library_id in library_ids))
+        qc_index.upsert_library_qc(config, run_id, analysis_dir.get('sequencer_type', None), list(libraries_by_library_id.values()))
+        library_qc_written = True
 
         logging.info(json.dumps({
             "event_type": "write_library_qc_complete",
@@ -386,7 +997,39 @@ def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str,
             "dst_file": library_qc_dst_file
         }))
 
+    updated_manifest = {
+        'manifest_version': fingerprint.MANIFEST_VERSION,
+        'run_id': run_id,
+        'routine_nanopore_qc_output_path': latest_routine_nanopore_qc_output_path,
+        'pipeline_version': fingerprint.get_pipeline_version(latest_routine_nanopore_qc_output_path),
+        'output_dir_mtime_ns': output_dir_mtime_ns,
+        'known_species_hash': known_species_hash,
+        'library_projects_hash': library_projects_hash,
+        'libraries': source_fingerprints,
+    }
+    if updated_manifest != manifest:
+        write_json(fingerprint.get_manifest_path(config, run_id), updated_manifest)
 
+    # Runs collected before the QC index existed are added from their existing output files.
+    run_indexed = qc_index.ensure_run_indexed(config, run_id, analysis_dir.get('sequencer_type', None), library_qc_dst_file, species_abundance_dst_file)
+    if species_abundance_written or library_qc_written or run_indexed:
+        export.export_run(config, run_id)
+    if len(incomplete_library_ids) == 0:
+        _collected_runs[run_id] = {'collection_state': collection_state, 'num_libraries': len(library_ids)}
+    else:
+        _collected_runs.pop(run_id, None)
 
-
+    metrics.increment_counter('runs_collected_total', result='collected')
+    metrics.increment_counter('libraries_collected_total', len(species_abundance_library_ids | library_qc_library_ids))
     logging.info(json.dumps({"event_type": "collect_outputs_complete", "sequencing_run_id": run_id, "analysis_dir_path": analysis_dir['path']}))
+
+    collect_outputs_summary = {
+        'sequencing_run_id': run_id,
+        'num_libraries': len(library_ids),
+        'num_libraries_collected': len(species_abundance_library_ids | library_qc_library_ids),
+        'incomplete_library_ids': incomplete_library_ids,
+        'species_abundance_written': species_abundance_written,
+        'library_qc_written': library_qc_written,
+    }
+
+    return collect_outputs_summary
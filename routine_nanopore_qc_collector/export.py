@@ -0,0 +1,346 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import threading
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError as e:
+    pyarrow = None
+
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.qc_index as qc_index
+import routine_nanopore_qc_collector.writers as writers
+
+
+# Number of species in each species-abundance record (the top 7 kraken2 species report rows, less 'unclassified').
+NUM_ABUNDANCE_SPECIES = 7
+
+# Columns of each exported table, with their types ('str', 'int' or 'float').
+EXPORT_COLUMNS = {
+    'library_qc': [
+        ('run_id', 'str'),
+        ('run_date', 'str'),
+        ('sequencer_type', 'str'),
+        ('library_id', 'str'),
+        ('num_reads', 'int'),
+        ('num_bases', 'int'),
+        ('read_n50', 'int'),
+        ('longest_read', 'int'),
+        ('shortest_read', 'int'),
+        ('median_read_length', 'int'),
+        ('median_quality', 'float'),
+        ('inferred_species_name', 'str'),
+        ('inferred_genus_name', 'str'),
+        ('inferred_species_percent', 'float'),
+        ('inferred_genus_percent', 'float'),
+        ('inferred_species_genome_size_mb', 'float'),
+        ('inferred_species_estimated_depth', 'float'),
+        ('inferred_genus_estimated_depth', 'float'),
+        ('project_id', 'str'),
+        ('project_species_name', 'str'),
+        ('project_species_percent', 'float'),
+        ('project_genome_size_mb', 'float'),
+        ('project_estimated_depth', 'float'),
+    ],
+    'species_abundance': [
+        ('run_id', 'str'),
+        ('run_date', 'str'),
+        ('library_id', 'str'),
+        ('unclassified_fraction_total_reads', 'float'),
+    ] + [
+        column
+        for abundance_num in range(1, NUM_ABUNDANCE_SPECIES + 1)
+        for column in [
+            ('abundance_' + str(abundance_num) + '_name', 'str'),
+            ('abundance_' + str(abundance_num) + '_genus_name', 'str'),
+            ('abundance_' + str(abundance_num) + '_genus_taxid', 'str'),
+            ('abundance_' + str(abundance_num) + '_fraction_total_reads', 'float'),
+        ]
+    ],
+}
+
+_partition_locks = {}
+_partition_locks_lock = threading.Lock()
+
+
+def get_export_dir(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the export dir. Defaults to 'export' in the output dir.
+    :rtype: str
+    """
+    return config.get('export_dir', os.path.join(config['output_dir'], 'export'))
+
+
+def get_export_format(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: 'parquet' if 'export_format' is 'parquet', or is 'auto' (the default) and pyarrow is installed. Otherwise 'csv'.
+    :rtype: str
+    """
+    export_format = config.get('export_format', 'auto')
+    if export_format == 'parquet' and pyarrow is None:
+        logging.warning(json.dumps({"event_type": "parquet_export_unavailable", "reason": "pyarrow is not installed", "export_format": "csv"}))
+        return 'csv'
+    if export_format == 'auto':
+        return 'parquet' if pyarrow is not None else 'csv'
+    if export_format not in ['parquet', 'csv']:
+        logging.error(json.dumps({"event_type": "invalid_export_format", "export_format": export_format}))
+        return 'csv'
+
+    return export_format
+
+
+def get_partition_dir(config, table, month):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param month: Month (eg. '2023-01'), or 'unknown' for runs without a date.
+    :type month: str
+    :return: Path to the table's partition for the month (eg. 'export/library_qc/month=2023-01').
+    :rtype: str
+    """
+    return os.path.join(get_export_dir(config), table, 'month=' + month)
+
+
+def get_part_path(config, table, run_id):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Path to the file holding the run's records, in the partition for its month (eg. 'export/library_qc/month=2023-01/<run_id>.parquet').
+    :rtype: str
+    """
+    return os.path.join(get_partition_dir(config, table, qc_index.get_run_month(run_id)), run_id + '.' + get_export_format(config))
+
+
+@contextlib.contextmanager
+def partition_lock(config, table, month):
+    """
+    Lock a table's partition for a month, against other threads (with a local lock) and other nodes (with the
+    'export-<table>-<month>' lease, which is waited for for up to its TTL). Whichever node writes a run's records
+    last must have read them from the QC index after the others did, so writes to a partition are never run at once.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param month: Month (eg. '2023-01'), or 'unknown' for runs without a date.
+    :type month: str
+    :return: Whether the lease was acquired.
+    :rtype: Iterator[bool]
+    """
+    partition_dir = get_partition_dir(config, table, month)
+    with _partition_locks_lock:
+        local_lock = _partition_locks.setdefault(partition_dir, threading.Lock())
+    with local_lock, leases.lease(config, 'export-' + table + '-' + month, wait_seconds=leases.get_lease_ttl_seconds(config)) as acquired:
+        if not acquired:
+            logging.error(json.dumps({"event_type": "export_partition_failed", "table": table, "month": month, "reason": "Lease held by another node"}))
+        yield acquired
+
+
+def write_partition_csv(dst_path, columns, records):
+    """
+    :param dst_path: Path to write to.
+    :type dst_path: str
+    :param columns: Column names and types.
+    :type columns: list[tuple[str, str]]
+    :param records: Records to write. Missing fields are left empty.
+    :type records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    with writers.atomic_writer(dst_path) as f:
+        writer = csv.writer(f, dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow([column_name for column_name, _ in columns])
+        for record in records:
+            writer.writerow(['' if record.get(column_name, None) is None else record[column_name] for column_name, _ in columns])
+
+
+def write_partition_parquet(dst_path, columns, records):
+    """
+    :param dst_path: Path to write to. The file is replaced atomically.
+    :type dst_path: str
+    :param columns: Column names and types.
+    :type columns: list[tuple[str, str]]
+    :param records: Records to write. Missing fields are null.
+    :type records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    pyarrow_types = {
+        'str': pyarrow.string(),
+        'int': pyarrow.int64(),
+        'float': pyarrow.float64(),
+    }
+    arrays = []
+    for column_name, column_type in columns:
+        values = [record.get(column_name, None) for record in records]
+        if column_type == 'str':
+            values = [str(value) if value is not None else None for value in values]
+        arrays.append(pyarrow.array(values, type=pyarrow_types[column_type]))
+    table = pyarrow.Table.from_arrays(arrays, names=[column_name for column_name, _ in columns])
+
+    with writers.atomic_writer(dst_path, binary=True) as f:
+        pyarrow.parquet.write_table(table, f)
+
+
+def write_part(config, table, run_id, records):
+    """
+    Write a run's records to its part file (see `get_part_path`), or remove the part file if the run has no records.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param records: The run's records.
+    :type records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    part_path = get_part_path(config, table, run_id)
+    if len(records) == 0:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    if get_export_format(config) == 'parquet':
+        write_partition_parquet(part_path, EXPORT_COLUMNS[table], records)
+    else:
+        write_partition_csv(part_path, EXPORT_COLUMNS[table], records)
+
+
+def get_exported_filenames(config, table, month):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param month: Month (eg. '2023-01'), or 'unknown' for runs without a date.
+    :type month: str
+    :return: Names of the files in the table's partition for the month, not including temporary files.
+    :rtype: set[str]
+    """
+    try:
+        return set(filename for filename in os.listdir(get_partition_dir(config, table, month)) if not filename.startswith('.'))
+    except FileNotFoundError as e:
+        return set()
+
+
+def export_month(config, month):
+    """
+    Rewrite the export partitions for a month, from the QC index, with a part file for each run. Files for runs
+    that are no longer in the index, or from another export format, are removed. Partitions for other months are untouched.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param month: Month (eg. '2023-01'), or 'unknown' for runs without a date.
+    :type month: str
+    :return: None
+    :rtype: NoneType
+    """
+    for table in EXPORT_COLUMNS:
+        with partition_lock(config, table, month) as acquired:
+            if not acquired:
+                continue
+            records = qc_index.get_month_records(config, table, month)
+            records_by_run_id = {}
+            for record in records:
+                records_by_run_id.setdefault(record['run_id'], []).append(record)
+            for run_id, run_records in records_by_run_id.items():
+                write_part(config, table, run_id, run_records)
+            part_filenames = set(os.path.basename(get_part_path(config, table, run_id)) for run_id in records_by_run_id)
+            for filename in get_exported_filenames(config, table, month) - part_filenames:
+                os.remove(os.path.join(get_partition_dir(config, table, month), filename))
+
+        logging.info(json.dumps({"event_type": "export_partition_complete", "table": table, "month": month, "num_records": len(records), "num_runs": len(records_by_run_id)}))
+
+
+def export_run(config, run_id):
+    """
+    Update the exported tables after a run has been (re-)collected. Only the run's own part files are re-written.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: None
+    :rtype: NoneType
+    """
+    if not config.get('export_enabled', True):
+        return
+
+    month = qc_index.get_run_month(run_id)
+    for table in EXPORT_COLUMNS:
+        with partition_lock(config, table, month) as acquired:
+            if not acquired:
+                continue
+            write_part(config, table, run_id, qc_index.get_run_records(config, table, run_id))
+
+    logging.debug(json.dumps({"event_type": "export_run_complete", "sequencing_run_id": run_id, "month": month}))
+
+
+def get_export_columns_path(config, table):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :return: Path to the file recording the columns that the table's partitions were exported with.
+    :rtype: str
+    """
+    return os.path.join(get_export_dir(config), table, '_columns.json')
+
+
+def ensure_exported(config):
+    """
+    Export any months in the QC index whose export partitions don't have a part file for each of their runs
+    (eg. runs collected before exports were introduced, or after the export format changed).
+    If a table's columns have changed since it was last exported, all of its months are re-exported.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    if not config.get('export_enabled', True):
+        return
+
+    columns_changed = False
+    for table, columns in EXPORT_COLUMNS.items():
+        try:
+            with open(get_export_columns_path(config, table), 'r') as f:
+                exported_columns = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            exported_columns = None
+        if exported_columns != [column_name for column_name, _ in columns]:
+            columns_changed = True
+
+    # A month is re-exported if the runs that have part files in any of its partitions differ from the runs in the index.
+    part_filenames_by_month = {}
+    for table in EXPORT_COLUMNS:
+        for run_id in qc_index.get_indexed_run_ids(config, table):
+            part_filenames_by_month.setdefault(qc_index.get_run_month(run_id), {table_name: set() for table_name in EXPORT_COLUMNS})[table].add(os.path.basename(get_part_path(config, table, run_id)))
+    for month in sorted(part_filenames_by_month.keys()):
+        if columns_changed or any(get_exported_filenames(config, table, month) != part_filenames_by_month[month][table] for table in EXPORT_COLUMNS):
+            export_month(config, month)
+
+    if columns_changed:
+        for table, columns in EXPORT_COLUMNS.items():
+            os.makedirs(os.path.join(get_export_dir(config), table), exist_ok=True)
+            with writers.atomic_writer(get_export_columns_path(config, table)) as f:
+                json.dump([column_name for column_name, _ in columns], f)
+        logging.info(json.dumps({"event_type": "export_columns_updated"}))
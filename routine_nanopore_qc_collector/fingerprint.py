@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+from typing import Optional
+
+
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(config, run_id):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Path to the run's manifest file.
+    :rtype: str
+    """
+    return os.path.join(config['output_dir'], 'manifests', run_id + '_manifest.json')
+
+
+def load_manifest(config, run_id):
+    """
+    Load the manifest describing the source files that a run's outputs were built from.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Manifest, or None if the run has no (valid) manifest.
+    :rtype: Optional[dict[str, object]]
+    """
+    manifest_path = get_manifest_path(config, run_id)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError as e:
+        return None
+    except json.decoder.JSONDecodeError as e:
+        logging.warning(json.dumps({"event_type": "load_manifest_failed", "sequencing_run_id": run_id, "manifest_file": manifest_path}))
+        return None
+
+    if manifest.get('manifest_version', None) != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def get_pipeline_version(routine_nanopore_qc_output_path):
+    """
+    :param routine_nanopore_qc_output_path: Path to a 'routine-nanopore-qc-v*-output' dir.
+    :type routine_nanopore_qc_output_path: str
+    :return: Pipeline version (eg. 'v0.1.0'), or None if it can't be determined from the dir name.
+    :rtype: Optional[str]
+    """
+    match = re.match('routine-nanopore-qc-(v.+)-output$', os.path.basename(routine_nanopore_qc_output_path))
+    if match is None:
+        return None
+
+    return match.group(1)
+
+
+def get_known_species_hash(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: SHA-256 of the known species list, as loaded into the config.
+    :rtype: str
+    """
+    known_species = config.get('known_species', {})
+    serialized_known_species = json.dumps({k: dict(v) for k, v in known_species.items()}, sort_keys=True)
+
+    return hashlib.sha256(serialized_known_species.encode('utf-8')).hexdigest()
+
+
+def get_library_projects_hash(library_projects):
+    """
+    :param library_projects: Project for each library in a run, as returned by `samplesheet.get_library_projects`.
+    :type library_projects: dict[str, dict[str, object]]
+    :return: SHA-256 of the libraries' projects, or None if no library has a project.
+    :rtype: Optional[str]
+    """
+    if len(library_projects) == 0:
+        return None
+    serialized_library_projects = json.dumps({library_id: dict(library_project) for library_id, library_project in library_projects.items()}, sort_keys=True)
+
+    return hashlib.sha256(serialized_library_projects.encode('utf-8')).hexdigest()
+
+
+def get_file_fingerprint(path, previous_fingerprint=None, content=None, stat=None, hash_content=True):
+    """
+    Describe a source file by its size, modification time and SHA-256. If the size and
+    modification time match a previous fingerprint, its hash is re-used rather than re-reading the file.
+
+    :param path: Path to the file.
+    :type path: str
+    :param previous_fingerprint: Fingerprint from the last time the file was collected.
+    :type previous_fingerprint: Optional[dict[str, object]]
+    :param content: Contents of the file, if already read.
+    :type content: Optional[bytes]
+    :param stat: Result of `os.stat` on the file, if already known (eg. from `os.scandir`).
+    :type stat: Optional[os.stat_result]
+    :param hash_content: Hash the file if its size or modification time has changed. If False, the hash is left out.
+    :type hash_content: bool
+    :return: Fingerprint (Keys: ['size', 'mtime_ns', 'sha256']), or None if the file doesn't exist. 'sha256' may be None.
+    :rtype: Optional[dict[str, object]]
+    """
+    if stat is None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError as e:
+            return None
+
+    fingerprint = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': None,
+    }
+    if previous_fingerprint is not None and previous_fingerprint['size'] == fingerprint['size'] and previous_fingerprint['mtime_ns'] == fingerprint['mtime_ns']:
+        fingerprint['sha256'] = previous_fingerprint['sha256']
+    elif not hash_content:
+        pass
+    elif content is not None:
+        fingerprint['sha256'] = hashlib.sha256(content).hexdigest()
+    else:
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+        fingerprint['sha256'] = file_hash.hexdigest()
+
+    return fingerprint
+
+
+def same_content(fingerprint, previous_fingerprint):
+    """
+    Compare two fingerprints of a file by their SHA-256, or by size and modification time if either wasn't hashed.
+
+    :param fingerprint: Current fingerprint of a file.
+    :type fingerprint: Optional[dict[str, object]]
+    :param previous_fingerprint: Fingerprint from the last time the file was collected.
+    :type previous_fingerprint: Optional[dict[str, object]]
+    :return: Whether the file's content is unchanged (including both being absent).
+    :rtype: bool
+    """
+    if fingerprint is None or previous_fingerprint is None:
+        return fingerprint is None and previous_fingerprint is None
+    if fingerprint['sha256'] is None or previous_fingerprint['sha256'] is None:
+        return fingerprint['size'] == previous_fingerprint['size'] and fingerprint['mtime_ns'] == previous_fingerprint['mtime_ns']
+
+    return fingerprint['sha256'] == previous_fingerprint['sha256']
+
+
+def get_incomplete_library_ids(source_fingerprints):
+    """
+    :param source_fingerprints: Source file fingerprints by library ID, as recorded in a manifest.
+    :type source_fingerprints: dict[str, dict[str, Optional[dict[str, object]]]]
+    :return: IDs of libraries that are missing any of their source files.
+    :rtype: list[str]
+    """
+    return sorted(library_id for library_id, library_fingerprints in source_fingerprints.items() if any(f is None for f in library_fingerprints.values()))
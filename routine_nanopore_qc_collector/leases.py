@@ -0,0 +1,379 @@
+"""
+Coordination between collectors on several nodes that share an analysis_by_run dir and output dir,
+using only the shared filesystem.
+
+Work is claimed with lease files in the lease dir (eg. 'run-<run_id>.lease'). A lease is created with
+O_CREAT | O_EXCL, so only one node can hold it. While a node holds leases, a background thread renews
+them by updating their modification time. A lease that hasn't been renewed for 'lease_ttl_seconds' is
+considered abandoned (eg. its node crashed), and may be taken over: it is first renamed to a name unique
+to the node taking it over, so that only one node can succeed, and then re-created.
+
+Whether a lease has been renewed is decided without comparing clocks: the modification time set by the
+file server is only compared with the modification time seen previously, and a lease is abandoned once
+this node has seen it unchanged for 'lease_ttl_seconds', measured on this node's monotonic clock. Clock
+skew between nodes (or between a node and the file server) therefore can't cause a live lease to be
+taken over. The cost is that an abandoned lease is only taken over 'lease_ttl_seconds' after this node
+first tries to acquire it.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import routine_nanopore_qc_collector.metrics as metrics
+
+
+DEFAULT_LEASE_TTL_SECONDS = 300.0
+
+_held_leases = {}
+_held_leases_lock = threading.Lock()
+_heartbeat_thread = None
+# The token and modification time last seen for each lease held by another node, and when (monotonic) they were first seen.
+_observed_leases = {}
+_observed_leases_lock = threading.Lock()
+# Serializes threads in this process waiting for the same lease (see `lease`), so that they don't poll the lease file.
+_local_locks = {}
+
+
+def is_enabled(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Whether work is coordinated with other nodes using leases ('leases_enabled' in the config, default false).
+    :rtype: bool
+    """
+    return bool(config.get('leases_enabled', False))
+
+
+def get_node_id(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: ID of this node. Defaults to the host name and process ID.
+    :rtype: str
+    """
+    return config.get('node_id', socket.gethostname() + ':' + str(os.getpid()))
+
+
+def get_lease_dir(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the lease dir. Defaults to 'leases' in the output dir.
+    :rtype: str
+    """
+    return config.get('lease_dir', os.path.join(config['output_dir'], 'leases'))
+
+
+def get_lease_ttl_seconds(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Time after which a lease that hasn't been renewed may be taken over by another node.
+    :rtype: float
+    """
+    return float(config.get('lease_ttl_seconds', DEFAULT_LEASE_TTL_SECONDS))
+
+
+def get_lease_path(config, name):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param name: Lease name (eg. 'run-<run_id>').
+    :type name: str
+    :return: Path to the lease file.
+    :rtype: str
+    """
+    return os.path.join(get_lease_dir(config), name + '.lease')
+
+
+def read_lease(lease_path):
+    """
+    :param lease_path: Path to a lease file.
+    :type lease_path: str
+    :return: Lease (Keys: ['name', 'node_id', 'token', 'acquired']) and the modification time of the lease file (in ns, as set by the file server), or None if there is no lease file. The lease is None if the file is empty or unreadable (eg. it is still being written).
+    :rtype: Optional[tuple[Optional[dict[str, object]], int]]
+    """
+    try:
+        with open(lease_path, 'r') as f:
+            renewed_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            content = f.read()
+    except FileNotFoundError as e:
+        return None
+    try:
+        lease = json.loads(content)
+    except json.decoder.JSONDecodeError as e:
+        lease = None
+
+    return lease, renewed_mtime_ns
+
+
+def is_lease_expired(config, lease_path, lease, renewed_mtime_ns):
+    """
+    Check whether a lease held by another node has been abandoned: whether this node has seen the same lease, with
+    the same modification time, for at least 'lease_ttl_seconds'. See the module docstring.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param lease_path: Path to the lease file.
+    :type lease_path: str
+    :param lease: The lease, as read by `read_lease`.
+    :type lease: Optional[dict[str, object]]
+    :param renewed_mtime_ns: Modification time of the lease file, as read by `read_lease`.
+    :type renewed_mtime_ns: int
+    :return: Whether the lease may be taken over.
+    :rtype: bool
+    """
+    observation = (lease.get('token', None) if lease is not None else None, renewed_mtime_ns)
+    now = time.monotonic()
+    with _observed_leases_lock:
+        observed_lease = _observed_leases.get(lease_path, None)
+        if observed_lease is None or observed_lease[0] != observation:
+            _observed_leases[lease_path] = (observation, now)
+            return False
+
+    return now - observed_lease[1] >= get_lease_ttl_seconds(config)
+
+
+def take_over_expired_lease(config, lease_path, expired_lease):
+    """
+    Remove an expired lease so that it can be re-created. If another node takes over the lease at the same time,
+    only one of them succeeds.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param lease_path: Path to the lease file.
+    :type lease_path: str
+    :param expired_lease: The expired lease, as read by `read_lease`.
+    :type expired_lease: Optional[dict[str, object]]
+    :return: Whether the lease file was removed (or was already gone).
+    :rtype: bool
+    """
+    expired_token = expired_lease.get('token', None) if expired_lease is not None else None
+    stale_lease_path = lease_path + '.' + uuid.uuid4().hex + '.stale'
+    try:
+        os.rename(lease_path, stale_lease_path)
+    except FileNotFoundError as e:
+        return True
+
+    moved_lease = read_lease(stale_lease_path)
+    moved_token = None
+    if moved_lease is not None and moved_lease[0] is not None:
+        moved_token = moved_lease[0].get('token', None)
+    if moved_token != expired_token:
+        # Another node replaced the expired lease with a new one before it was moved. Put the new one back.
+        try:
+            os.link(stale_lease_path, lease_path)
+        except FileExistsError as e:
+            pass
+        os.remove(stale_lease_path)
+        return False
+
+    os.remove(stale_lease_path)
+    metrics.increment_counter('leases_taken_over_total')
+    logging.warning(json.dumps({"event_type": "expired_lease_taken_over", "lease_file": lease_path, "previous_node_id": expired_lease.get('node_id', None) if expired_lease is not None else None, "node_id": get_node_id(config)}))
+
+    return True
+
+
+def acquire_lease(config, name):
+    """
+    Try to acquire a lease, without waiting.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param name: Lease name (eg. 'run-<run_id>').
+    :type name: str
+    :return: The lease (Keys: ['name', 'node_id', 'token', 'acquired']), or None if it is held by another node.
+    :rtype: Optional[dict[str, object]]
+    """
+    lease_path = get_lease_path(config, name)
+    os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+    lease = {
+        'name': name,
+        'node_id': get_node_id(config),
+        'token': uuid.uuid4().hex,
+        'acquired': time.time(),
+    }
+    for _ in range(3):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError as e:
+            existing_lease = read_lease(lease_path)
+            if existing_lease is None:
+                continue
+            existing_lease, renewed_mtime_ns = existing_lease
+            if not is_lease_expired(config, lease_path, existing_lease, renewed_mtime_ns):
+                return None
+            if not take_over_expired_lease(config, lease_path, existing_lease):
+                return None
+            continue
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+        with _observed_leases_lock:
+            _observed_leases.pop(lease_path, None)
+        with _held_leases_lock:
+            _held_leases[lease_path] = lease
+        start_heartbeat(config)
+        metrics.increment_counter('leases_acquired_total')
+        logging.debug(json.dumps({"event_type": "lease_acquired", "lease_file": lease_path, "node_id": lease['node_id']}))
+        return lease
+
+    return None
+
+
+def is_lease_held(config, lease):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param lease: Lease, as returned by `acquire_lease`.
+    :type lease: dict[str, object]
+    :return: Whether the lease is still held by this node (ie. it hasn't expired and been taken over).
+    :rtype: bool
+    """
+    current_lease = read_lease(get_lease_path(config, lease['name']))
+
+    return current_lease is not None and current_lease[0] is not None and current_lease[0].get('token', None) == lease['token']
+
+
+def forget_lease(lease_path, lease):
+    """
+    Stop renewing a lease. A newer lease on the same file (eg. re-acquired after this one was taken over) is kept.
+
+    :param lease_path: Path to the lease file.
+    :type lease_path: str
+    :param lease: Lease, as returned by `acquire_lease`.
+    :type lease: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    with _held_leases_lock:
+        if _held_leases.get(lease_path, {}).get('token', None) == lease['token']:
+            _held_leases.pop(lease_path)
+
+
+def release_lease(config, lease):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param lease: Lease, as returned by `acquire_lease`.
+    :type lease: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    lease_path = get_lease_path(config, lease['name'])
+    forget_lease(lease_path, lease)
+    if is_lease_held(config, lease):
+        try:
+            os.remove(lease_path)
+        except FileNotFoundError as e:
+            pass
+    else:
+        metrics.increment_counter('leases_lost_total')
+        logging.warning(json.dumps({"event_type": "lease_lost", "lease_file": lease_path, "node_id": lease['node_id']}))
+    logging.debug(json.dumps({"event_type": "lease_released", "lease_file": lease_path}))
+
+
+def renew_leases(config):
+    """
+    Renew all leases held by this node, by updating the modification time of their lease files.
+    Leases that have been taken over by another node are forgotten.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    with _held_leases_lock:
+        held_leases = list(_held_leases.items())
+    for lease_path, lease in held_leases:
+        if is_lease_held(config, lease):
+            try:
+                os.utime(lease_path)
+                continue
+            except FileNotFoundError as e:
+                pass
+        forget_lease(lease_path, lease)
+        metrics.increment_counter('leases_lost_total')
+        logging.warning(json.dumps({"event_type": "lease_lost", "lease_file": lease_path, "node_id": lease['node_id']}))
+
+
+def start_heartbeat(config):
+    """
+    Start the background thread that renews this node's leases, every third of 'lease_ttl_seconds', if it isn't already running.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    global _heartbeat_thread
+    with _held_leases_lock:
+        if _heartbeat_thread is not None:
+            return
+        heartbeat_interval_seconds = get_lease_ttl_seconds(config) / 3
+
+        def heartbeat():
+            while True:
+                time.sleep(heartbeat_interval_seconds)
+                try:
+                    renew_leases(config)
+                except OSError as e:
+                    logging.error(json.dumps({"event_type": "renew_leases_failed", "error": repr(e)}))
+
+        _heartbeat_thread = threading.Thread(target=heartbeat, name='lease-heartbeat', daemon=True)
+        _heartbeat_thread.start()
+
+
+@contextlib.contextmanager
+def lease(config, name, wait_seconds=0.0):
+    """
+    Hold a lease for the duration of the block. If leases are disabled, the block always runs, as if the lease was acquired.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param name: Lease name (eg. 'run-<run_id>').
+    :type name: str
+    :param wait_seconds: How long to keep trying to acquire the lease, if it is held by another node. If None, wait until it is acquired.
+    :type wait_seconds: Optional[float]
+    :return: Whether the lease was acquired. If not, the block should skip the work.
+    :rtype: Iterator[bool]
+    """
+    if not is_enabled(config):
+        yield True
+        return
+
+    deadline = None if wait_seconds is None else time.monotonic() + wait_seconds
+    local_lock = None
+    if deadline is None or wait_seconds > 0:
+        with _held_leases_lock:
+            local_lock = _local_locks.setdefault(name, threading.Lock())
+        if not local_lock.acquire(timeout=-1 if deadline is None else wait_seconds):
+            metrics.increment_counter('lease_conflicts_total')
+            yield False
+            return
+
+    try:
+        acquired_lease = acquire_lease(config, name)
+        while acquired_lease is None and (deadline is None or time.monotonic() < deadline):
+            time.sleep(1.0 if deadline is None else min(1.0, max(deadline - time.monotonic(), 0.0)))
+            acquired_lease = acquire_lease(config, name)
+        if acquired_lease is None:
+            metrics.increment_counter('lease_conflicts_total')
+            logging.debug(json.dumps({"event_type": "lease_held_elsewhere", "lease_file": get_lease_path(config, name)}))
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            release_lease(config, acquired_lease)
+    finally:
+        if local_lock is not None:
+            local_lock.release()
@@ -0,0 +1,281 @@
+import contextlib
+import functools
+import http.server
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+
+METRIC_PREFIX = 'routine_nanopore_qc_collector_'
+
+# Upper bounds (in seconds) of the histogram buckets.
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0]
+
+# Metric types and help text, by metric name (without prefix).
+METRICS = {
+    'stage_duration_seconds': ('histogram', 'Time spent in each stage of scanning and collection.'),
+    'runs_collected_total': ('counter', 'Runs passed to collect_outputs, by result.'),
+    'libraries_collected_total': ('counter', 'Libraries whose outputs were (re-)computed.'),
+    'errors_total': ('counter', 'Errors, by stage.'),
+    'runs_discovered': ('gauge', 'Runs found in the last scan, by status.'),
+    'analysis_root_scan_duration_seconds': ('gauge', 'Duration of the last scan of each analysis root.'),
+    'analysis_root_runs': ('gauge', 'Runs found in the last scan of each analysis root.'),
+    'analysis_root_timeouts_total': ('counter', 'Scans of each analysis root that exceeded analysis_root_timeout_seconds.'),
+    'scan_duration_seconds': ('gauge', 'Duration of the last full scan.'),
+    'last_scan_complete_timestamp_seconds': ('gauge', 'Unix time at which the last full scan completed.'),
+    'queue_depth': ('gauge', 'Runs waiting in the collection queue.'),
+    'queue_wait_seconds': ('histogram', 'Time runs spent in the collection queue before collection started, by sequencer type.'),
+    'runs_pending_retry': ('gauge', 'Runs with incomplete outputs, waiting to be retried.'),
+    'run_retries_total': ('counter', 'Runs scheduled for retry, by reason.'),
+    'leases_acquired_total': ('counter', 'Leases acquired by this node.'),
+    'leases_taken_over_total': ('counter', 'Expired leases of other nodes taken over by this node.'),
+    'leases_lost_total': ('counter', 'Leases held by this node that were taken over by another node before being released.'),
+    'lease_conflicts_total': ('counter', 'Leases that could not be acquired because another node held them.'),
+    'species_baseline_outliers_total': ('counter', 'Library QC metrics flagged as unusual for the inferred species, by metric.'),
+    'api_requests_total': ('counter', 'Requests to the read API, by endpoint and status.'),
+    'api_request_duration_seconds': ('histogram', 'Time taken to answer requests to the read API, by endpoint.'),
+    'process_cpu_seconds_total': ('counter', 'User and system CPU time used by the process.'),
+    'process_max_resident_memory_bytes': ('gauge', 'Peak resident memory of the process.'),
+}
+
+_metrics_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_http_servers = {}
+
+
+def _get_key(name, labels):
+    """
+    :param name: Metric name (without prefix).
+    :type name: str
+    :param labels: Metric labels.
+    :type labels: dict[str, str]
+    :return: Key identifying the metric and its labels.
+    :rtype: tuple[str, tuple[tuple[str, str], ...]]
+    """
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def increment_counter(name, value=1, **labels):
+    """
+    :param name: Metric name (without prefix).
+    :type name: str
+    :param value: Amount to increment by.
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    key = _get_key(name, labels)
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    :param name: Metric name (without prefix).
+    :type name: str
+    :param value: Current value.
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    key = _get_key(name, labels)
+    with _metrics_lock:
+        _gauges[key] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record one observation in a histogram.
+
+    :param name: Metric name (without prefix).
+    :type name: str
+    :param value: Observed value, in seconds.
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    key = _get_key(name, labels)
+    with _metrics_lock:
+        histogram = _histograms.get(key, None)
+        if histogram is None:
+            histogram = {'bucket_counts': [0] * len(DURATION_BUCKETS), 'count': 0, 'sum': 0.0}
+            _histograms[key] = histogram
+        for bucket_num, upper_bound in enumerate(DURATION_BUCKETS):
+            if value <= upper_bound:
+                histogram['bucket_counts'][bucket_num] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def observe_duration(stage, duration_seconds):
+    """
+    Record the duration of one pass through a stage.
+
+    :param stage: Stage name (eg. 'discover_runs').
+    :type stage: str
+    :param duration_seconds: Duration of the stage.
+    :type duration_seconds: float
+    :return: None
+    :rtype: NoneType
+    """
+    observe('stage_duration_seconds', duration_seconds, stage=stage)
+
+
+@contextlib.contextmanager
+def time_stage(stage):
+    """
+    Time the enclosed block as one pass through a stage. If the block raises, the error
+    is counted in 'errors_total' for the stage, and re-raised.
+
+    :param stage: Stage name (eg. 'discover_runs').
+    :type stage: str
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        increment_counter('errors_total', stage=stage)
+        raise
+    finally:
+        observe_duration(stage, time.perf_counter() - start_time)
+
+
+def timed(stage):
+    """
+    Decorator that times each call to the decorated function as one pass through a stage (see `time_stage`).
+
+    :param stage: Stage name (eg. 'discover_runs').
+    :type stage: str
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def format_metrics():
+    """
+    :return: All metrics, in the Prometheus text exposition format.
+    :rtype: str
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    set_gauge('process_max_resident_memory_bytes', usage.ru_maxrss * 1024)
+    with _metrics_lock:
+        counters = dict(_counters)
+        counters[_get_key('process_cpu_seconds_total', {})] = usage.ru_utime + usage.ru_stime
+        gauges = dict(_gauges)
+        histograms = {key: dict(histogram, bucket_counts=list(histogram['bucket_counts'])) for key, histogram in _histograms.items()}
+
+    def format_labels(labels, extra_labels=()):
+        all_labels = list(labels) + list(extra_labels)
+        if len(all_labels) == 0:
+            return ''
+        return '{' + ','.join(k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in all_labels) + '}'
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        metric_name = METRIC_PREFIX + name
+        if metric_type == 'histogram':
+            samples = sorted((key, value) for key, value in histograms.items() if key[0] == name)
+        elif metric_type == 'counter':
+            samples = sorted((key, value) for key, value in counters.items() if key[0] == name)
+        else:
+            samples = sorted((key, value) for key, value in gauges.items() if key[0] == name)
+        if len(samples) == 0:
+            continue
+        lines.append('# HELP ' + metric_name + ' ' + help_text)
+        lines.append('# TYPE ' + metric_name + ' ' + metric_type)
+        for (_, labels), value in samples:
+            if metric_type == 'histogram':
+                for upper_bound, bucket_count in zip(DURATION_BUCKETS, value['bucket_counts']):
+                    lines.append(metric_name + '_bucket' + format_labels(labels, [('le', repr(upper_bound))]) + ' ' + str(bucket_count))
+                lines.append(metric_name + '_bucket' + format_labels(labels, [('le', '+Inf')]) + ' ' + str(value['count']))
+                lines.append(metric_name + '_sum' + format_labels(labels) + ' ' + repr(value['sum']))
+                lines.append(metric_name + '_count' + format_labels(labels) + ' ' + str(value['count']))
+            else:
+                lines.append(metric_name + format_labels(labels) + ' ' + repr(value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(config):
+    """
+    Write all metrics to 'metrics_textfile' (if set in the config), for the node-exporter textfile collector.
+    The file is replaced atomically, so the collector never reads a partial file.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    metrics_textfile = config.get('metrics_textfile', None)
+    if metrics_textfile is None:
+        return
+
+    dst_dir, dst_filename = os.path.split(os.path.abspath(metrics_textfile))
+    tmp_path = os.path.join(dst_dir, '.' + dst_filename + '.' + str(os.getpid()) + '.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(format_metrics())
+        os.replace(tmp_path, metrics_textfile)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "write_metrics_textfile_failed", "metrics_textfile": metrics_textfile, "error": repr(e)}))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve all metrics at '/metrics'.
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = format_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(json.dumps({"event_type": "metrics_request", "client_address": self.client_address[0], "request": self.requestline}))
+
+
+def start_http_server(config):
+    """
+    Start serving metrics over HTTP on 'metrics_port' (if set in the config), in a background thread.
+    The server listens on 'metrics_address' (default: '127.0.0.1'). Calling this again with the same
+    address and port has no effect.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    metrics_port = config.get('metrics_port', None)
+    if metrics_port is None:
+        return
+    server_address = (config.get('metrics_address', '127.0.0.1'), int(metrics_port))
+    if server_address in _http_servers:
+        return
+
+    try:
+        server = http.server.ThreadingHTTPServer(server_address, MetricsRequestHandler)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "start_metrics_server_failed", "address": server_address[0], "port": server_address[1], "error": repr(e)}))
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    _http_servers[server_address] = server
+    logging.info(json.dumps({"event_type": "metrics_server_started", "address": server_address[0], "port": server_address[1]}))
@@ -1,74 +1,192 @@
 import collections
 import re
 import csv
+import io
+import itertools
 
+import routine_nanopore_qc_collector.metrics as metrics
 
-def parse_nanoq(nanoq_path):
+
+# Number of rows read before their columns are converted. Rows are converted one column at a time,
+# so that each column's conversion runs as a single `map` rather than a loop over individual fields.
+PARSE_CHUNK_SIZE = 256
+
+NanoqRecord = collections.namedtuple('NanoqRecord', [
+    'reads',
+    'bases',
+    'n50',
+    'longest',
+    'shortest',
+    'mean_length',
+    'median_length',
+    'mean_quality',
+    'median_quality',
+])
+
+KrakenSpeciesRecord = collections.namedtuple('KrakenSpeciesRecord', [
+    'percent_seqs_in_clade',
+    'num_seqs_in_clade',
+    'num_seqs_this_taxon',
+    'rank_code',
+    'ncbi_taxonomy_id',
+    'taxon_name',
+])
+
+
+def parse_int(value):
+    """
+    :param value: Value to convert.
+    :type value: Optional[str]
+    :return: Value as an int, or None if it can't be converted.
+    :rtype: Optional[int]
+    """
+    try:
+        return int(value)
+    except (ValueError, TypeError) as e:
+        return None
+
+
+def parse_float(value):
+    """
+    :param value: Value to convert.
+    :type value: Optional[str]
+    :return: Value as a float, or None if it can't be converted.
+    :rtype: Optional[float]
+    """
+    try:
+        return float(value)
+    except (ValueError, TypeError) as e:
+        return None
+
+
+NANOQ_CONVERTERS = {
+    'reads': parse_int,
+    'bases': parse_int,
+    'n50': parse_int,
+    'longest': parse_int,
+    'shortest': parse_int,
+    'mean_length': parse_int,
+    'median_length': parse_int,
+    'mean_quality': parse_float,
+    'median_quality': parse_float,
+}
+
+KRAKEN_SPECIES_CONVERTERS = {
+    'percent_seqs_in_clade': parse_float,
+    'num_seqs_in_clade': parse_int,
+    'num_seqs_this_taxon': parse_int,
+}
+
+
+def iter_records(path, record_type, converters, top_n=None, content=None):
+    """
+    Parse a csv file with a header, yielding one record per row. Only the first `top_n` rows are
+    read, so the rest of the file is never parsed. Columns missing from the file are set to None.
+
+    :param path: Path to the csv file.
+    :type path: str
+    :param record_type: Record type. Its fields are matched to columns by header name.
+    :type record_type: type
+    :param converters: Conversion function for each field that isn't kept as a string, by field name.
+    :type converters: dict[str, Callable[[Optional[str]], object]]
+    :param top_n: Maximum number of records to yield. If None, all rows are parsed.
+    :type top_n: Optional[int]
+    :param content: Contents of the file, if already read. The file isn't opened.
+    :type content: Optional[bytes]
+    :return: Records, in file order.
+    :rtype: Iterator[tuple]
+    """
+    if content is not None:
+        f = io.TextIOWrapper(io.BytesIO(content), newline='')
+    else:
+        f = open(path, 'r', newline='')
+    with f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        column_nums_by_name = {name: column_num for column_num, name in enumerate(header)}
+        column_nums = [column_nums_by_name.get(field, None) for field in record_type._fields]
+        field_converters = [converters.get(field, None) for field in record_type._fields]
+        num_columns = len(header)
+
+        rows = (row for row in reader if len(row) > 0)
+        rows = itertools.islice(rows, top_n)
+        while True:
+            chunk = list(itertools.islice(rows, PARSE_CHUNK_SIZE))
+            if len(chunk) == 0:
+                break
+            for row_num, row in enumerate(chunk):
+                if len(row) < num_columns:
+                    chunk[row_num] = row + [None] * (num_columns - len(row))
+            columns = list(zip(*chunk))
+            fields = []
+            for column_num, converter in zip(column_nums, field_converters):
+                if column_num is None:
+                    fields.append([None] * len(chunk))
+                elif converter is None:
+                    fields.append(columns[column_num])
+                else:
+                    fields.append(list(map(converter, columns[column_num])))
+            yield from map(record_type._make, zip(*fields))
+
+
+def iter_nanoq(nanoq_path, top_n=None, content=None):
     """
+    Parse a nanoq report, one record at a time.
+
+    :param nanoq_path: Path to the '_nanoq.csv' file.
+    :type nanoq_path: str
+    :param top_n: Maximum number of records to yield. If None, all rows are parsed.
+    :type top_n: Optional[int]
+    :param content: Contents of the file, if already read.
+    :type content: Optional[bytes]
+    :return: Nanoq records. Numeric fields that can't be converted are None.
+    :rtype: Iterator[NanoqRecord]
+    """
+    return iter_records(nanoq_path, NanoqRecord, NANOQ_CONVERTERS, top_n, content)
+
+
+def iter_kraken_species(kraken_species_path, top_n=None, content=None):
     """
-    nanoq = []
- 
-    int_fields = [
-        'reads',
-        'bases',
-        'n50',
-        'longest',
-        'shortest',
-        'mean_length',
-        'median_length',
-    ]
-
-    float_fields = [
-        'mean_quality',
-        'median_quality',
-    ]
-
-    with open(nanoq_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            for field in int_fields:
-                try:
-                    row[field] = int(row[field])
-                except ValueError as e:
-                    row[field] = None
-            for field in float_fields:
-                try:
-                    row[field] = float(row[field])
-                except ValueError as e:
-                    row[field] = None
-
-            nanoq.append(row)
-
-    return nanoq
-
-
-def parse_kraken_species(kraken_species_path):
+    Parse a kraken2 species report, one record at a time. Reports are sorted by abundance,
+    so `top_n` selects the most abundant taxa without parsing the rest of the report.
+
+    :param kraken_species_path: Path to the '_kraken2_species.csv' file.
+    :type kraken_species_path: str
+    :param top_n: Maximum number of records to yield. If None, all rows are parsed.
+    :type top_n: Optional[int]
+    :param content: Contents of the file, if already read.
+    :type content: Optional[bytes]
+    :return: Kraken species records. Numeric fields that can't be converted are None.
+    :rtype: Iterator[KrakenSpeciesRecord]
+    """
+    return iter_records(kraken_species_path, KrakenSpeciesRecord, KRAKEN_SPECIES_CONVERTERS, top_n, content)
+
+
+@metrics.timed('parse_nanoq')
+def parse_nanoq(nanoq_path, content=None):
+    """
+    :param nanoq_path: Path to the '_nanoq.csv' file.
+    :type nanoq_path: str
+    :param content: Contents of the file, if already read.
+    :type content: Optional[bytes]
+    :return: All records in the nanoq report.
+    :rtype: list[dict[str, object]]
+    """
+    return [record._asdict() for record in iter_nanoq(nanoq_path, content=content)]
+
+
+@metrics.timed('parse_kraken_species')
+def parse_kraken_species(kraken_species_path, top_n=None, content=None):
     """
+    :param kraken_species_path: Path to the '_kraken2_species.csv' file.
+    :type kraken_species_path: str
+    :param top_n: Maximum number of records to return. If None, all rows are parsed.
+    :type top_n: Optional[int]
+    :param content: Contents of the file, if already read.
+    :type content: Optional[bytes]
+    :return: Records in the kraken2 species report.
+    :rtype: list[dict[str, object]]
     """
-    kraken_species = []
-    int_fields = [
-        'num_seqs_in_clade',
-        'num_seqs_this_taxon',
-    ]
-
-    float_fields = [
-        'percent_seqs_in_clade',
-    ]
-
-    with open(kraken_species_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            for field in int_fields:
-                try:
-                    row[field] = int(row[field])
-                except ValueError as e:
-                    row[field] = None
-            for field in float_fields:
-                try:
-                    row[field] = float(row[field])
-                except ValueError as e:
-                    row[field] = None
-
-            kraken_species.append(row)        
-
-    return kraken_species
+    return [record._asdict() for record in iter_kraken_species(kraken_species_path, top_n, content)]
@@ -0,0 +1,173 @@
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+import routine_nanopore_qc_collector.fingerprint as fingerprint
+import routine_nanopore_qc_collector.metrics as metrics
+
+
+DEFAULT_PREFETCH_CONCURRENCY = 16
+
+# Source files read from each library's output dir, by source type. The file name is the library ID followed by the suffix.
+SOURCE_FILE_SUFFIXES = {
+    'kraken2_species': '_kraken2_species.csv',
+    'nanoq': '_nanoq.csv',
+}
+
+
+def get_prefetch_concurrency(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Maximum number of library dirs to read from at once, for each run ('prefetch_concurrency' in the config).
+    :rtype: int
+    """
+    return max(int(config.get('prefetch_concurrency', DEFAULT_PREFETCH_CONCURRENCY)), 1)
+
+
+def read_file(path):
+    """
+    :param path: Path to the file.
+    :type path: str
+    :return: Contents of the file and its `os.stat_result`, taken from the open file, or None if the file doesn't exist.
+    :rtype: Optional[tuple[bytes, os.stat_result]]
+    """
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            content = f.read()
+    except FileNotFoundError as e:
+        return None
+
+    return content, stat
+
+
+def fetch_library_source_files(library_dir_path, library_id, previous_library_fingerprints, hash_content=False):
+    """
+    Fingerprint a library's source files, with a single `os.scandir` of the library dir. Files are described by their size
+    and modification time. With `hash_content`, files whose size or modification time differ from their previous
+    fingerprint are also read, to compute their hash, and their contents kept.
+
+    :param library_dir_path: Path to the library's output dir.
+    :type library_dir_path: str
+    :param library_id: Library ID.
+    :type library_id: str
+    :param previous_library_fingerprints: Fingerprints of the library's source files from the last time it was collected, by source type.
+    :type previous_library_fingerprints: dict[str, Optional[dict[str, object]]]
+    :param hash_content: Hash the files that have changed.
+    :type hash_content: bool
+    :return: Source files, by source type. Keys: ['path', 'fingerprint', 'content']. 'fingerprint' is None if the file
+             doesn't exist. 'content' is None if the file wasn't read.
+    :rtype: dict[str, dict[str, object]]
+    """
+    entries_by_name = {}
+    try:
+        with os.scandir(library_dir_path) as library_dir_contents:
+            for entry in library_dir_contents:
+                entries_by_name[entry.name] = entry
+    except FileNotFoundError as e:
+        pass
+
+    source_files = {}
+    for source_type, suffix in SOURCE_FILE_SUFFIXES.items():
+        source_file = {
+            'path': os.path.join(library_dir_path, library_id + suffix),
+            'fingerprint': None,
+            'content': None,
+        }
+        source_files[source_type] = source_file
+        entry = entries_by_name.get(library_id + suffix, None)
+        if entry is None:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError as e:
+            continue
+
+        previous_fingerprint = previous_library_fingerprints.get(source_type, None)
+        if hash_content and (previous_fingerprint is None or previous_fingerprint['size'] != stat.st_size or previous_fingerprint['mtime_ns'] != stat.st_mtime_ns):
+            file = read_file(source_file['path'])
+            if file is None:
+                continue
+            source_file['content'], stat = file
+        source_file['fingerprint'] = fingerprint.get_file_fingerprint(source_file['path'], previous_fingerprint, content=source_file['content'], stat=stat, hash_content=hash_content)
+
+    return source_files
+
+
+@metrics.timed('prefetch_source_files')
+def prefetch_source_files(config, output_path, library_ids, previous_source_fingerprints):
+    """
+    Fingerprint the source files of all of a run's libraries (see `fetch_library_source_files`), reading from up to
+    'prefetch_concurrency' library dirs at once, so that the latency of a network filesystem is paid once per batch
+    rather than once per file. Changed files are only hashed with 'verify_source_fingerprints' enabled.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param output_path: Path to the run's routine-nanopore-qc output dir.
+    :type output_path: str
+    :param library_ids: Library IDs (the names of the library dirs in the output dir).
+    :type library_ids: list[str]
+    :param previous_source_fingerprints: Fingerprints from the run's manifest, by library ID and source type.
+    :type previous_source_fingerprints: dict[str, dict[str, Optional[dict[str, object]]]]
+    :return: Source files, by library ID and source type. See `fetch_library_source_files`.
+    :rtype: dict[str, dict[str, dict[str, object]]]
+    """
+    prefetch_start_timestamp = time.perf_counter()
+    hash_content = config.get('verify_source_fingerprints', False)
+    source_files_by_library_id = {}
+    if len(library_ids) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(get_prefetch_concurrency(config), len(library_ids)), thread_name_prefix='prefetch') as executor:
+            futures = [
+                executor.submit(fetch_library_source_files, os.path.join(output_path, library_id), library_id, previous_source_fingerprints.get(library_id, {}), hash_content)
+                for library_id in library_ids
+            ]
+            for library_id, future in zip(library_ids, futures):
+                source_files_by_library_id[library_id] = future.result()
+
+    num_files_read = len([source_file for source_files in source_files_by_library_id.values() for source_file in source_files.values() if source_file['content'] is not None])
+    logging.debug(json.dumps({"event_type": "prefetch_source_files_complete", "output_path": output_path, "num_libraries": len(library_ids), "num_files_read": num_files_read, "duration_seconds": round(time.perf_counter() - prefetch_start_timestamp, 3)}))
+
+    return source_files_by_library_id
+
+
+def parse_source_file(source_file, parse_fn):
+    """
+    :param source_file: Source file, as returned by `fetch_library_source_files`.
+    :type source_file: dict[str, object]
+    :param parse_fn: Function taking the path to the file and its contents (or None, to read it from the path), and returning the parsed file.
+    :type parse_fn: Callable[[str, Optional[bytes]], object]
+    :return: The parsed file, or None if it doesn't exist.
+    :rtype: Optional[object]
+    """
+    if source_file['fingerprint'] is None:
+        return None
+    try:
+        return parse_fn(source_file['path'], source_file['content'])
+    except FileNotFoundError as e:
+        return None
+
+
+@metrics.timed('parse_source_files')
+def parse_source_files(config, source_files, parse_fn):
+    """
+    Parse the given source files, up to 'prefetch_concurrency' at once. Files whose contents were kept when they were
+    fingerprinted are parsed from memory. Others are parsed from their path, so that a parser that only needs the start
+    of a file doesn't read the rest of it. Files that have been removed since they were fingerprinted are skipped.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param source_files: Source files, as returned by `fetch_library_source_files`.
+    :type source_files: list[dict[str, object]]
+    :param parse_fn: Function taking the path to a file and its contents (or None), and returning the parsed file.
+    :type parse_fn: Callable[[str, Optional[bytes]], object]
+    :return: The parsed files, in the same order as `source_files`. None for files that don't exist.
+    :rtype: list[Optional[object]]
+    """
+    if len(source_files) == 0:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(get_prefetch_concurrency(config), len(source_files)), thread_name_prefix='prefetch') as executor:
+        return list(executor.map(lambda source_file: parse_source_file(source_file, parse_fn), source_files))
@@ -0,0 +1,409 @@
+import json
+import logging
+import os
+import sqlite3
+import urllib.parse
+
+from typing import Optional
+
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.writers as writers
+
+
+LIBRARY_QC_INDEXED_FIELDS = [
+    'inferred_species_name',
+    'inferred_genus_name',
+    'num_reads',
+    'num_bases',
+    'read_n50',
+    'median_quality',
+    'inferred_species_percent',
+    'inferred_species_estimated_depth',
+    'inferred_genus_estimated_depth',
+]
+
+
+def get_qc_index_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the QC index. Defaults to 'qc_index.sqlite' in the output dir.
+    :rtype: str
+    """
+    return config.get('qc_index_path', os.path.join(config['output_dir'], 'qc_index.sqlite'))
+
+
+def get_run_date(run_id):
+    """
+    :param run_id: Sequencing run ID (eg. '20230101_1200_X1_FAV12345_abcd1234').
+    :type run_id: str
+    :return: Run date, in ISO format (eg. '2023-01-01'), or None if the run ID doesn't start with a date.
+    :rtype: Optional[str]
+    """
+    run_date = run_id[0:8]
+    if len(run_date) != 8 or not run_date.isdigit():
+        return None
+
+    return run_date[0:4] + '-' + run_date[4:6] + '-' + run_date[6:8]
+
+
+def get_run_month(run_id):
+    """
+    :param run_id: Sequencing run ID (eg. '20230101_1200_X1_FAV12345_abcd1234').
+    :type run_id: str
+    :return: Month of the run (eg. '2023-01'), or 'unknown' if the run ID doesn't start with a date.
+    :rtype: str
+    """
+    run_date = get_run_date(run_id)
+    if run_date is None:
+        return 'unknown'
+
+    return run_date[0:7]
+
+
+def get_journal_mode(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: SQLite journal mode for the QC index. WAL only works when every process using the database is on the same host,
+             so when several nodes share the output dir (see `leases`), the rollback journal ('DELETE') is used instead.
+    :rtype: str
+    """
+    if leases.is_enabled(config):
+        return 'DELETE'
+
+    return 'WAL'
+
+
+def open_qc_index(qc_index_path, journal_mode='WAL'):
+    """
+    Open (creating if needed) the QC index.
+
+    :param qc_index_path: Path to the SQLite QC index.
+    :type qc_index_path: str
+    :param journal_mode: SQLite journal mode, as returned by `get_journal_mode`.
+    :type journal_mode: str
+    :return: Connection to the QC index.
+    :rtype: sqlite3.Connection
+    """
+    connection = sqlite3.connect(qc_index_path, timeout=60)
+    connection.execute("PRAGMA journal_mode=" + journal_mode)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS library_qc (
+            run_id TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            run_date TEXT,
+            sequencer_type TEXT,
+            inferred_species_name TEXT,
+            inferred_genus_name TEXT,
+            num_reads INTEGER,
+            num_bases INTEGER,
+            read_n50 INTEGER,
+            median_quality REAL,
+            inferred_species_percent REAL,
+            inferred_species_estimated_depth REAL,
+            inferred_genus_estimated_depth REAL,
+            record TEXT NOT NULL,
+            PRIMARY KEY (run_id, library_id)
+        )
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS species_abundance (
+            run_id TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            run_date TEXT,
+            record TEXT NOT NULL,
+            PRIMARY KEY (run_id, library_id)
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS library_qc_run_date ON library_qc (run_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS library_qc_inferred_species_name ON library_qc (inferred_species_name)")
+    connection.execute("CREATE INDEX IF NOT EXISTS library_qc_library_id ON library_qc (library_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS species_abundance_library_id ON species_abundance (library_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS species_abundance_run_date ON species_abundance (run_date)")
+    connection.commit()
+
+    return connection
+
+
+def open_qc_index_read_only(qc_index_path):
+    """
+    Open an existing QC index for reading. Unlike `open_qc_index`, a missing index is not created.
+
+    :param qc_index_path: Path to the SQLite QC index.
+    :type qc_index_path: str
+    :return: Read-only connection to the QC index.
+    :rtype: sqlite3.Connection
+    :raises FileNotFoundError: If there is no QC index at the path.
+    """
+    if not os.path.isfile(qc_index_path):
+        raise FileNotFoundError("QC index not found: " + qc_index_path)
+
+    return sqlite3.connect('file:' + urllib.parse.quote(os.path.abspath(qc_index_path)) + '?mode=ro', uri=True, timeout=60)
+
+
+def upsert_library_qc(config, run_id, sequencer_type, library_qc_records):
+    """
+    Insert or replace the library-qc records for a run in the QC index.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param sequencer_type: Sequencer type ('gridion' or 'promethion').
+    :type sequencer_type: Optional[str]
+    :param library_qc_records: Library QC records, as written to the run's '_library_qc' output file.
+    :type library_qc_records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    run_date = get_run_date(run_id)
+    rows = []
+    for record in library_qc_records:
+        if 'library_id' not in record:
+            continue
+        row = [run_id, record['library_id'], run_date, sequencer_type]
+        row += [record.get(field, None) for field in LIBRARY_QC_INDEXED_FIELDS]
+        row.append(json.dumps(record))
+        rows.append(row)
+
+    columns = ['run_id', 'library_id', 'run_date', 'sequencer_type'] + LIBRARY_QC_INDEXED_FIELDS + ['record']
+    # With several nodes, writes are serialized by a lease, as SQLite's file locks can't be relied on over a network filesystem.
+    with leases.lease(config, 'qc-index', wait_seconds=None):
+        connection = open_qc_index(get_qc_index_path(config), get_journal_mode(config))
+        try:
+            with connection:
+                connection.execute("DELETE FROM library_qc WHERE run_id = ?", (run_id,))
+                connection.executemany(
+                    "INSERT OR REPLACE INTO library_qc (" + ", ".join(columns) + ") VALUES (" + ", ".join(['?'] * len(columns)) + ")",
+                    rows
+                )
+        finally:
+            connection.close()
+
+    logging.info(json.dumps({"event_type": "index_library_qc_complete", "sequencing_run_id": run_id, "num_libraries": len(rows)}))
+
+
+def upsert_species_abundance(config, run_id, species_abundance_records):
+    """
+    Insert or replace the species-abundance records for a run in the QC index.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param species_abundance_records: Species abundance records, as written to the run's '_species_abundance' output file.
+    :type species_abundance_records: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    run_date = get_run_date(run_id)
+    rows = [(run_id, record['library_id'], run_date, json.dumps(record)) for record in species_abundance_records if 'library_id' in record]
+    with leases.lease(config, 'qc-index', wait_seconds=None):
+        connection = open_qc_index(get_qc_index_path(config), get_journal_mode(config))
+        try:
+            with connection:
+                connection.execute("DELETE FROM species_abundance WHERE run_id = ?", (run_id,))
+                connection.executemany("INSERT OR REPLACE INTO species_abundance (run_id, library_id, run_date, record) VALUES (?, ?, ?, ?)", rows)
+        finally:
+            connection.close()
+
+    logging.info(json.dumps({"event_type": "index_species_abundance_complete", "sequencing_run_id": run_id, "num_libraries": len(rows)}))
+
+
+def ensure_run_indexed(config, run_id, sequencer_type, library_qc_path, species_abundance_path):
+    """
+    Add a run's existing output files to the QC index if it isn't already there.
+    This is used to index runs that were collected before the index existed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param sequencer_type: Sequencer type ('gridion' or 'promethion').
+    :type sequencer_type: Optional[str]
+    :param library_qc_path: Path to the run's '_library_qc' output file.
+    :type library_qc_path: str
+    :param species_abundance_path: Path to the run's '_species_abundance' output file.
+    :type species_abundance_path: str
+    :return: Whether any records were added to the index.
+    :rtype: bool
+    """
+    library_qc_indexed = False
+    species_abundance_indexed = False
+    try:
+        connection = open_qc_index_read_only(get_qc_index_path(config))
+    except FileNotFoundError as e:
+        connection = None
+    if connection is not None:
+        try:
+            library_qc_indexed = connection.execute("SELECT 1 FROM library_qc WHERE run_id = ? LIMIT 1", (run_id,)).fetchone() is not None
+            species_abundance_indexed = connection.execute("SELECT 1 FROM species_abundance WHERE run_id = ? LIMIT 1", (run_id,)).fetchone() is not None
+        finally:
+            connection.close()
+
+    indexed = False
+    if not library_qc_indexed and os.path.exists(library_qc_path):
+        upsert_library_qc(config, run_id, sequencer_type, writers.read_records(library_qc_path))
+        indexed = True
+    if not species_abundance_indexed and os.path.exists(species_abundance_path):
+        upsert_species_abundance(config, run_id, writers.read_records(species_abundance_path))
+        indexed = True
+
+    return indexed
+
+
+def get_indexed_run_ids(config, table):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :return: IDs of all runs with records in the table.
+    :rtype: set[str]
+    """
+    run_ids = set()
+    try:
+        connection = open_qc_index_read_only(get_qc_index_path(config))
+    except FileNotFoundError as e:
+        return run_ids
+    try:
+        for (run_id,) in connection.execute("SELECT DISTINCT run_id FROM " + table):
+            run_ids.add(run_id)
+    finally:
+        connection.close()
+
+    return run_ids
+
+
+def select_records(config, table, condition=None, parameters=()):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param condition: SQL condition (eg. 'run_id = ?') that records must meet. If None, all records are included.
+    :type condition: Optional[str]
+    :param parameters: Values for the placeholders in the condition.
+    :type parameters: Sequence[object]
+    :return: Records, with 'run_id', 'run_date' and 'sequencer_type' (library_qc only) added. Ordered by run ID and library ID.
+             Empty if the QC index doesn't exist yet.
+    :rtype: list[dict[str, object]]
+    """
+    columns = ['run_id', 'run_date']
+    if table == 'library_qc':
+        columns.append('sequencer_type')
+    query = "SELECT " + ", ".join(columns + ['record']) + " FROM " + table
+    if condition is not None:
+        query += " WHERE " + condition
+    query += " ORDER BY run_id, library_id"
+
+    records = []
+    try:
+        connection = open_qc_index_read_only(get_qc_index_path(config))
+    except FileNotFoundError as e:
+        return records
+    try:
+        for row in connection.execute(query, parameters):
+            record = dict(zip(columns, row[0:-1]))
+            record.update(json.loads(row[-1]))
+            records.append(record)
+    finally:
+        connection.close()
+
+    return records
+
+
+def get_month_records(config, table, month):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param month: Month (eg. '2023-01'), or 'unknown' for runs without a date.
+    :type month: str
+    :return: Records for all runs in the month. See `select_records`.
+    :rtype: list[dict[str, object]]
+    """
+    if month == 'unknown':
+        return select_records(config, table, "run_date IS NULL")
+
+    return select_records(config, table, "run_date >= ? AND run_date < ?", (month + '-01', month + '-99'))
+
+
+def get_run_records(config, table, run_id=None):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param table: 'library_qc' or 'species_abundance'.
+    :type table: str
+    :param run_id: Only include records from this run. If None, records from all runs are included.
+    :type run_id: Optional[str]
+    :return: Records. See `select_records`.
+    :rtype: list[dict[str, object]]
+    """
+    if run_id is None:
+        return select_records(config, table)
+
+    return select_records(config, table, "run_id = ?", (run_id,))
+
+
+def query_library_qc(qc_index_path, run_id: Optional[str]=None, library_id: Optional[str]=None, species_name: Optional[str]=None, start_date: Optional[str]=None, end_date: Optional[str]=None, min_depth: Optional[float]=None, max_depth: Optional[float]=None, limit: Optional[int]=None):
+    """
+    Query library-qc records across all runs.
+
+    :param qc_index_path: Path to the SQLite QC index.
+    :type qc_index_path: str
+    :param run_id: Only include libraries from this run.
+    :type run_id: Optional[str]
+    :param library_id: Only include libraries with this ID.
+    :type library_id: Optional[str]
+    :param species_name: Only include libraries with this inferred species.
+    :type species_name: Optional[str]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :param min_depth: Only include libraries with inferred species estimated depth of at least this.
+    :type min_depth: Optional[float]
+    :param max_depth: Only include libraries with inferred species estimated depth less than this.
+    :type max_depth: Optional[float]
+    :param limit: Maximum number of records to return.
+    :type limit: Optional[int]
+    :return: Library QC records, with 'run_id' added. Ordered by run ID and library ID.
+    :rtype: list[dict[str, object]]
+    :raises FileNotFoundError: If there is no QC index at the path.
+    """
+    conditions = []
+    parameters = []
+    for column, operator, value in [
+            ('run_id', '=', run_id),
+            ('library_id', '=', library_id),
+            ('inferred_species_name', '=', species_name),
+            ('run_date', '>=', start_date),
+            ('run_date', '<=', end_date),
+            ('inferred_species_estimated_depth', '>=', min_depth),
+            ('inferred_species_estimated_depth', '<', max_depth)]:
+        if value is not None:
+            conditions.append(column + ' ' + operator + ' ?')
+            parameters.append(value)
+
+    query = "SELECT run_id, record FROM library_qc"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY run_id, library_id"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+
+    records = []
+    connection = open_qc_index_read_only(qc_index_path)
+    try:
+        for row_run_id, row_record in connection.execute(query, parameters):
+            record = {'run_id': row_run_id}
+            record.update(json.loads(row_record))
+            records.append(record)
+    finally:
+        connection.close()
+
+    return records
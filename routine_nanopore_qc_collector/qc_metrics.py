@@ -0,0 +1,229 @@
+"""
+Run-level computation of the inferred species and genus for each library, along with
+their percentages of reads and estimated depths, and of the same metrics for the species
+expected for each library's project.
+
+Rather than looking up 'abundance_N_*' keys library by library, the top abundances of every
+library in a run are loaded once into columns (one list per rank, indexed by library), and each
+metric is computed for the whole run in a single pass over those columns. Results are identical to
+`core.infer_species`, `core.infer_genus`, `core.get_percent_reads_by_species_name` and
+`core.get_percent_reads_by_genus_name`, including their handling of ties and missing values.
+The 'inferred_metrics_per_library' and 'inferred_metrics_by_run' benchmark stages compare the two.
+"""
+
+# Ranks considered when inferring species and genus.
+NUM_INFERENCE_RANKS = 5
+
+EXCLUDED_SPECIES = 'Homo sapiens'
+
+# Marks a field that is absent from a species abundance record, as distinct from one that is present but None.
+MISSING = object()
+
+
+def load_abundance_columns(species_abundances):
+    """
+    Load the top abundances of a set of libraries into columns.
+
+    :param species_abundances: Species abundance records, one per library.
+    :type species_abundances: list[dict[str, object]]
+    :return: Columns by rank (1-5). Keys: ['name', 'genus_name', 'fraction_total_reads']. Each is a list with one value per library, or `MISSING`.
+    :rtype: dict[int, dict[str, list[object]]]
+    """
+    columns_by_rank = {}
+    for rank in range(1, NUM_INFERENCE_RANKS + 1):
+        key_prefix = 'abundance_' + str(rank) + '_'
+        columns_by_rank[rank] = {
+            field: [species_abundance.get(key_prefix + field, MISSING) for species_abundance in species_abundances]
+            for field in ['name', 'genus_name', 'fraction_total_reads']
+        }
+
+    return columns_by_rank
+
+
+def infer_species(columns_by_rank, num_libraries):
+    """
+    :param columns_by_rank: Columns, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param num_libraries: Number of libraries.
+    :type num_libraries: int
+    :return: Inferred species for each library: the most abundant species other than Homo sapiens. Ties go to the lower-ranked species.
+    :rtype: list[Optional[str]]
+    """
+    inferred_species = [None] * num_libraries
+    greatest_fractions = [0.0] * num_libraries
+    for rank in range(NUM_INFERENCE_RANKS, 0, -1):
+        names = columns_by_rank[rank]['name']
+        fractions = columns_by_rank[rank]['fraction_total_reads']
+        for library_num in range(num_libraries):
+            name = names[library_num]
+            if name is not MISSING and name != EXCLUDED_SPECIES and fractions[library_num] > greatest_fractions[library_num]:
+                inferred_species[library_num] = name
+                greatest_fractions[library_num] = fractions[library_num]
+
+    return inferred_species
+
+
+def infer_genus(columns_by_rank, inferred_species):
+    """
+    :param columns_by_rank: Columns, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param inferred_species: Inferred species for each library.
+    :type inferred_species: list[Optional[str]]
+    :return: Genus of the highest-ranked occurrence of each library's inferred species.
+    :rtype: list[Optional[str]]
+    """
+    inferred_genus = [None] * len(inferred_species)
+    found = [False] * len(inferred_species)
+    for rank in range(1, NUM_INFERENCE_RANKS + 1):
+        names = columns_by_rank[rank]['name']
+        genus_names = columns_by_rank[rank]['genus_name']
+        for library_num, species_name in enumerate(inferred_species):
+            if not found[library_num] and names[library_num] is not MISSING and names[library_num] == species_name:
+                genus_name = genus_names[library_num]
+                inferred_genus[library_num] = genus_name if genus_name is not MISSING else None
+                found[library_num] = True
+
+    return inferred_genus
+
+
+def get_percent_reads_by_species_name(columns_by_rank, species_names):
+    """
+    :param columns_by_rank: Columns, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param species_names: Species name for each library.
+    :type species_names: list[Optional[str]]
+    :return: Percent of reads for each library's species, from its lowest-ranked occurrence, or None if not found.
+    :rtype: list[Optional[float]]
+    """
+    percent_reads = [None] * len(species_names)
+    for rank in range(NUM_INFERENCE_RANKS, 0, -1):
+        names = columns_by_rank[rank]['name']
+        fractions = columns_by_rank[rank]['fraction_total_reads']
+        for library_num, species_name in enumerate(species_names):
+            if percent_reads[library_num] is None and names[library_num] is not MISSING and names[library_num] == species_name and fractions[library_num] is not MISSING:
+                percent_reads[library_num] = round(100 * fractions[library_num], 3)
+
+    return percent_reads
+
+
+def get_percent_reads_by_genus_name(columns_by_rank, genus_names):
+    """
+    :param columns_by_rank: Columns, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param genus_names: Genus name for each library.
+    :type genus_names: list[Optional[str]]
+    :return: Total percent of reads for all species in each library's genus.
+    :rtype: list[float]
+    """
+    percent_reads = [0.0] * len(genus_names)
+    for rank in range(1, NUM_INFERENCE_RANKS + 1):
+        rank_genus_names = columns_by_rank[rank]['genus_name']
+        fractions = columns_by_rank[rank]['fraction_total_reads']
+        for library_num, genus_name in enumerate(genus_names):
+            if rank_genus_names[library_num] is not MISSING and rank_genus_names[library_num] == genus_name and fractions[library_num] is not MISSING:
+                percent_reads[library_num] += 100 * fractions[library_num]
+
+    return [round(p, 3) for p in percent_reads]
+
+
+def compute_inferred_metrics(config, columns_by_rank, num_bases):
+    """
+    Compute the inferred species and genus metrics for every library in a run.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param columns_by_rank: Columns of the libraries' species abundance records, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param num_bases: Number of bases for each library, or None if unknown.
+    :type num_bases: list[Optional[int]]
+    :return: Library QC fields for each library, in output order. Empty for libraries with no inferred species.
+             Keys: ['inferred_species_name', 'inferred_genus_name', 'inferred_species_percent', 'inferred_genus_percent',
+                    'inferred_species_genome_size_mb', 'inferred_species_estimated_depth', 'inferred_genus_estimated_depth']
+    :rtype: list[dict[str, object]]
+    """
+    num_libraries = len(num_bases)
+    inferred_species = infer_species(columns_by_rank, num_libraries)
+    inferred_genus = infer_genus(columns_by_rank, inferred_species)
+    species_percents = get_percent_reads_by_species_name(columns_by_rank, inferred_species)
+    genus_percents = get_percent_reads_by_genus_name(columns_by_rank, inferred_genus)
+    known_species = config.get('known_species', {})
+
+    inferred_metrics = []
+    for library_num in range(num_libraries):
+        species_name = inferred_species[library_num]
+        if species_name is None:
+            inferred_metrics.append({})
+            continue
+
+        library_metrics = {
+            'inferred_species_name': species_name,
+            'inferred_genus_name': inferred_genus[library_num],
+            'inferred_species_percent': species_percents[library_num],
+            'inferred_genus_percent': genus_percents[library_num],
+        }
+        if species_name in known_species:
+            library_metrics['inferred_species_genome_size_mb'] = known_species[species_name]['genome_size_mb']
+            library_num_bases = num_bases[library_num]
+            genome_size = library_metrics['inferred_species_genome_size_mb'] * 1000000
+            species_percent = library_metrics['inferred_species_percent']
+            genus_percent = library_metrics['inferred_genus_percent']
+            if library_num_bases is not None and all([library_num_bases, genome_size, species_percent]):
+                library_metrics['inferred_species_estimated_depth'] = round((library_num_bases * (species_percent / 100)) / genome_size, 3)
+            if library_num_bases is not None and all([library_num_bases, genome_size, genus_percent]):
+                library_metrics['inferred_genus_estimated_depth'] = round((library_num_bases * (genus_percent / 100)) / genome_size, 3)
+        inferred_metrics.append(library_metrics)
+
+    return inferred_metrics
+
+
+def compute_project_metrics(config, columns_by_rank, num_bases, library_projects):
+    """
+    Compute the expected (project) species metrics for every library in a run.
+
+    The genome size is the project's own genome size if the project has a fixed genome size, otherwise the
+    genome size of the project species from the known species list. For projects with a fixed genome size, the
+    estimated depth covers all bases in the library. Otherwise it covers only the bases assigned to the project species.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param columns_by_rank: Columns of the libraries' species abundance records, as returned by `load_abundance_columns`.
+    :type columns_by_rank: dict[int, dict[str, list[object]]]
+    :param num_bases: Number of bases for each library, or None if unknown.
+    :type num_bases: list[Optional[int]]
+    :param library_projects: Project for each library, as returned by `samplesheet.get_library_projects`, or None if the library has no project.
+    :type library_projects: list[Optional[dict[str, object]]]
+    :return: Library QC fields for each library, in output order. Empty for libraries with no project.
+             Keys: ['project_id', 'project_species_name', 'project_species_percent', 'project_genome_size_mb', 'project_estimated_depth']
+    :rtype: list[dict[str, object]]
+    """
+    project_species = [library_project.get('project_species_name', None) if library_project is not None else None for library_project in library_projects]
+    species_percents = get_percent_reads_by_species_name(columns_by_rank, project_species)
+    known_species = config.get('known_species', {})
+
+    project_metrics = []
+    for library_num, library_project in enumerate(library_projects):
+        if library_project is None:
+            project_metrics.append({})
+            continue
+
+        library_metrics = {'project_id': library_project['project_id']}
+        species_name = project_species[library_num]
+        if species_name is not None:
+            library_metrics['project_species_name'] = species_name
+            library_metrics['project_species_percent'] = species_percents[library_num]
+        fixed_genome_size = library_project.get('fixed_genome_size', False) and 'genome_size_mb' in library_project
+        if fixed_genome_size:
+            library_metrics['project_genome_size_mb'] = library_project['genome_size_mb']
+        elif species_name in known_species and 'genome_size_mb' in known_species[species_name]:
+            library_metrics['project_genome_size_mb'] = known_species[species_name]['genome_size_mb']
+
+        library_num_bases = num_bases[library_num]
+        if library_num_bases and library_metrics.get('project_genome_size_mb', None):
+            genome_size = library_metrics['project_genome_size_mb'] * 1000000
+            if fixed_genome_size:
+                library_metrics['project_estimated_depth'] = round(library_num_bases / genome_size, 3)
+            elif library_metrics.get('project_species_percent', None):
+                library_metrics['project_estimated_depth'] = round((library_num_bases * (library_metrics['project_species_percent'] / 100)) / genome_size, 3)
+        project_metrics.append(library_metrics)
+
+    return project_metrics
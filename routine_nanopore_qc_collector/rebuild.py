@@ -0,0 +1,195 @@
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+from typing import Optional
+
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.qc_index as qc_index
+
+
+def get_checkpoint_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the rebuild checkpoint file.
+    :rtype: str
+    """
+    return os.path.join(config['output_dir'], 'rebuild_checkpoint.json')
+
+
+def select_runs(discovered_runs, run_ids: Optional[set[str]]=None, start_date: Optional[str]=None, end_date: Optional[str]=None):
+    """
+    Select completed, non-excluded runs to rebuild.
+
+    :param discovered_runs: Runs, as returned by `core.discover_runs`.
+    :type discovered_runs: list[core.RunRecord]
+    :param run_ids: Only include these runs.
+    :type run_ids: Optional[set[str]]
+    :param start_date: Only include runs on or after this date (YYYY-MM-DD).
+    :type start_date: Optional[str]
+    :param end_date: Only include runs on or before this date (YYYY-MM-DD).
+    :type end_date: Optional[str]
+    :return: Selected runs, in run ID order.
+    :rtype: list[core.RunRecord]
+    """
+    selected_runs = []
+    for run in discovered_runs:
+        if run['excluded'] or not run['analysis_complete']:
+            continue
+        if run_ids is not None and run['run_id'] not in run_ids:
+            continue
+        run_date = qc_index.get_run_date(run['run_id'])
+        if start_date is not None and (run_date is None or run_date < start_date):
+            continue
+        if end_date is not None and (run_date is None or run_date > end_date):
+            continue
+        selected_runs.append(run)
+
+    return selected_runs
+
+
+def load_checkpoint(checkpoint_path, selection):
+    """
+    Load the IDs of runs already rebuilt by an earlier, interrupted rebuild with the same selection.
+
+    :param checkpoint_path: Path to the checkpoint file.
+    :type checkpoint_path: str
+    :param selection: Parameters used to select runs. Keys: ['run_ids', 'start_date', 'end_date']
+    :type selection: dict[str, object]
+    :return: IDs of runs that have already been rebuilt.
+    :rtype: set[str]
+    """
+    if not os.path.exists(checkpoint_path):
+        return set()
+    try:
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+    except json.decoder.JSONDecodeError as e:
+        logging.warning(json.dumps({"event_type": "load_rebuild_checkpoint_failed", "checkpoint_file": checkpoint_path}))
+        return set()
+
+    if checkpoint.get('selection', None) != selection:
+        logging.info(json.dumps({"event_type": "rebuild_checkpoint_ignored", "reason": "selection_changed", "checkpoint_file": checkpoint_path}))
+        return set()
+
+    completed_run_ids = set(checkpoint.get('completed_run_ids', []))
+    logging.info(json.dumps({"event_type": "rebuild_checkpoint_loaded", "checkpoint_file": checkpoint_path, "num_runs_completed": len(completed_run_ids)}))
+
+    return completed_run_ids
+
+
+def rebuild_run(config, analysis_dir):
+    """
+    Re-collect outputs for a run, holding the run's lease ('run-<run_id>', as used by the collector), so that
+    the run isn't collected by a running collector at the same time. If another node holds the lease, wait for it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_dir: Analysis dir to collect.
+    :type analysis_dir: dict[str, str]
+    :return: Summary returned by `core.collect_outputs`.
+    :rtype: dict[str, object]
+    """
+    run_id = os.path.basename(analysis_dir['path'])
+    with leases.lease(config, 'run-' + run_id, wait_seconds=None):
+        return core.collect_outputs(config, analysis_dir, True)
+
+
+def rebuild(config, runs, num_workers=1, selection=None, checkpoint_path=None):
+    """
+    Re-collect outputs for a set of runs, overwriting any existing outputs. Progress is
+    checkpointed after each run, so an interrupted rebuild with the same selection resumes
+    where it stopped. The checkpoint is removed when the rebuild completes.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param runs: Runs to rebuild, as returned by `select_runs`.
+    :type runs: list[core.RunRecord]
+    :param num_workers: Maximum number of runs to rebuild at once.
+    :type num_workers: int
+    :param selection: Parameters used to select runs, stored in the checkpoint. Keys: ['run_ids', 'start_date', 'end_date']
+    :type selection: Optional[dict[str, object]]
+    :param checkpoint_path: Path to the checkpoint file. Defaults to 'rebuild_checkpoint.json' in the output dir.
+    :type checkpoint_path: Optional[str]
+    :return: Summary. Keys: ['num_runs', 'num_libraries', 'num_failed', 'duration_seconds', 'runs_per_minute', 'libraries_per_minute']
+    :rtype: dict[str, object]
+    """
+    if selection is None:
+        selection = {}
+    if checkpoint_path is None:
+        checkpoint_path = get_checkpoint_path(config)
+
+    completed_run_ids = load_checkpoint(checkpoint_path, selection)
+    pending_runs = [run for run in runs if run['run_id'] not in completed_run_ids]
+    logging.info(json.dumps({"event_type": "rebuild_start", "num_runs_selected": len(runs), "num_runs_pending": len(pending_runs), "num_workers": num_workers}))
+
+    summary = {
+        'num_runs': 0,
+        'num_libraries': 0,
+        'num_failed': 0,
+        'duration_seconds': 0.0,
+        'runs_per_minute': 0.0,
+        'libraries_per_minute': 0.0,
+    }
+    start_time = time.monotonic()
+
+    def update_throughput():
+        summary['duration_seconds'] = round(time.monotonic() - start_time, 3)
+        elapsed_minutes = max(summary['duration_seconds'], 1e-9) / 60
+        summary['runs_per_minute'] = round(summary['num_runs'] / elapsed_minutes, 3)
+        summary['libraries_per_minute'] = round(summary['num_libraries'] / elapsed_minutes, 3)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='rebuild')
+    futures = {}
+    try:
+        for run in pending_runs:
+            analysis_dir = {
+                "path": run['path'],
+                "sequencer_type": run['sequencer_type'],
+                "routine_nanopore_qc_output_path": run['routine_nanopore_qc_output_path'],
+            }
+            futures[executor.submit(rebuild_run, config, analysis_dir)] = run['run_id']
+
+        for future in concurrent.futures.as_completed(futures):
+            run_id = futures[future]
+            try:
+                collect_outputs_summary = future.result()
+            except Exception as e:
+                summary['num_failed'] += 1
+                logging.error(json.dumps({"event_type": "rebuild_run_failed", "sequencing_run_id": run_id, "error": repr(e)}))
+                continue
+            summary['num_runs'] += 1
+            summary['num_libraries'] += collect_outputs_summary['num_libraries']
+            completed_run_ids.add(run_id)
+            core.write_json(checkpoint_path, {'selection': selection, 'completed_run_ids': sorted(completed_run_ids)})
+            update_throughput()
+            logging.info(json.dumps({
+                "event_type": "rebuild_progress",
+                "sequencing_run_id": run_id,
+                "num_runs_completed": len(completed_run_ids),
+                "num_runs_selected": len(runs),
+                "runs_per_minute": summary['runs_per_minute'],
+                "libraries_per_minute": summary['libraries_per_minute'],
+            }))
+    except KeyboardInterrupt as e:
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Runs that were in progress when interrupted have now finished, so record them too.
+        for future, run_id in futures.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                completed_run_ids.add(run_id)
+        core.write_json(checkpoint_path, {'selection': selection, 'completed_run_ids': sorted(completed_run_ids)})
+        logging.info(json.dumps({"event_type": "rebuild_interrupted", "checkpoint_file": checkpoint_path, "num_runs_completed": len(completed_run_ids)}))
+        raise
+
+    executor.shutdown(wait=True)
+    update_throughput()
+    if summary['num_failed'] == 0 and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    logging.info(json.dumps(dict({"event_type": "rebuild_complete"}, **summary)))
+
+    return summary
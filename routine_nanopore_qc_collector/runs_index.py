@@ -0,0 +1,164 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.qc_index as qc_index
+import routine_nanopore_qc_collector.writers as writers
+
+
+RUNS_INDEX_VERSION = 1
+
+# Number of changes kept in the runs index, so that consumers can catch up on recent changes run by run.
+MAX_RUNS_INDEX_CHANGES = 100
+
+
+def get_runs_index_dir(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the dir containing the runs index and its monthly shards.
+    :rtype: str
+    """
+    return os.path.join(config['output_dir'], 'runs')
+
+
+def get_etag(runs):
+    """
+    :param runs: Runs, as returned by `core.find_runs`.
+    :type runs: list[dict[str, str]]
+    :return: Hash of the runs, which changes whenever their content changes.
+    :rtype: str
+    """
+    serialized_runs = json.dumps(runs, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(serialized_runs.encode('utf-8')).hexdigest()
+
+
+def load_runs_index(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Runs index. Keys: ['runs_index_version', 'sequence', 'etag', 'updated', 'shards', 'changes']
+    :rtype: dict[str, object]
+    """
+    runs_index = {
+        'runs_index_version': RUNS_INDEX_VERSION,
+        'sequence': 0,
+        'etag': None,
+        'updated': None,
+        'shards': {},
+        'changes': [],
+    }
+    runs_index_path = os.path.join(get_runs_index_dir(config), 'index.json')
+    try:
+        with open(runs_index_path, 'r') as f:
+            existing_runs_index = json.load(f)
+    except FileNotFoundError as e:
+        return runs_index
+    except json.decoder.JSONDecodeError as e:
+        logging.warning(json.dumps({"event_type": "load_runs_index_failed", "runs_index_file": runs_index_path}))
+        return runs_index
+
+    if existing_runs_index.get('runs_index_version', None) == RUNS_INDEX_VERSION:
+        runs_index = existing_runs_index
+
+    return runs_index
+
+
+def update_runs_index(config, runs):
+    """
+    Bring the runs output file, monthly shards and runs index up to date with the current list of runs.
+    Each file is only rewritten if its content has changed.
+
+    The runs index ('runs/index.json' in the output dir) records a sequence number, which is incremented
+    whenever any run is added, removed or changed, along with an etag for the full list of runs, and the
+    etag and sequence number of the last change for each monthly shard (eg. 'runs/2023-01.json').
+    Consumers can poll the index, and only fetch the shards that have changed since the sequence number
+    they last saw. The most recent changes are also listed by run ID.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param runs: Runs, as returned by `core.find_runs`.
+    :type runs: list[dict[str, str]]
+    :return: Runs index.
+    :rtype: dict[str, object]
+    """
+    runs_index_dir = get_runs_index_dir(config)
+    os.makedirs(runs_index_dir, exist_ok=True)
+    runs_index = load_runs_index(config)
+    sequence = runs_index['sequence'] + 1
+
+    runs_by_month = {}
+    for run in runs:
+        runs_by_month.setdefault(qc_index.get_run_month(run['run_id']), []).append(run)
+
+    changes = []
+    for month in sorted(set(runs_by_month.keys()) | set(runs_index['shards'].keys())):
+        month_runs = runs_by_month.get(month, [])
+        etag = get_etag(month_runs)
+        shard = runs_index['shards'].get(month, None)
+        shard_path = writers.get_output_path(config, runs_index_dir, month)
+        if shard is not None and shard['etag'] == etag and os.path.join(runs_index_dir, shard['file']) == shard_path and os.path.exists(shard_path):
+            continue
+
+        previous_runs_by_run_id = {}
+        if shard is not None:
+            previous_shard_path = os.path.join(runs_index_dir, shard['file'])
+            try:
+                previous_runs_by_run_id = {run['run_id']: run for run in writers.read_records(previous_shard_path)}
+            except (OSError, EOFError, json.decoder.JSONDecodeError) as e:
+                pass
+            if previous_shard_path != shard_path and os.path.exists(previous_shard_path):
+                os.remove(previous_shard_path)
+        month_runs_by_run_id = {run['run_id']: run for run in month_runs}
+
+        if len(month_runs) > 0:
+            writers.write_output(config, shard_path, month_runs)
+            runs_index['shards'][month] = {
+                'file': os.path.basename(shard_path),
+                'etag': etag,
+                'num_runs': len(month_runs),
+                'sequence': sequence,
+            }
+        else:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+            runs_index['shards'].pop(month)
+
+        change = {
+            'sequence': sequence,
+            'month': month,
+            'added_run_ids': sorted(set(month_runs_by_run_id.keys()) - set(previous_runs_by_run_id.keys())),
+            'removed_run_ids': sorted(set(previous_runs_by_run_id.keys()) - set(month_runs_by_run_id.keys())),
+            'updated_run_ids': sorted(run_id for run_id in month_runs_by_run_id if run_id in previous_runs_by_run_id and month_runs_by_run_id[run_id] != previous_runs_by_run_id[run_id]),
+        }
+        changes.append(change)
+
+    etag = get_etag(runs)
+    runs_output_file = writers.get_output_path(config, config['output_dir'], 'runs')
+    runs_file_changed = runs_index['etag'] != etag or not os.path.exists(runs_output_file)
+    if runs_file_changed:
+        writers.write_output(config, runs_output_file, runs)
+        logging.info(json.dumps({"event_type": "write_runs_file_complete", "runs_file": runs_output_file}))
+
+    if runs_file_changed or len(changes) > 0:
+        runs_index['sequence'] = sequence
+        runs_index['etag'] = etag
+        runs_index['updated'] = datetime.datetime.now().astimezone().isoformat()
+        runs_index['changes'] = (runs_index['changes'] + changes)[-MAX_RUNS_INDEX_CHANGES:]
+        core.write_json(os.path.join(runs_index_dir, 'index.json'), runs_index)
+        logging.info(json.dumps({
+            "event_type": "runs_index_updated",
+            "sequence": sequence,
+            "num_runs": len(runs),
+            "shards_changed": [change['month'] for change in changes],
+            "num_runs_added": sum(len(change['added_run_ids']) for change in changes),
+            "num_runs_removed": sum(len(change['removed_run_ids']) for change in changes),
+        }))
+    else:
+        logging.debug(json.dumps({"event_type": "runs_index_unchanged", "sequence": runs_index['sequence']}))
+
+    return runs_index
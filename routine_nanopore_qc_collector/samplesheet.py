@@ -1,32 +1,283 @@
+import csv
 import glob
 import json
 import logging
 import os
-import re
+import threading
 
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.writers as writers
 
-def find_samplesheet_for_run(run_id, sequencer_output_dirs):
+
+SAMPLESHEET_INDEX_VERSION = 1
+
+# Samplesheet columns that may hold the library ID and project ID, in order of preference.
+LIBRARY_ID_COLUMNS = ['alias', 'library_id', 'sample_id']
+PROJECT_ID_COLUMNS = ['project_id', 'project']
+
+_samplesheet_index = None
+_samplesheet_index_lock = threading.Lock()
+_parsed_samplesheets = {}
+_parsed_samplesheets_lock = threading.Lock()
+
+
+def get_sequencer_output_dirs(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Sequencer output dirs, from 'sequencer_output_dirs', which may be a single path or a list of paths.
+    :rtype: list[str]
+    """
+    sequencer_output_dirs = config.get('sequencer_output_dirs', [])
+    if isinstance(sequencer_output_dirs, str):
+        sequencer_output_dirs = [sequencer_output_dirs]
+
+    return list(dict.fromkeys(os.path.abspath(sequencer_output_dir) for sequencer_output_dir in sequencer_output_dirs))
+
+
+def get_samplesheet_index_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the samplesheet index. Defaults to 'samplesheet_index.json' in the output dir.
+    :rtype: str
+    """
+    return config.get('samplesheet_index_path', os.path.join(config['output_dir'], 'samplesheet_index.json'))
+
+
+def load_samplesheet_index(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Samplesheet index. Keys: ['samplesheet_index_version', 'sequencer_output_dirs']. See `update_samplesheet_index`.
+    :rtype: dict[str, object]
+    """
+    samplesheet_index = {
+        'samplesheet_index_version': SAMPLESHEET_INDEX_VERSION,
+        'sequencer_output_dirs': {},
+    }
+    samplesheet_index_path = get_samplesheet_index_path(config)
+    try:
+        with open(samplesheet_index_path, 'r') as f:
+            existing_samplesheet_index = json.load(f)
+    except FileNotFoundError as e:
+        return samplesheet_index
+    except json.decoder.JSONDecodeError as e:
+        logging.warning(json.dumps({"event_type": "load_samplesheet_index_failed", "samplesheet_index_file": samplesheet_index_path}))
+        return samplesheet_index
+
+    if existing_samplesheet_index.get('samplesheet_index_version', None) == SAMPLESHEET_INDEX_VERSION:
+        samplesheet_index = existing_samplesheet_index
+
+    return samplesheet_index
+
+
+def find_samplesheet(sequencer_run_dir):
+    """
+    :param sequencer_run_dir: Path to a run's sequencer output dir.
+    :type sequencer_run_dir: str
+    :return: Path to the run's 'sample_sheet_*.csv' file, or None if it has none. If there are several (eg. after a restarted run), the most recently modified is used.
+    :rtype: Optional[str]
+    """
+    samplesheets = glob.glob(os.path.join(glob.escape(sequencer_run_dir), 'sample_sheet_*.csv'))
+    if len(samplesheets) == 0:
+        return None
+
+    return max(samplesheets, key=lambda samplesheet_path: (os.stat(samplesheet_path).st_mtime_ns, samplesheet_path))
+
+
+def update_samplesheet_index(config):
+    """
+    Bring the samplesheet index up to date with the sequencer output dirs, and save it if anything changed.
+
+    The index records, for each sequencer output dir, its mtime and the samplesheet found in each run dir within it.
+    Run dirs must be directly within a sequencer output dir, and named by run ID. Deeper dirs aren't searched.
+    A sequencer output dir is only listed when its mtime has changed, and then only new run dirs (and run dirs
+    that had no samplesheet, if they have changed since) are searched for samplesheets.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Samplesheet index.
+    :rtype: dict[str, object]
     """
+    global _samplesheet_index
+    with _samplesheet_index_lock:
+        if _samplesheet_index is None:
+            _samplesheet_index = load_samplesheet_index(config)
+        samplesheet_index = _samplesheet_index
+
+        sequencer_output_dirs = get_sequencer_output_dirs(config)
+        modified = False
+        for sequencer_output_dir in list(samplesheet_index['sequencer_output_dirs'].keys()):
+            if sequencer_output_dir not in sequencer_output_dirs:
+                samplesheet_index['sequencer_output_dirs'].pop(sequencer_output_dir)
+                modified = True
+
+        num_runs_added = 0
+        for sequencer_output_dir in sequencer_output_dirs:
+            indexed_dir = samplesheet_index['sequencer_output_dirs'].get(sequencer_output_dir, {'mtime_ns': None, 'runs': {}})
+            try:
+                dir_mtime_ns = os.stat(sequencer_output_dir).st_mtime_ns
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "sequencer_output_dir_unavailable", "sequencer_output_dir": sequencer_output_dir, "error": repr(e)}))
+                continue
+
+            if indexed_dir['mtime_ns'] == dir_mtime_ns:
+                # No run dirs have been added or removed, so only run dirs without a samplesheet are re-checked.
+                run_dirs = [(run_id, os.path.join(sequencer_output_dir, run_id)) for run_id, indexed_run in indexed_dir['runs'].items() if indexed_run['samplesheet_path'] is None]
+                runs = dict(indexed_dir['runs'])
+            else:
+                with os.scandir(sequencer_output_dir) as subdirs:
+                    run_dirs = [(subdir.name, subdir.path) for subdir in subdirs if subdir.is_dir()]
+                runs = {run_id: indexed_dir['runs'][run_id] for run_id, _ in run_dirs if run_id in indexed_dir['runs']}
+                modified = True
+
+            for run_id, run_dir_path in run_dirs:
+                indexed_run = runs.get(run_id, None)
+                if indexed_run is not None and indexed_run['samplesheet_path'] is not None:
+                    continue
+                try:
+                    run_dir_mtime_ns = os.stat(run_dir_path).st_mtime_ns
+                except FileNotFoundError as e:
+                    runs.pop(run_id, None)
+                    modified = True
+                    continue
+                if indexed_run is not None and indexed_run['run_dir_mtime_ns'] == run_dir_mtime_ns:
+                    continue
+                runs[run_id] = {
+                    'run_dir_mtime_ns': run_dir_mtime_ns,
+                    'samplesheet_path': find_samplesheet(run_dir_path),
+                }
+                if indexed_run is None:
+                    num_runs_added += 1
+                modified = True
+            samplesheet_index['sequencer_output_dirs'][sequencer_output_dir] = {'mtime_ns': dir_mtime_ns, 'runs': runs}
+
+        if modified:
+            samplesheet_index_path = get_samplesheet_index_path(config)
+            with leases.lease(config, 'samplesheet-index', wait_seconds=None):
+                with writers.atomic_writer(samplesheet_index_path) as f:
+                    json.dump(samplesheet_index, f)
+            logging.info(json.dumps({"event_type": "samplesheet_index_updated", "samplesheet_index_file": samplesheet_index_path, "num_runs_added": num_runs_added}))
+
+    return samplesheet_index
+
+
+def find_samplesheet_for_run(config, run_id):
     """
-    samplesheets = []
-    samplesheet_path = None
+    Look up a run's samplesheet in the samplesheet index. The sequencer output dirs are not scanned
+    here, except when the index hasn't been loaded yet.
 
-    sequencer_run_dir = ""
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Path to the run's samplesheet, or None if it wasn't found.
+    :rtype: Optional[str]
+    """
+    if len(get_sequencer_output_dirs(config)) == 0:
+        return None
 
-    for run_dir in os.listdir(sequencer_output_dir):
-        if os.path.basename(run_dir) == run_id:
-            sequencer_run_dir = os.path.join(sequencer_output_dir, run_dir)
-            samplesheet_glob = os.path.join(sequencer_run_dir, 'sample_sheet_*.csv')
-            samplesheets = glob.glob(samplesheet_glob)
+    samplesheet_index = _samplesheet_index
+    if samplesheet_index is None:
+        samplesheet_index = update_samplesheet_index(config)
 
-        if len(samplesheets) == 1:
-            samplesheet_path = samplesheets[0]
+    for sequencer_output_dir in get_sequencer_output_dirs(config):
+        indexed_run = samplesheet_index['sequencer_output_dirs'].get(sequencer_output_dir, {'runs': {}})['runs'].get(run_id, None)
+        if indexed_run is not None and indexed_run['samplesheet_path'] is not None:
+            return indexed_run['samplesheet_path']
 
-    return samplesheet_path
+    return None
 
 
 def parse_samplesheet(samplesheet_path):
     """
+    Parse a MinKNOW samplesheet. Parsed samplesheets are cached, and only re-parsed when their size or modification time changes.
+
+    :param samplesheet_path: Path to the 'sample_sheet_*.csv' file.
+    :type samplesheet_path: str
+    :return: One record per library. Keys: ['library_id', 'project_id', 'barcode']. 'project_id' and 'barcode' are None if not present.
+    :rtype: list[dict[str, Optional[str]]]
     """
+    stat = os.stat(samplesheet_path)
+    with _parsed_samplesheets_lock:
+        cached = _parsed_samplesheets.get(samplesheet_path, None)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['samplesheet']
+
     samplesheet = []
+    with open(samplesheet_path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        fieldnames = {fieldname.strip().lower(): fieldname for fieldname in (reader.fieldnames or [])}
+        library_id_column = next((fieldnames[column] for column in LIBRARY_ID_COLUMNS if column in fieldnames), None)
+        project_id_column = next((fieldnames[column] for column in PROJECT_ID_COLUMNS if column in fieldnames), None)
+        barcode_column = fieldnames.get('barcode', None)
+        if library_id_column is None:
+            logging.warning(json.dumps({"event_type": "parse_samplesheet_failed", "samplesheet_path": samplesheet_path, "reason": "No library ID column"}))
+        else:
+            for row in reader:
+                library_id = (row[library_id_column] or '').strip()
+                if library_id == '':
+                    continue
+                project_id = None
+                if project_id_column is not None and (row[project_id_column] or '').strip() != '':
+                    project_id = row[project_id_column].strip()
+                barcode = None
+                if barcode_column is not None and (row[barcode_column] or '').strip() != '':
+                    barcode = row[barcode_column].strip()
+                samplesheet.append({
+                    'library_id': library_id,
+                    'project_id': project_id,
+                    'barcode': barcode,
+                })
+
+    with _parsed_samplesheets_lock:
+        _parsed_samplesheets[samplesheet_path] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'samplesheet': samplesheet,
+        }
+
     return samplesheet
+
+
+def get_library_projects(config, run_id):
+    """
+    Find the project for each library in a run, from the run's samplesheet and the project definitions.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Project for each library in the samplesheet that has a project ID, by library ID.
+             Keys: ['project_id', 'project_species_name', 'fixed_genome_size', 'genome_size_mb']. Only 'project_id'
+             is guaranteed; it is the translated project ID if the project has one.
+    :rtype: dict[str, dict[str, object]]
+    """
+    samplesheet_path = find_samplesheet_for_run(config, run_id)
+    if samplesheet_path is None:
+        if len(get_sequencer_output_dirs(config)) > 0:
+            # Only run dirs directly within a sequencer output dir are searched, so runs in nested layouts aren't found.
+            logging.warning(json.dumps({"event_type": "samplesheet_not_found", "sequencing_run_id": run_id, "sequencer_output_dirs": get_sequencer_output_dirs(config)}))
+        return {}
+    try:
+        samplesheet = parse_samplesheet(samplesheet_path)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "parse_samplesheet_failed", "samplesheet_path": samplesheet_path, "error": repr(e)}))
+        return {}
+
+    projects = config.get('projects', {})
+    library_projects = {}
+    for library in samplesheet:
+        if library['project_id'] is None:
+            continue
+        library_project = {'project_id': library['project_id']}
+        project = projects.get(library['project_id'], None)
+        if project is not None:
+            library_project['project_id'] = project.get('translated_project_id', project['samplesheet_project_id'])
+            for field in ['project_species_name', 'fixed_genome_size', 'genome_size_mb']:
+                if field in project:
+                    library_project[field] = project[field]
+        library_projects[library['library_id']] = library_project
+
+    return library_projects
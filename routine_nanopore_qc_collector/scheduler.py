@@ -0,0 +1,261 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+import routine_nanopore_qc_collector.metrics as metrics
+
+
+DEFAULT_RETRY_INITIAL_BACKOFF_SECONDS = 60.0
+DEFAULT_RETRY_MAX_BACKOFF_SECONDS = 3600.0
+DEFAULT_RETRY_MAX_ATTEMPTS = 8
+DEFAULT_QUEUE_REFRESH_INTERVAL_SECONDS = 60.0
+
+
+def init_scheduler_state():
+    """
+    :return: Scheduler state, kept for the life of the process. Keys: ['queue', 'sequence', 'retries']. 'retries' is keyed by run ID;
+             the per-run keys are ['num_attempts', 'next_attempt_timestamp', 'reason', 'routine_nanopore_qc_output_path'] (see `record_result`).
+    :rtype: dict[str, object]
+    """
+    return {
+        'queue': [],
+        'sequence': itertools.count(),
+        'retries': {},
+    }
+
+
+def get_run_start(run_id):
+    """
+    :param run_id: Sequencing run ID (eg. '20230131_1530_X1_FAV12345_a1b2c3d4').
+    :type run_id: str
+    :return: Run start time as an int (eg. 202301311530), or 0 if the run ID doesn't start with a date and time.
+    :rtype: int
+    """
+    try:
+        return int(run_id[0:8] + run_id[9:13])
+    except ValueError as e:
+        return 0
+
+
+def get_run_priority(config, run_id, sequencer_type):
+    """
+    Runs are collected in order of sequencer priority (highest first), then start time (newest first).
+    Sequencer priorities are set by 'sequencer_priority' in the config (eg. {"promethion": 1, "gridion": 0}),
+    and default to 0.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param sequencer_type: 'gridion' or 'promethion'.
+    :type sequencer_type: Optional[str]
+    :return: Sort key. Runs with lower keys are collected first.
+    :rtype: tuple[float, int, str]
+    """
+    sequencer_priority = config.get('sequencer_priority', {}).get(sequencer_type, 0)
+
+    return (-float(sequencer_priority), -get_run_start(run_id), run_id)
+
+
+def get_retry_backoff_seconds(config, num_attempts):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param num_attempts: Number of attempts made so far.
+    :type num_attempts: int
+    :return: Delay before the next attempt. Doubles with each attempt, up to 'retry_max_backoff_seconds'.
+    :rtype: float
+    """
+    initial_backoff_seconds = float(config.get('retry_initial_backoff_seconds', DEFAULT_RETRY_INITIAL_BACKOFF_SECONDS))
+    max_backoff_seconds = float(config.get('retry_max_backoff_seconds', DEFAULT_RETRY_MAX_BACKOFF_SECONDS))
+
+    return min(initial_backoff_seconds * (2 ** (num_attempts - 1)), max_backoff_seconds)
+
+
+def is_retries_exhausted(retry, analysis_dir):
+    """
+    :param retry: The run's retry state, as recorded by `record_result`.
+    :type retry: dict[str, object]
+    :param analysis_dir: Analysis dir for the run.
+    :type analysis_dir: dict[str, str]
+    :return: Whether the run has used up its retries, and its latest routine-nanopore-qc output dir hasn't changed since.
+    :rtype: bool
+    """
+    return retry['next_attempt_timestamp'] is None and retry.get('routine_nanopore_qc_output_path', None) == analysis_dir.get('routine_nanopore_qc_output_path', None)
+
+
+def enqueue(config, scheduler_state, analysis_dirs, skip_run_ids=None):
+    """
+    Add analysis dirs to the collection queue. Runs waiting for a retry are held back until the retry is due.
+    Runs that have used up their retries are not added again, unless their latest routine-nanopore-qc output dir
+    changes (eg. the analysis is re-run).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scheduler_state: Scheduler state, as returned by `init_scheduler_state`. Updated in place.
+    :type scheduler_state: dict[str, object]
+    :param analysis_dirs: Analysis dirs, as yielded by `core.scan`. None values are skipped.
+    :type analysis_dirs: Iterator[Optional[dict[str, str]]]
+    :param skip_run_ids: IDs of runs not to add (eg. runs already collected since the queue was last filled).
+    :type skip_run_ids: Optional[set[str]]
+    :return: Number of runs added to the queue.
+    :rtype: int
+    """
+    queued_run_ids = set(run_id for _, _, run_id, _, _ in scheduler_state['queue'])
+    if skip_run_ids is not None:
+        queued_run_ids |= skip_run_ids
+    now = time.time()
+    num_enqueued = 0
+    for analysis_dir in analysis_dirs:
+        if analysis_dir is None:
+            continue
+        run_id = os.path.basename(analysis_dir['path'])
+        if run_id in queued_run_ids:
+            continue
+        retry = scheduler_state['retries'].get(run_id, None)
+        if retry is not None and retry['next_attempt_timestamp'] is not None and retry['next_attempt_timestamp'] > now:
+            logging.debug(json.dumps({"event_type": "run_retry_deferred", "sequencing_run_id": run_id, "num_attempts": retry['num_attempts'], "next_attempt_timestamp": retry['next_attempt_timestamp']}))
+            continue
+        if retry is not None and is_retries_exhausted(retry, analysis_dir):
+            logging.debug(json.dumps({"event_type": "run_retries_exhausted_skipped", "sequencing_run_id": run_id, "num_attempts": retry['num_attempts']}))
+            continue
+        priority = get_run_priority(config, run_id, analysis_dir.get('sequencer_type', None))
+        heapq.heappush(scheduler_state['queue'], (priority, next(scheduler_state['sequence']), run_id, now, analysis_dir))
+        queued_run_ids.add(run_id)
+        num_enqueued += 1
+
+    metrics.set_gauge('queue_depth', len(scheduler_state['queue']))
+    logging.info(json.dumps({"event_type": "runs_enqueued", "num_runs_enqueued": num_enqueued, "queue_depth": len(scheduler_state['queue'])}))
+
+    return num_enqueued
+
+
+def get_queue_refresh_interval_seconds(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: How often runs are re-discovered while the queue is being worked through ('queue_refresh_interval_seconds' in the config).
+    :rtype: float
+    """
+    return float(config.get('queue_refresh_interval_seconds', DEFAULT_QUEUE_REFRESH_INTERVAL_SECONDS))
+
+
+def iter_queue(scheduler_state, config=None, find_analysis_dirs=None):
+    """
+    Remove analysis dirs from the collection queue in priority order (see `get_run_priority`),
+    recording how long each spent waiting.
+
+    If `find_analysis_dirs` is supplied, it is called every 'queue_refresh_interval_seconds' until the queue is empty,
+    and the runs it finds are added to the queue, so that a run that completes while a long queue is being worked
+    through is collected in priority order, rather than after the queue is empty. Runs already removed from the
+    queue by this call are not added again.
+
+    :param scheduler_state: Scheduler state, as returned by `init_scheduler_state`. Updated in place.
+    :type scheduler_state: dict[str, object]
+    :param config: Application config. Required if `find_analysis_dirs` is supplied.
+    :type config: Optional[dict[str, object]]
+    :param find_analysis_dirs: Function that re-discovers the analysis dirs that are ready to collect (eg. `core.scan`).
+    :type find_analysis_dirs: Optional[Callable[[], Iterator[Optional[dict[str, str]]]]]
+    :return: Analysis dirs, in the order they should be collected.
+    :rtype: Iterator[dict[str, str]]
+    """
+    dequeued_run_ids = set()
+    next_refresh_timestamp = None
+    if find_analysis_dirs is not None:
+        next_refresh_timestamp = time.monotonic() + get_queue_refresh_interval_seconds(config)
+    while len(scheduler_state['queue']) > 0:
+        if next_refresh_timestamp is not None and time.monotonic() >= next_refresh_timestamp:
+            num_enqueued = enqueue(config, scheduler_state, find_analysis_dirs(), dequeued_run_ids)
+            logging.info(json.dumps({"event_type": "queue_refreshed", "num_runs_enqueued": num_enqueued, "queue_depth": len(scheduler_state['queue'])}))
+            next_refresh_timestamp = time.monotonic() + get_queue_refresh_interval_seconds(config)
+        _, _, run_id, enqueued_timestamp, analysis_dir = heapq.heappop(scheduler_state['queue'])
+        dequeued_run_ids.add(run_id)
+        wait_seconds = time.time() - enqueued_timestamp
+        metrics.set_gauge('queue_depth', len(scheduler_state['queue']))
+        metrics.observe('queue_wait_seconds', wait_seconds, sequencer_type=analysis_dir.get('sequencer_type', None))
+        logging.info(json.dumps({"event_type": "run_dequeued", "sequencing_run_id": run_id, "queue_wait_seconds": round(wait_seconds, 3), "queue_depth": len(scheduler_state['queue'])}))
+        yield analysis_dir
+
+
+def record_result(config, scheduler_state, analysis_dir, collect_outputs_summary=None, error=None):
+    """
+    Record the result of collecting a run. Runs that failed, or that have libraries with missing source
+    files, are retried with exponential backoff (see `get_retry_backoff_seconds`), up to 'retry_max_attempts'
+    times. After that, they are not queued again (see `enqueue`) until their latest routine-nanopore-qc output
+    dir changes, when a new series of retries starts, or the collector is restarted.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scheduler_state: Scheduler state, as returned by `init_scheduler_state`. Updated in place.
+    :type scheduler_state: dict[str, object]
+    :param analysis_dir: Analysis dir that was collected.
+    :type analysis_dir: dict[str, str]
+    :param collect_outputs_summary: Summary returned by `core.collect_outputs`, or None if it raised.
+    :type collect_outputs_summary: Optional[dict[str, object]]
+    :param error: Exception raised by `core.collect_outputs`, if any.
+    :type error: Optional[Exception]
+    :return: None
+    :rtype: NoneType
+    """
+    run_id = os.path.basename(analysis_dir['path'])
+    if error is not None:
+        reason = 'collect_failed'
+    elif collect_outputs_summary is not None and len(collect_outputs_summary.get('incomplete_library_ids', [])) > 0:
+        reason = 'incomplete_libraries'
+    else:
+        if scheduler_state['retries'].pop(run_id, None) is not None:
+            logging.info(json.dumps({"event_type": "run_retry_succeeded", "sequencing_run_id": run_id}))
+        metrics.set_gauge('runs_pending_retry', get_num_pending_retries(scheduler_state))
+        return
+
+    routine_nanopore_qc_output_path = analysis_dir.get('routine_nanopore_qc_output_path', None)
+    retry = scheduler_state['retries'].get(run_id, None)
+    if retry is None or retry.get('routine_nanopore_qc_output_path', None) != routine_nanopore_qc_output_path:
+        retry = {'num_attempts': 0, 'next_attempt_timestamp': None, 'routine_nanopore_qc_output_path': routine_nanopore_qc_output_path}
+    num_attempts = retry['num_attempts'] + 1
+    max_attempts = int(config.get('retry_max_attempts', DEFAULT_RETRY_MAX_ATTEMPTS))
+    if retry['num_attempts'] >= max_attempts:
+        # Retries are exhausted. The run stays in the retry state (with no next attempt), so that
+        # later full scans don't start a new series of retries.
+        if retry['next_attempt_timestamp'] is not None:
+            logging.warning(json.dumps({"event_type": "run_retries_exhausted", "sequencing_run_id": run_id, "num_attempts": retry['num_attempts'], "reason": reason}))
+        retry['next_attempt_timestamp'] = None
+        scheduler_state['retries'][run_id] = retry
+    else:
+        backoff_seconds = get_retry_backoff_seconds(config, num_attempts)
+        scheduler_state['retries'][run_id] = {
+            'num_attempts': num_attempts,
+            'next_attempt_timestamp': time.time() + backoff_seconds,
+            'reason': reason,
+            'routine_nanopore_qc_output_path': routine_nanopore_qc_output_path,
+        }
+        metrics.increment_counter('run_retries_total', reason=reason)
+        logging.info(json.dumps({"event_type": "run_retry_scheduled", "sequencing_run_id": run_id, "num_attempts": num_attempts, "backoff_seconds": backoff_seconds, "reason": reason}))
+    metrics.set_gauge('runs_pending_retry', get_num_pending_retries(scheduler_state))
+
+
+def get_num_pending_retries(scheduler_state):
+    """
+    :param scheduler_state: Scheduler state, as returned by `init_scheduler_state`.
+    :type scheduler_state: dict[str, object]
+    :return: Number of runs with a retry scheduled.
+    :rtype: int
+    """
+    return len([retry for retry in scheduler_state['retries'].values() if retry['next_attempt_timestamp'] is not None])
+
+
+def get_seconds_until_next_retry(scheduler_state):
+    """
+    :param scheduler_state: Scheduler state, as returned by `init_scheduler_state`.
+    :type scheduler_state: dict[str, object]
+    :return: Seconds until the earliest scheduled retry is due (0 if it is already due), or None if no retries are scheduled.
+    :rtype: Optional[float]
+    """
+    next_attempt_timestamps = [retry['next_attempt_timestamp'] for retry in scheduler_state['retries'].values() if retry['next_attempt_timestamp'] is not None]
+    if len(next_attempt_timestamps) == 0:
+        return None
+
+    return max(min(next_attempt_timestamps) - time.time(), 0.0)
@@ -0,0 +1,556 @@
+"""
+Running per-species baselines for library QC metrics, used to flag libraries whose metrics are
+unusual for their inferred species.
+
+For each species and metric, the baseline holds the count, mean and sum of squared deviations
+(updated with Welford's algorithm), and a sketch of the distribution: a histogram with logarithmically
+sized bins, each covering values within SKETCH_RELATIVE_ACCURACY of each other. Adding or removing a
+library is O(1), and the number of bins is bounded by the range of the metric rather than the number
+of libraries. Each species' baselines are kept in their own file, so that collecting a run only reads and
+re-writes the species found in it. The values that each library contributed are kept in a file per run, so
+that a re-collected library replaces its previous contribution rather than being counted twice.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import urllib.parse
+
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.metrics as metrics
+import routine_nanopore_qc_collector.qc_index as qc_index
+import routine_nanopore_qc_collector.writers as writers
+
+
+SPECIES_BASELINES_VERSION = 3
+
+BASELINE_METRICS = [
+    'read_n50',
+    'median_quality',
+    'num_bases',
+    'inferred_species_estimated_depth',
+]
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+
+DEFAULT_MIN_COUNT = 20
+DEFAULT_ZSCORE_THRESHOLD = 3.0
+
+_species_baselines_lock = threading.Lock()
+
+
+def is_enabled(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Whether library QC records are annotated with species baselines ('species_baselines_enabled' in the config, default false).
+    :rtype: bool
+    """
+    return bool(config.get('species_baselines_enabled', False))
+
+
+def get_species_baselines_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the species baselines file, which records the format of the baselines. The baselines themselves are
+             kept in files named after it (see `get_species_baseline_path`). Defaults to 'species_baselines.json' in the output dir.
+    :rtype: str
+    """
+    return config.get('species_baselines_path', os.path.join(config['output_dir'], 'species_baselines.json'))
+
+
+def get_species_baseline_path(config, species_name):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param species_name: Species name.
+    :type species_name: str
+    :return: Path to the file holding a species' baselines, in a dir named after the species baselines file
+             (eg. 'species_baselines_species/Escherichia%20coli.json').
+    :rtype: str
+    """
+    return os.path.join(os.path.splitext(get_species_baselines_path(config))[0] + '_species', urllib.parse.quote(species_name, safe='') + '.json')
+
+
+def get_pending_update_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the file holding an update that is being applied (see `apply_pending_update`).
+    :rtype: str
+    """
+    return os.path.splitext(get_species_baselines_path(config))[0] + '_pending.json'
+
+
+def init_species_baselines():
+    """
+    :return: Empty species baselines. Keys: ['species']. 'species' holds a baseline (see `init_baseline`) for each metric,
+             by species name and metric, for the species that have been loaded (see `load_species`).
+    :rtype: dict[str, object]
+    """
+    return {
+        'species': {},
+    }
+
+
+def init_baseline():
+    """
+    :return: Empty baseline for one metric. Keys: ['count', 'mean', 'm2', 'zero_count', 'bins']. 'bins' holds sketch bin counts, by bin index (as a str).
+    :rtype: dict[str, object]
+    """
+    return {
+        'count': 0,
+        'mean': 0.0,
+        'm2': 0.0,
+        'zero_count': 0,
+        'bins': {},
+    }
+
+
+def get_bin_index(value):
+    """
+    :param value: Metric value, greater than 0.
+    :type value: float
+    :return: Index of the sketch bin that the value falls in. Bin i covers (SKETCH_GAMMA ** (i - 1), SKETCH_GAMMA ** i].
+    :rtype: int
+    """
+    return math.ceil(math.log(value, SKETCH_GAMMA))
+
+
+def add_value(baseline, value):
+    """
+    :param baseline: Baseline, as returned by `init_baseline`. Updated in place.
+    :type baseline: dict[str, object]
+    :param value: Metric value.
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    baseline['count'] += 1
+    delta = value - baseline['mean']
+    baseline['mean'] += delta / baseline['count']
+    baseline['m2'] += delta * (value - baseline['mean'])
+    if value <= 0:
+        baseline['zero_count'] += 1
+    else:
+        bin_index = str(get_bin_index(value))
+        baseline['bins'][bin_index] = baseline['bins'].get(bin_index, 0) + 1
+
+
+def remove_value(baseline, value):
+    """
+    Reverse `add_value`.
+
+    :param baseline: Baseline, as returned by `init_baseline`. Updated in place.
+    :type baseline: dict[str, object]
+    :param value: Metric value that was previously added.
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    if baseline['count'] <= 1:
+        baseline.update(init_baseline())
+        return
+    previous_mean = baseline['mean']
+    baseline['count'] -= 1
+    baseline['mean'] = (previous_mean * (baseline['count'] + 1) - value) / baseline['count']
+    baseline['m2'] = max(baseline['m2'] - (value - previous_mean) * (value - baseline['mean']), 0.0)
+    if value <= 0:
+        baseline['zero_count'] = max(baseline['zero_count'] - 1, 0)
+    else:
+        bin_index = str(get_bin_index(value))
+        bin_count = baseline['bins'].get(bin_index, 0) - 1
+        if bin_count > 0:
+            baseline['bins'][bin_index] = bin_count
+        else:
+            baseline['bins'].pop(bin_index, None)
+
+
+def get_zscore(baseline, value):
+    """
+    :param baseline: Baseline, as returned by `init_baseline`.
+    :type baseline: dict[str, object]
+    :param value: Metric value.
+    :type value: float
+    :return: Number of (sample) standard deviations that the value is from the mean, or None if the baseline has no variance.
+    :rtype: Optional[float]
+    """
+    if baseline['count'] < 2:
+        return None
+    standard_deviation = math.sqrt(baseline['m2'] / (baseline['count'] - 1))
+    if standard_deviation == 0:
+        return None
+
+    return (value - baseline['mean']) / standard_deviation
+
+
+def get_percentile(baseline, value):
+    """
+    :param baseline: Baseline, as returned by `init_baseline`.
+    :type baseline: dict[str, object]
+    :param value: Metric value.
+    :type value: float
+    :return: Percent of the baseline's values that are below the value (counting values in the same sketch bin as half below), or None if the baseline is empty.
+    :rtype: Optional[float]
+    """
+    if baseline['count'] == 0:
+        return None
+    if value <= 0:
+        num_below = baseline['zero_count'] / 2
+    else:
+        value_bin_index = get_bin_index(value)
+        num_below = baseline['zero_count']
+        for bin_index, bin_count in baseline['bins'].items():
+            bin_index = int(bin_index)
+            if bin_index < value_bin_index:
+                num_below += bin_count
+            elif bin_index == value_bin_index:
+                num_below += bin_count / 2
+
+    return 100 * num_below / baseline['count']
+
+
+def get_library_values(library_qc):
+    """
+    :param library_qc: Library QC record.
+    :type library_qc: dict[str, object]
+    :return: Value of each baseline metric, or None where the record has no numeric value.
+    :rtype: list[Optional[float]]
+    """
+    values = []
+    for metric in BASELINE_METRICS:
+        value = library_qc.get(metric, None)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or math.isnan(value):
+            value = None
+        values.append(value)
+
+    return values
+
+
+def add_library(species_baselines, run_libraries, library_id, species_name, values):
+    """
+    :param species_baselines: Species baselines, as returned by `init_species_baselines`. Updated in place.
+    :type species_baselines: dict[str, object]
+    :param run_libraries: The inferred species and metric values that each of the run's libraries contributed, by library ID. Updated in place.
+    :type run_libraries: dict[str, list[object]]
+    :param library_id: Library ID.
+    :type library_id: str
+    :param species_name: Inferred species.
+    :type species_name: str
+    :param values: Values, as returned by `get_library_values`.
+    :type values: list[Optional[float]]
+    :return: None
+    :rtype: NoneType
+    """
+    species_baseline = species_baselines['species'].setdefault(species_name, {})
+    for metric, value in zip(BASELINE_METRICS, values):
+        if value is not None:
+            add_value(species_baseline.setdefault(metric, init_baseline()), value)
+    run_libraries[library_id] = [species_name] + values
+
+
+def remove_library(species_baselines, run_libraries, library_id):
+    """
+    Remove a library's contribution to the baselines, if it has one.
+
+    :param species_baselines: Species baselines, as returned by `init_species_baselines`. Updated in place.
+    :type species_baselines: dict[str, object]
+    :param run_libraries: The inferred species and metric values that each of the run's libraries contributed, by library ID. Updated in place.
+    :type run_libraries: dict[str, list[object]]
+    :param library_id: Library ID.
+    :type library_id: str
+    :return: None
+    :rtype: NoneType
+    """
+    library = run_libraries.pop(library_id, None)
+    if library is None:
+        return
+    species_name, values = library[0], library[1:]
+    species_baseline = species_baselines['species'].get(species_name, {})
+    for metric, value in zip(BASELINE_METRICS, values):
+        if value is not None and metric in species_baseline:
+            remove_value(species_baseline[metric], value)
+
+
+def get_run_contribution_path(config, run_id):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Path to the file holding the run's contribution to the baselines, in a dir named after the species
+             baselines file (eg. 'species_baselines_runs/<run_id>.json').
+    :rtype: str
+    """
+    return os.path.join(os.path.splitext(get_species_baselines_path(config))[0] + '_runs', run_id + '.json')
+
+
+def write_json(dst_path, data):
+    """
+    :param dst_path: Path to write to. Its directory is created if it doesn't exist.
+    :type dst_path: str
+    :param data: Data to write.
+    :type data: object
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with writers.atomic_writer(dst_path) as f:
+        json.dump(data, f, separators=(',', ':'))
+
+
+def load_run_contribution(config, run_id):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: The inferred species and metric values that each of the run's libraries contributed to the baselines,
+             by library ID, or None if the run's contribution file can't be read.
+    :rtype: Optional[dict[str, list[object]]]
+    """
+    try:
+        with open(get_run_contribution_path(config, run_id), 'r') as f:
+            return json.load(f)['libraries']
+    except FileNotFoundError as e:
+        return {}
+    except (json.decoder.JSONDecodeError, KeyError) as e:
+        return None
+
+
+def load_species(config, species_baselines, species_names):
+    """
+    Load the baselines for the given species, if they haven't been loaded already.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param species_baselines: Species baselines, as returned by `load_species_baselines`. Updated in place.
+    :type species_baselines: dict[str, object]
+    :param species_names: Species names.
+    :type species_names: Iterable[str]
+    :return: None
+    :rtype: NoneType
+    """
+    for species_name in species_names:
+        if species_name in species_baselines['species']:
+            continue
+        try:
+            with open(get_species_baseline_path(config, species_name), 'r') as f:
+                species_baselines['species'][species_name] = json.load(f)['baselines']
+        except FileNotFoundError as e:
+            species_baselines['species'][species_name] = {}
+
+
+def save_species(config, species_baselines, species_names):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param species_baselines: Species baselines, as returned by `load_species_baselines`.
+    :type species_baselines: dict[str, object]
+    :param species_names: Species whose baselines are written. They must have been loaded.
+    :type species_names: Iterable[str]
+    :return: None
+    :rtype: NoneType
+    """
+    for species_name in species_names:
+        write_json(get_species_baseline_path(config, species_name), {'species_name': species_name, 'baselines': species_baselines['species'][species_name]})
+
+
+def apply_pending_update(config):
+    """
+    Finish applying the pending update, if there is one. An update is written to the pending update file before
+    any of the species or run contribution files that it changes, and the file is removed once they have all been
+    written, so an update that was interrupted (eg. by the collector crashing) is completed rather than lost or
+    applied twice.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Whether there was a pending update, or None if the pending update file can't be read.
+    :rtype: Optional[bool]
+    """
+    pending_update_path = get_pending_update_path(config)
+    try:
+        with open(pending_update_path, 'r') as f:
+            pending_update = json.load(f)
+    except FileNotFoundError as e:
+        return False
+    except json.decoder.JSONDecodeError as e:
+        return None
+
+    species_baselines = init_species_baselines()
+    species_baselines['species'] = pending_update['species']
+    save_species(config, species_baselines, pending_update['species'].keys())
+    write_json(get_run_contribution_path(config, pending_update['run_id']), {'libraries': pending_update['libraries']})
+    os.remove(pending_update_path)
+
+    return True
+
+
+def load_species_baselines(config):
+    """
+    Prepare the species baselines for an update, completing any update that was interrupted (see `apply_pending_update`).
+    If the baselines don't exist yet (eg. when baselines are first enabled) or are in an older format, they are seeded
+    from the library QC records already in the QC index. Species are loaded as they are needed, with `load_species`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Species baselines. See `init_species_baselines`.
+    :rtype: dict[str, object]
+    """
+    species_baselines_path = get_species_baselines_path(config)
+    try:
+        with open(species_baselines_path, 'r') as f:
+            species_baselines_format = json.load(f)
+        if species_baselines_format.get('species_baselines_version', None) == SPECIES_BASELINES_VERSION and species_baselines_format.get('metrics', None) == BASELINE_METRICS and species_baselines_format.get('sketch_relative_accuracy', None) == SKETCH_RELATIVE_ACCURACY:
+            if apply_pending_update(config) is not None:
+                return init_species_baselines()
+            logging.warning(json.dumps({"event_type": "species_baselines_inconsistent", "pending_update_file": get_pending_update_path(config)}))
+    except FileNotFoundError as e:
+        pass
+    except json.decoder.JSONDecodeError as e:
+        logging.warning(json.dumps({"event_type": "load_species_baselines_failed", "species_baselines_file": species_baselines_path}))
+
+    return seed_species_baselines(config)
+
+
+def seed_species_baselines(config):
+    """
+    Build the species baselines from the library QC records in the QC index, replacing any existing species
+    and run contribution files. The species baselines file is written last, so seeding is repeated if it is interrupted.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Species baselines, with every species loaded. See `init_species_baselines`.
+    :rtype: dict[str, object]
+    """
+    species_baselines_path = get_species_baselines_path(config)
+    if os.path.exists(species_baselines_path):
+        os.remove(species_baselines_path)
+    for dir_suffix in ['_species', '_runs']:
+        shutil.rmtree(os.path.splitext(species_baselines_path)[0] + dir_suffix, ignore_errors=True)
+    if os.path.exists(get_pending_update_path(config)):
+        os.remove(get_pending_update_path(config))
+
+    species_baselines = init_species_baselines()
+    libraries_by_run_id = {}
+    num_libraries = 0
+    for library_qc in qc_index.get_run_records(config, 'library_qc'):
+        species_name = library_qc.get('inferred_species_name', None)
+        if species_name is not None and 'library_id' in library_qc:
+            add_library(species_baselines, libraries_by_run_id.setdefault(library_qc['run_id'], {}), library_qc['library_id'], species_name, get_library_values(library_qc))
+            num_libraries += 1
+    for run_id, run_libraries in libraries_by_run_id.items():
+        write_json(get_run_contribution_path(config, run_id), {'libraries': run_libraries})
+    save_species(config, species_baselines, species_baselines['species'].keys())
+    write_json(species_baselines_path, {
+        'species_baselines_version': SPECIES_BASELINES_VERSION,
+        'metrics': BASELINE_METRICS,
+        'sketch_relative_accuracy': SKETCH_RELATIVE_ACCURACY,
+    })
+    logging.info(json.dumps({"event_type": "species_baselines_seeded", "num_libraries": num_libraries, "num_species": len(species_baselines['species'])}))
+
+    return species_baselines
+
+
+def annotate_library_qc(species_baselines, library_qc, values, min_count, zscore_threshold):
+    """
+    Annotate a library QC record with how its metrics compare to the baselines for its inferred species.
+
+    For each metric, '<metric>_species_zscore' and '<metric>_species_percentile' are added, once the species has
+    at least `min_count` values for the metric. 'species_baseline_outliers' lists the metrics whose z-score is at
+    least `zscore_threshold` in either direction.
+
+    :param species_baselines: Species baselines, as returned by `load_species_baselines`.
+    :type species_baselines: dict[str, object]
+    :param library_qc: Library QC record, with an inferred species. Updated in place.
+    :type library_qc: dict[str, object]
+    :param values: Values, as returned by `get_library_values`.
+    :type values: list[Optional[float]]
+    :param min_count: Number of values that a species needs for a metric to be annotated.
+    :type min_count: int
+    :param zscore_threshold: Z-score at which a metric is listed as an outlier.
+    :type zscore_threshold: float
+    :return: None
+    :rtype: NoneType
+    """
+    species_baseline = species_baselines['species'].get(library_qc['inferred_species_name'], {})
+    outliers = []
+    for metric, value in zip(BASELINE_METRICS, values):
+        baseline = species_baseline.get(metric, None)
+        if value is None or baseline is None or baseline['count'] < min_count:
+            continue
+        zscore = get_zscore(baseline, value)
+        library_qc[metric + '_species_zscore'] = round(zscore, 3) if zscore is not None else None
+        library_qc[metric + '_species_percentile'] = round(get_percentile(baseline, value), 1)
+        if zscore is not None and abs(zscore) >= zscore_threshold:
+            outliers.append(metric)
+            metrics.increment_counter('species_baseline_outliers_total', metric=metric)
+    library_qc['species_baseline_outliers'] = outliers
+
+
+def update_run_library_qc(config, run_id, library_qcs, removed_library_ids):
+    """
+    Annotate a run's newly collected library QC records (see `annotate_library_qc`), then add them to the baselines
+    for their inferred species. Each library is compared against the baselines without its own previous contribution,
+    if it has been collected before. Libraries that are no longer part of the run are removed from the baselines.
+
+    The baselines of the species that the run contributes to are re-read, updated and re-written while holding the
+    'species-baselines' lease, so that updates from collectors on other nodes are kept. Thresholds are 'species_baseline_min_count' (default: 20) and
+    'species_baseline_zscore_threshold' (default: 3.0) in the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param library_qcs: Library QC records, as returned by `core.collect_library_qc`. Updated in place.
+    :type library_qcs: list[dict[str, object]]
+    :param removed_library_ids: IDs of libraries that are no longer part of the run.
+    :type removed_library_ids: Iterable[str]
+    :return: None
+    :rtype: NoneType
+    """
+    min_count = int(config.get('species_baseline_min_count', DEFAULT_MIN_COUNT))
+    zscore_threshold = float(config.get('species_baseline_zscore_threshold', DEFAULT_ZSCORE_THRESHOLD))
+    with _species_baselines_lock, leases.lease(config, 'species-baselines', wait_seconds=None):
+        species_baselines = load_species_baselines(config)
+        run_libraries = load_run_contribution(config, run_id)
+        if run_libraries is None:
+            logging.warning(json.dumps({"event_type": "species_baselines_inconsistent", "sequencing_run_id": run_id, "run_contribution_file": get_run_contribution_path(config, run_id)}))
+            species_baselines = seed_species_baselines(config)
+            run_libraries = load_run_contribution(config, run_id)
+        previous_run_libraries = dict(run_libraries)
+
+        # Only the species that the run's libraries contributed to, or will contribute to, are read.
+        species_names = set(library[0] for library in run_libraries.values())
+        species_names |= set(library_qc['inferred_species_name'] for library_qc in library_qcs if library_qc.get('inferred_species_name', None) is not None)
+        load_species(config, species_baselines, species_names)
+
+        for library_id in removed_library_ids:
+            remove_library(species_baselines, run_libraries, library_id)
+        for library_qc in library_qcs:
+            if 'library_id' not in library_qc:
+                continue
+            remove_library(species_baselines, run_libraries, library_qc['library_id'])
+            if library_qc.get('inferred_species_name', None) is None:
+                continue
+            values = get_library_values(library_qc)
+            annotate_library_qc(species_baselines, library_qc, values, min_count, zscore_threshold)
+            add_library(species_baselines, run_libraries, library_qc['library_id'], library_qc['inferred_species_name'], values)
+
+        if run_libraries == previous_run_libraries:
+            return
+        changed_species_names = set()
+        for library_id in set(run_libraries.keys()) | set(previous_run_libraries.keys()):
+            if run_libraries.get(library_id, None) != previous_run_libraries.get(library_id, None):
+                changed_species_names |= set(library[0] for library in [run_libraries.get(library_id, None), previous_run_libraries.get(library_id, None)] if library is not None)
+        write_json(get_pending_update_path(config), {
+            'run_id': run_id,
+            'libraries': run_libraries,
+            'species': {species_name: species_baselines['species'][species_name] for species_name in changed_species_names},
+        })
+        apply_pending_update(config)
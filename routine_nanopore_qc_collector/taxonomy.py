@@ -0,0 +1,606 @@
+import array
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import routine_nanopore_qc_collector.leases as leases
+import routine_nanopore_qc_collector.metrics as metrics
+import routine_nanopore_qc_collector.writers as writers
+
+
+def resolve_genera_taxonkit(taxids, taxonkit_data_dir=None):
+    """
+    Look up the genus for a collection of NCBI taxonomy IDs using a single
+    `taxonkit reformat` invocation, with the taxids supplied over stdin.
+
+    :param taxids: NCBI taxonomy IDs to resolve. Duplicates and '0' (unclassified) are ignored.
+    :type taxids: Iterable[str]
+    :param taxonkit_data_dir: Directory containing the NCBI taxdump files. If None, taxonkit's default is used.
+    :type taxonkit_data_dir: Optional[str]
+    :return: Genus details by taxid. Keys: ['genus_taxon_name', 'genus_ncbi_taxonomy_id']
+    :rtype: dict[str, dict[str, str]]
+    """
+    genera_by_taxid = {}
+    unique_taxids = sorted(set(str(taxid) for taxid in taxids) - {'0'})
+    if len(unique_taxids) == 0:
+        return genera_by_taxid
+
+    taxonkit_cmd = [
+        'taxonkit',
+        'reformat',
+        '-F',
+        '-I', '1',
+        '-f', '"{g}|{s}"',
+        '-t',
+    ]
+    if taxonkit_data_dir is not None:
+        taxonkit_cmd += ['--data-dir', taxonkit_data_dir]
+
+    taxonkit_input = '\n'.join(unique_taxids) + '\n'
+    try:
+        taxonkit_result = subprocess.run(taxonkit_cmd, input=taxonkit_input, text=True, capture_output=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        logging.error(json.dumps({"event_type": "resolve_genera_failed", "num_taxids": len(unique_taxids), "error": str(e)}))
+        return genera_by_taxid
+
+    for line in taxonkit_result.stdout.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 3:
+            continue
+        taxid = fields[0]
+        taxonkit_output = list(map(lambda x: x.strip('"'), fields[1:]))
+        genera_by_taxid[taxid] = {
+            'genus_taxon_name': taxonkit_output[0].split('|')[0],
+            'genus_ncbi_taxonomy_id': taxonkit_output[1].split('|')[0],
+        }
+
+    logging.debug(json.dumps({"event_type": "resolve_genera_complete", "num_taxids": len(unique_taxids), "num_resolved": len(genera_by_taxid)}))
+
+    return genera_by_taxid
+
+
+TAXONOMY_INDEX_MAGIC = b'RNQCTAX1'
+
+TAXDUMP_FILES = ['nodes.dmp', 'names.dmp', 'merged.dmp']
+
+# Ranks above genus, used to name a missing genus the same way `taxonkit reformat -F` does
+# (eg. 'unclassified Enterobacteriaceae genus').
+RANKS_ABOVE_GENUS = {
+    'family',
+    'order',
+    'class',
+    'phylum',
+    'kingdom',
+    'superkingdom',
+    'domain',
+}
+
+_loaded_taxonomies = {}
+_taxonomy_lock = threading.Lock()
+
+_genus_cache_connections = {}
+_genus_cache_lock = threading.Lock()
+_genus_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def get_default_taxdump_dir(config):
+    """
+    Find the directory containing the NCBI taxdump files. Uses 'taxdump_dir' from the config if it is set,
+    then 'taxonkit_data_dir', then taxonkit's default location (~/.taxonkit).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to taxdump dir.
+    :rtype: str
+    """
+    if 'taxdump_dir' in config:
+        return config['taxdump_dir']
+    if 'taxonkit_data_dir' in config:
+        return config['taxonkit_data_dir']
+
+    return os.path.join(os.path.expanduser('~'), '.taxonkit')
+
+
+def get_taxdump_fingerprint(taxdump_dir):
+    """
+    Summarize the size and modification time of each taxdump file, so that changes to the
+    taxonomy database can be detected without reading it.
+
+    :param taxdump_dir: Directory containing 'nodes.dmp', 'names.dmp' and (optionally) 'merged.dmp'.
+    :type taxdump_dir: str
+    :return: Fingerprint. Keys are taxdump filenames, values are [size, mtime_ns]. None if the required files don't exist.
+    :rtype: Optional[dict[str, list[int]]]
+    """
+    fingerprint = {}
+    for taxdump_file in TAXDUMP_FILES:
+        try:
+            stat = os.stat(os.path.join(taxdump_dir, taxdump_file))
+            fingerprint[taxdump_file] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError as e:
+            if taxdump_file != 'merged.dmp':
+                return None
+
+    return fingerprint
+
+
+def get_taxonkit_data_fingerprint(config):
+    """
+    Summarize the size and modification time of each file in taxonkit's data dir ('taxonkit_data_dir' in the config,
+    then $TAXONKIT_DB, then ~/.taxonkit), for when there is no taxdump to fingerprint and genera are resolved by `taxonkit`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Fingerprint. Keys are filenames, values are [size, mtime_ns]. Empty if the dir doesn't exist.
+    :rtype: dict[str, list[int]]
+    """
+    taxonkit_data_dir = config.get('taxonkit_data_dir', os.environ.get('TAXONKIT_DB', os.path.join(os.path.expanduser('~'), '.taxonkit')))
+    fingerprint = {}
+    try:
+        with os.scandir(taxonkit_data_dir) as taxonkit_data_dir_contents:
+            for entry in taxonkit_data_dir_contents:
+                if entry.is_file():
+                    stat = entry.stat()
+                    fingerprint[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError as e:
+        pass
+
+    return fingerprint
+
+
+def get_genus_cache_fingerprint(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Fingerprint of the taxonomy data that genera are resolved from: the taxdump's (see `get_taxdump_fingerprint`),
+             or if there is no taxdump, taxonkit's data dir (see `get_taxonkit_data_fingerprint`).
+    :rtype: dict[str, object]
+    """
+    taxdump_fingerprint = get_taxdump_fingerprint(get_default_taxdump_dir(config))
+    if taxdump_fingerprint is not None:
+        return taxdump_fingerprint
+
+    return {'taxonkit_data_dir': get_taxonkit_data_fingerprint(config)}
+
+
+def _parse_dmp_line(line):
+    """
+    """
+    return line.rstrip('\t|\n').split('\t|\t')
+
+
+def build_taxonomy(taxdump_dir):
+    """
+    Parse the NCBI taxdump into array-backed tables indexed by taxid.
+
+    :param taxdump_dir: Directory containing 'nodes.dmp', 'names.dmp' and (optionally) 'merged.dmp'.
+    :type taxdump_dir: str
+    :return: Taxonomy tables. Keys: ['parents', 'ranks', 'rank_names', 'genera', 'name_offsets', 'names', 'merged', 'fingerprint']
+    :rtype: dict[str, object]
+    """
+    logging.info(json.dumps({"event_type": "build_taxonomy_start", "taxdump_dir": taxdump_dir}))
+    fingerprint = get_taxdump_fingerprint(taxdump_dir)
+
+    node_parents = {}
+    node_ranks = {}
+    rank_names = []
+    rank_index_by_name = {}
+    with open(os.path.join(taxdump_dir, 'nodes.dmp'), 'r') as f:
+        for line in f:
+            fields = _parse_dmp_line(line)
+            taxid = int(fields[0])
+            rank_name = fields[2]
+            if rank_name not in rank_index_by_name:
+                rank_index_by_name[rank_name] = len(rank_names)
+                rank_names.append(rank_name)
+            node_parents[taxid] = int(fields[1])
+            node_ranks[taxid] = rank_index_by_name[rank_name]
+
+    num_taxids = max(node_parents.keys(), default=0) + 1
+    parents = array.array('I', bytes(4 * num_taxids))
+    ranks = array.array('B', bytes(num_taxids))
+    for taxid, parent in node_parents.items():
+        parents[taxid] = parent
+        ranks[taxid] = node_ranks[taxid]
+    del node_parents, node_ranks
+
+    scientific_names = {}
+    with open(os.path.join(taxdump_dir, 'names.dmp'), 'r') as f:
+        for line in f:
+            fields = _parse_dmp_line(line)
+            if fields[3] == 'scientific name':
+                scientific_names[int(fields[0])] = fields[1].encode('utf-8')
+
+    name_offsets = array.array('I', bytes(4 * (num_taxids + 1)))
+    names = bytearray()
+    for taxid in range(num_taxids):
+        name_offsets[taxid] = len(names)
+        names += scientific_names.get(taxid, b'')
+    name_offsets[num_taxids] = len(names)
+    del scientific_names
+
+    merged = {}
+    merged_path = os.path.join(taxdump_dir, 'merged.dmp')
+    if os.path.exists(merged_path):
+        with open(merged_path, 'r') as f:
+            for line in f:
+                fields = _parse_dmp_line(line)
+                merged[int(fields[0])] = int(fields[1])
+
+    # Pre-compute the genus of every node so that lookups don't need to walk the tree.
+    # Each walk goes up from a node until it reaches a genus, the root, or an ancestor
+    # that has already been resolved, then assigns the result to every node on the path.
+    genus_rank = rank_index_by_name.get('genus', None)
+    genera = array.array('I', bytes(4 * num_taxids))
+    resolved = bytearray(num_taxids)
+    for taxid in range(1, num_taxids):
+        if resolved[taxid] or parents[taxid] == 0:
+            continue
+        path = []
+        genus_taxid = 0
+        node = taxid
+        while True:
+            if resolved[node]:
+                genus_taxid = genera[node]
+                break
+            path.append(node)
+            if ranks[node] == genus_rank:
+                genus_taxid = node
+                break
+            parent = parents[node]
+            if parent == node or parent == 0:
+                break
+            node = parent
+        for node in path:
+            genera[node] = genus_taxid
+            resolved[node] = 1
+
+    taxonomy = {
+        'parents': parents,
+        'ranks': ranks,
+        'rank_names': rank_names,
+        'genera': genera,
+        'name_offsets': name_offsets,
+        'names': bytes(names),
+        'merged': merged,
+        'fingerprint': fingerprint,
+    }
+    logging.info(json.dumps({"event_type": "build_taxonomy_complete", "taxdump_dir": taxdump_dir, "num_taxids": num_taxids}))
+
+    return taxonomy
+
+
+def write_taxonomy_index(taxonomy, index_path):
+    """
+    Write the taxonomy tables to a binary index file that can be memory-mapped by `read_taxonomy_index`.
+    The file is written atomically (see `writers.atomic_writer`).
+
+    :param taxonomy: Taxonomy tables, as returned by `build_taxonomy`.
+    :type taxonomy: dict[str, object]
+    :param index_path: Path to write the index to.
+    :type index_path: str
+    :return: None
+    :rtype: NoneType
+    """
+    num_taxids = len(taxonomy['parents'])
+    metadata = {
+        'num_taxids': num_taxids,
+        'names_length': len(taxonomy['names']),
+        'byteorder': sys.byteorder,
+        'rank_names': taxonomy['rank_names'],
+        'merged': sorted(taxonomy['merged'].items()),
+        'fingerprint': taxonomy['fingerprint'],
+    }
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+    padding = -(len(TAXONOMY_INDEX_MAGIC) + 8 + len(metadata_bytes)) % 8
+
+    with writers.atomic_writer(index_path, binary=True) as f:
+        f.write(TAXONOMY_INDEX_MAGIC)
+        f.write(len(metadata_bytes).to_bytes(8, 'little'))
+        f.write(metadata_bytes)
+        f.write(b'\0' * padding)
+        for table in ['parents', 'genera', 'name_offsets', 'ranks']:
+            f.write(memoryview(taxonomy[table]).cast('B'))
+        f.write(taxonomy['names'])
+
+    logging.info(json.dumps({"event_type": "write_taxonomy_index_complete", "taxonomy_index_path": index_path}))
+
+
+def read_taxonomy_index(index_path):
+    """
+    Memory-map a binary taxonomy index written by `write_taxonomy_index`. The tables are
+    read lazily from the mapped file rather than copied into memory.
+
+    :param index_path: Path to the index.
+    :type index_path: str
+    :return: Taxonomy tables, or None if the file is not a valid index for this platform.
+    :rtype: Optional[dict[str, object]]
+    """
+    with open(index_path, 'rb') as f:
+        index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_length = len(TAXONOMY_INDEX_MAGIC) + 8
+    if index_mmap[0:len(TAXONOMY_INDEX_MAGIC)] != TAXONOMY_INDEX_MAGIC:
+        return None
+    metadata_length = int.from_bytes(index_mmap[len(TAXONOMY_INDEX_MAGIC):header_length], 'little')
+    metadata = json.loads(index_mmap[header_length:header_length + metadata_length])
+    if metadata['byteorder'] != sys.byteorder:
+        return None
+
+    num_taxids = metadata['num_taxids']
+    offset = header_length + metadata_length
+    offset += -offset % 8
+    index_view = memoryview(index_mmap)
+    tables = {}
+    for table, item_format, num_items in [('parents', 'I', num_taxids), ('genera', 'I', num_taxids), ('name_offsets', 'I', num_taxids + 1), ('ranks', 'B', num_taxids)]:
+        table_length = num_items * array.array(item_format).itemsize
+        tables[table] = index_view[offset:offset + table_length].cast(item_format)
+        offset += table_length
+    tables['names'] = index_view[offset:offset + metadata['names_length']]
+
+    taxonomy = {
+        'parents': tables['parents'],
+        'ranks': tables['ranks'],
+        'rank_names': metadata['rank_names'],
+        'genera': tables['genera'],
+        'name_offsets': tables['name_offsets'],
+        'names': tables['names'],
+        'merged': {old_taxid: new_taxid for old_taxid, new_taxid in metadata['merged']},
+        'fingerprint': metadata['fingerprint'],
+        'mmap': index_mmap,
+    }
+
+    return taxonomy
+
+
+def load_taxonomy(taxdump_dir, index_path=None):
+    """
+    Load the taxonomy tables for a taxdump directory. If an index path is supplied, the index is
+    memory-mapped when it matches the current taxdump, and (re-)built from the taxdump otherwise.
+
+    :param taxdump_dir: Directory containing 'nodes.dmp', 'names.dmp' and (optionally) 'merged.dmp'.
+    :type taxdump_dir: str
+    :param index_path: Path to a binary taxonomy index.
+    :type index_path: Optional[str]
+    :return: Taxonomy tables.
+    :rtype: dict[str, object]
+    """
+    fingerprint = get_taxdump_fingerprint(taxdump_dir)
+    if index_path is not None and os.path.exists(index_path):
+        try:
+            taxonomy = read_taxonomy_index(index_path)
+        except (OSError, ValueError) as e:
+            taxonomy = None
+        if taxonomy is not None and taxonomy['fingerprint'] == fingerprint:
+            logging.info(json.dumps({"event_type": "taxonomy_index_loaded", "taxonomy_index_path": index_path}))
+            return taxonomy
+        logging.info(json.dumps({"event_type": "taxonomy_index_stale", "taxonomy_index_path": index_path}))
+
+    taxonomy = build_taxonomy(taxdump_dir)
+    if index_path is not None:
+        write_taxonomy_index(taxonomy, index_path)
+
+    return taxonomy
+
+
+def get_taxon_name(taxonomy, taxid):
+    """
+    :param taxonomy: Taxonomy tables.
+    :type taxonomy: dict[str, object]
+    :param taxid: NCBI taxonomy ID.
+    :type taxid: int
+    :return: Scientific name of the taxon.
+    :rtype: str
+    """
+    name_offsets = taxonomy['name_offsets']
+    return bytes(taxonomy['names'][name_offsets[taxid]:name_offsets[taxid + 1]]).decode('utf-8')
+
+
+def get_genus(taxonomy, taxid):
+    """
+    Find the genus of a taxon. Mirrors the output of `taxonkit reformat -F -f '{g}' -t`:
+    merged taxids are followed, and when there is no genus in the lineage it is named after
+    the nearest higher rank (eg. 'unclassified Enterobacteriaceae genus') with an empty taxid.
+
+    :param taxonomy: Taxonomy tables.
+    :type taxonomy: dict[str, object]
+    :param taxid: NCBI taxonomy ID.
+    :type taxid: str
+    :return: Genus details. Keys: ['genus_taxon_name', 'genus_ncbi_taxonomy_id']
+    :rtype: dict[str, str]
+    """
+    genus = {
+        'genus_taxon_name': '',
+        'genus_ncbi_taxonomy_id': '',
+    }
+    try:
+        taxid = int(taxid)
+    except ValueError as e:
+        return genus
+    taxid = taxonomy['merged'].get(taxid, taxid)
+    parents = taxonomy['parents']
+    if taxid <= 0 or taxid >= len(parents) or parents[taxid] == 0:
+        return genus
+
+    genus_taxid = taxonomy['genera'][taxid]
+    if genus_taxid != 0:
+        genus['genus_taxon_name'] = get_taxon_name(taxonomy, genus_taxid)
+        genus['genus_ncbi_taxonomy_id'] = str(genus_taxid)
+        return genus
+
+    rank_names = taxonomy['rank_names']
+    ranks = taxonomy['ranks']
+    node = taxid
+    while True:
+        if rank_names[ranks[node]] in RANKS_ABOVE_GENUS:
+            genus['genus_taxon_name'] = 'unclassified ' + get_taxon_name(taxonomy, node) + ' genus'
+            break
+        parent = parents[node]
+        if parent == node or parent == 0:
+            break
+        node = parent
+
+    return genus
+
+
+def get_taxonomy(config):
+    """
+    Get the taxonomy tables for the configured taxdump, loading them only on first use
+    or when the taxdump files have changed since they were loaded.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Taxonomy tables, or None if no taxdump is available.
+    :rtype: Optional[dict[str, object]]
+    """
+    taxdump_dir = get_default_taxdump_dir(config)
+    fingerprint = get_taxdump_fingerprint(taxdump_dir)
+    if fingerprint is None:
+        return None
+
+    with _taxonomy_lock:
+        taxonomy = _loaded_taxonomies.get(taxdump_dir, None)
+        if taxonomy is None or taxonomy['fingerprint'] != fingerprint:
+            taxonomy = load_taxonomy(taxdump_dir, config.get('taxonomy_index_path', None))
+            _loaded_taxonomies[taxdump_dir] = taxonomy
+
+    return taxonomy
+
+
+def get_genus_cache_path(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the persistent taxid->genus cache.
+    :rtype: str
+    """
+    return config.get('genus_cache_path', os.path.join(config['output_dir'], 'genus_cache.sqlite'))
+
+
+def open_genus_cache(config, genus_cache_path):
+    """
+    Open (creating if needed) the persistent taxid->genus cache. Connections are kept open
+    and shared for the lifetime of the process. The cache uses SQLite's default rollback journal,
+    so that it can be shared by several nodes (see `leases`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param genus_cache_path: Path to the SQLite cache file.
+    :type genus_cache_path: str
+    :return: Connection to the cache.
+    :rtype: sqlite3.Connection
+    """
+    connection = _genus_cache_connections.get(genus_cache_path, None)
+    if connection is None:
+        connection = sqlite3.connect(genus_cache_path, check_same_thread=False, timeout=60)
+        with leases.lease(config, 'genus-cache', wait_seconds=None):
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS genus (ncbi_taxonomy_id TEXT PRIMARY KEY, genus_taxon_name TEXT, genus_ncbi_taxonomy_id TEXT)")
+            connection.commit()
+        _genus_cache_connections[genus_cache_path] = connection
+
+    return connection
+
+
+def validate_genus_cache(config, connection, taxdump_fingerprint):
+    """
+    Clear the cache if it was populated from a different version of the taxonomy data.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param connection: Connection to the cache.
+    :type connection: sqlite3.Connection
+    :param taxdump_fingerprint: Fingerprint of the current taxonomy data, as returned by `get_genus_cache_fingerprint`.
+    :type taxdump_fingerprint: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    fingerprint = json.dumps(taxdump_fingerprint, sort_keys=True)
+    row = connection.execute("SELECT value FROM metadata WHERE key = 'taxdump_fingerprint'").fetchone()
+    if row is None or row[0] != fingerprint:
+        with leases.lease(config, 'genus-cache', wait_seconds=None), connection:
+            connection.execute("DELETE FROM genus")
+            connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('taxdump_fingerprint', ?)", (fingerprint,))
+        if row is not None:
+            logging.info(json.dumps({"event_type": "genus_cache_invalidated", "taxdump_fingerprint": taxdump_fingerprint}))
+
+
+@metrics.timed('resolve_genera')
+def resolve_genera(config, taxids):
+    """
+    Look up the genus for a collection of NCBI taxonomy IDs. Results are kept in a persistent
+    cache under 'output_dir', which is cleared whenever the taxdump (or taxonkit's data) changes. Cache misses are
+    resolved using the in-process taxonomy tables when the taxdump is available, unless
+    'taxonomy_engine' is set to 'taxonkit' in the config, in which case (or if no taxdump is
+    found) `taxonkit` is used.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param taxids: NCBI taxonomy IDs to resolve. Duplicates and '0' (unclassified) are ignored.
+    :type taxids: Iterable[str]
+    :return: Genus details by taxid. Keys: ['genus_taxon_name', 'genus_ncbi_taxonomy_id']
+    :rtype: dict[str, dict[str, str]]
+    """
+    unique_taxids = sorted(set(str(taxid) for taxid in taxids) - {'0'})
+    genera_by_taxid = {}
+    if len(unique_taxids) == 0:
+        return genera_by_taxid
+
+    genus_cache_path = get_genus_cache_path(config)
+    with _genus_cache_lock:
+        connection = open_genus_cache(config, genus_cache_path)
+        validate_genus_cache(config, connection, get_genus_cache_fingerprint(config))
+        for taxid in unique_taxids:
+            row = connection.execute("SELECT genus_taxon_name, genus_ncbi_taxonomy_id FROM genus WHERE ncbi_taxonomy_id = ?", (taxid,)).fetchone()
+            if row is not None:
+                genera_by_taxid[taxid] = {
+                    'genus_taxon_name': row[0],
+                    'genus_ncbi_taxonomy_id': row[1],
+                }
+
+        missed_taxids = [taxid for taxid in unique_taxids if taxid not in genera_by_taxid]
+        num_hits = len(genera_by_taxid)
+        num_misses = len(missed_taxids)
+        _genus_cache_stats['hits'] += num_hits
+        _genus_cache_stats['misses'] += num_misses
+        total_hits = _genus_cache_stats['hits']
+        total_misses = _genus_cache_stats['misses']
+
+    # Cache misses are resolved outside of the lock, so that concurrent collections
+    # aren't serialized behind a slow taxonkit invocation.
+    if num_misses > 0:
+        taxonomy = None
+        if config.get('taxonomy_engine', 'native') != 'taxonkit':
+            taxonomy = get_taxonomy(config)
+
+        if taxonomy is None:
+            resolved_genera_by_taxid = resolve_genera_taxonkit(missed_taxids, config.get('taxonkit_data_dir', None))
+        else:
+            resolved_genera_by_taxid = {taxid: get_genus(taxonomy, taxid) for taxid in missed_taxids}
+
+        # With several nodes sharing the cache, writes are serialized by a lease (see `leases`).
+        with _genus_cache_lock, leases.lease(config, 'genus-cache', wait_seconds=None):
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO genus (ncbi_taxonomy_id, genus_taxon_name, genus_ncbi_taxonomy_id) VALUES (?, ?, ?)",
+                    [(taxid, genus['genus_taxon_name'], genus['genus_ncbi_taxonomy_id']) for taxid, genus in resolved_genera_by_taxid.items()]
+                )
+        genera_by_taxid.update(resolved_genera_by_taxid)
+
+    logging.info(json.dumps({
+        "event_type": "resolve_genera_complete",
+        "num_taxids": len(unique_taxids),
+        "genus_cache_hits": num_hits,
+        "genus_cache_misses": num_misses,
+        "genus_cache_total_hits": total_hits,
+        "genus_cache_total_misses": total_misses,
+    }))
+
+    return genera_by_taxid
@@ -0,0 +1,413 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import time
+
+from typing import Iterator
+
+import routine_nanopore_qc_collector.core as core
+
+
+DEFAULT_WATCH_POLL_INTERVAL_SECONDS = 30.0
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+# Filesystems where changes made by other hosts are not reported by inotify.
+NETWORK_FILESYSTEM_TYPES = {
+    'nfs',
+    'nfs4',
+    'cifs',
+    'smb3',
+    'smbfs',
+    'lustre',
+    'gpfs',
+    'beegfs',
+    'ceph',
+}
+
+ANALYSIS_COMPLETE_FILENAME = 'analysis_complete.json'
+
+_libc = None
+
+
+def get_libc():
+    """
+    Load the C library, if it provides inotify.
+
+    :return: The C library, or None if inotify is not available.
+    :rtype: Optional[ctypes.CDLL]
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            _libc = libc
+        except (OSError, AttributeError) as e:
+            return None
+
+    return _libc
+
+
+def get_filesystem_type(path):
+    """
+    Find the type of the filesystem that a path is on, from /proc/mounts.
+
+    :param path: Path to check.
+    :type path: str
+    :return: Filesystem type (eg. 'ext4', 'nfs4'), or None if it can't be determined.
+    :rtype: Optional[str]
+    """
+    real_path = os.path.realpath(path)
+    filesystem_type = None
+    longest_mount_point = ''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                is_under_mount_point = real_path == mount_point or real_path.startswith(mount_point.rstrip('/') + '/')
+                if is_under_mount_point and len(mount_point) >= len(longest_mount_point):
+                    longest_mount_point = mount_point
+                    filesystem_type = fields[2]
+    except OSError as e:
+        pass
+
+    return filesystem_type
+
+
+def get_watch_mode(config):
+    """
+    Decide how to watch for completed analyses. The 'watch_mode' config value may be
+    'inotify', 'poll', or 'auto' (the default). In 'auto' mode, inotify is used unless it is
+    unavailable or any of the analysis_by_run dirs are on a network filesystem.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: 'inotify' or 'poll'
+    :rtype: str
+    """
+    watch_mode = config.get('watch_mode', 'auto')
+    if watch_mode == 'poll':
+        return 'poll'
+    if get_libc() is None:
+        return 'poll'
+    if watch_mode == 'auto':
+        for analysis_root in core.get_analysis_roots(config):
+            filesystem_type = get_filesystem_type(analysis_root)
+            if filesystem_type is None or filesystem_type in NETWORK_FILESYSTEM_TYPES or filesystem_type.startswith('fuse'):
+                return 'poll'
+
+    return 'inotify'
+
+
+def is_routine_nanopore_qc_output_dirname(dirname):
+    """
+    :param dirname: Directory name.
+    :type dirname: str
+    :return: Whether the directory name looks like 'routine-nanopore-qc-v*-output'.
+    :rtype: bool
+    """
+    return dirname.startswith('routine-nanopore-qc-v') and dirname.endswith('-output')
+
+
+def list_new_run_dirs(config, known_run_ids):
+    """
+    List the run dirs in the analysis_by_run dirs that aren't already known. Only the analysis_by_run dirs
+    themselves are read; run dirs are not checked.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param known_run_ids: IDs of runs that have already been found.
+    :type known_run_ids: set[str]
+    :return: Paths to run dirs, for runs that aren't known or excluded.
+    :rtype: list[str]
+    """
+    run_dir_paths = []
+    for analysis_root in core.get_analysis_roots(config):
+        try:
+            with os.scandir(analysis_root) as subdirs:
+                for subdir in subdirs:
+                    run_id = subdir.name
+                    if run_id in known_run_ids or run_id in config['excluded_runs'] or core.get_sequencer_type(run_id) is None:
+                        continue
+                    if subdir.is_dir():
+                        run_dir_paths.append(os.path.abspath(subdir.path))
+        except OSError as e:
+            logging.warning(json.dumps({"event_type": "list_run_dirs_failed", "analysis_root": analysis_root, "error": repr(e)}))
+
+    return run_dir_paths
+
+
+def get_incomplete_run_dirs(scan_state):
+    """
+    :param scan_state: Scan state, as returned by `core.load_scan_state`.
+    :type scan_state: dict[str, object]
+    :return: Paths to the run dirs of runs whose analysis wasn't complete when they were last checked.
+    :rtype: list[str]
+    """
+    return [run_status['run_dir_path'] for run_status in scan_state['runs'].values() if not run_status['analysis_complete'] and run_status.get('run_dir_path', None) is not None]
+
+
+def get_ready_analysis_dir(config, scan_state, run_dir_path):
+    """
+    Check whether a run is ready to be collected.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `core.load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param run_dir_path: Path to the run's analysis directory.
+    :type run_dir_path: str
+    :return: Analysis dir (Keys: ['path', 'sequencer_type', 'routine_nanopore_qc_output_path']) if the run is ready, otherwise None.
+    :rtype: Optional[dict[str, str]]
+    """
+    run_id = os.path.basename(run_dir_path)
+    sequencer_type = core.get_sequencer_type(run_id)
+    if sequencer_type is None or run_id in config['excluded_runs'] or not os.path.isdir(run_dir_path):
+        return None
+
+    run_status = core.get_run_status(scan_state, run_dir_path)
+    if not run_status['analysis_complete']:
+        return None
+
+    analysis_dir = {
+        "path": os.path.abspath(run_dir_path),
+        "sequencer_type": sequencer_type,
+        "routine_nanopore_qc_output_path": run_status['routine_nanopore_qc_output_path'],
+    }
+
+    return analysis_dir
+
+
+def watch_inotify(config, scan_state, discovered_runs, duration_seconds):
+    """
+    Watch for runs whose analysis completes, using inotify. Watches are placed on each
+    analysis_by_run dir (for new runs), on each incomplete run dir (for new pipeline output
+    dirs), and on each incomplete pipeline output dir (for 'analysis_complete.json').
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `core.load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param discovered_runs: Runs, as returned by `core.discover_runs`.
+    :type discovered_runs: list[core.RunRecord]
+    :param duration_seconds: How long to watch for.
+    :type duration_seconds: float
+    :return: Analysis dirs that are ready to collect.
+    :rtype: Iterator[dict[str, str]]
+    """
+    libc = get_libc()
+    inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if inotify_fd < 0:
+        logging.error(json.dumps({"event_type": "inotify_init_failed", "errno": ctypes.get_errno()}))
+        yield from watch_poll(config, scan_state, discovered_runs, duration_seconds)
+        return
+
+    watched_dirs_by_wd = {}
+    watched_paths = set()
+    yielded_run_ids = set()
+
+    def add_watch(path, watch_type):
+        if path in watched_paths:
+            return
+        mask = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+        if watch_type == 'output':
+            mask |= IN_CLOSE_WRITE
+        wd = libc.inotify_add_watch(inotify_fd, os.fsencode(path), mask)
+        if wd < 0:
+            logging.warning(json.dumps({"event_type": "inotify_add_watch_failed", "path": path, "errno": ctypes.get_errno()}))
+            return
+        watched_dirs_by_wd[wd] = (watch_type, path)
+        watched_paths.add(path)
+
+    def check_run(run_dir_path):
+        run_id = os.path.basename(run_dir_path)
+        if run_id in yielded_run_ids:
+            return None
+        if core.get_sequencer_type(run_id) is None or run_id in config['excluded_runs']:
+            return None
+        add_watch(run_dir_path, 'run')
+        analysis_dir = get_ready_analysis_dir(config, scan_state, run_dir_path)
+        if analysis_dir is not None:
+            yielded_run_ids.add(run_id)
+            return analysis_dir
+        routine_nanopore_qc_output_path = scan_state['runs'].get(run_id, {}).get('routine_nanopore_qc_output_path', None)
+        if routine_nanopore_qc_output_path is not None:
+            add_watch(routine_nanopore_qc_output_path, 'output')
+            # The analysis may have completed between the status check and adding the watch.
+            analysis_dir = get_ready_analysis_dir(config, scan_state, run_dir_path)
+            if analysis_dir is not None:
+                yielded_run_ids.add(run_id)
+                return analysis_dir
+
+        return None
+
+    for analysis_root in core.get_analysis_roots(config):
+        add_watch(analysis_root, 'root')
+    for run in discovered_runs:
+        if not run['excluded'] and not run['analysis_complete']:
+            add_watch(run['path'], 'run')
+            if run['routine_nanopore_qc_output_path'] is not None:
+                add_watch(run['routine_nanopore_qc_output_path'], 'output')
+    logging.info(json.dumps({"event_type": "watch_start", "watch_mode": "inotify", "num_watches": len(watched_dirs_by_wd), "duration_seconds": duration_seconds}))
+
+    deadline = time.monotonic() + duration_seconds
+    try:
+        while True:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                break
+            readable, _, _ = select.select([inotify_fd], [], [], remaining_seconds)
+            if not readable:
+                continue
+            try:
+                events_buffer = os.read(inotify_fd, 65536)
+            except BlockingIOError as e:
+                continue
+
+            run_dirs_to_check = []
+            offset = 0
+            while offset + INOTIFY_EVENT_HEADER.size <= len(events_buffer):
+                wd, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(events_buffer, offset)
+                name_start = offset + INOTIFY_EVENT_HEADER.size
+                name = os.fsdecode(events_buffer[name_start:name_start + name_length].rstrip(b'\0'))
+                offset = name_start + name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning(json.dumps({"event_type": "inotify_queue_overflow"}))
+                    # Events were lost, so check every run that could have completed: incomplete runs, and any new runs.
+                    run_dirs_to_check += get_incomplete_run_dirs(scan_state)
+                    run_dirs_to_check += list_new_run_dirs(config, set(scan_state['runs'].keys()))
+                    continue
+                if mask & IN_IGNORED:
+                    watched_type_and_path = watched_dirs_by_wd.pop(wd, None)
+                    if watched_type_and_path is not None:
+                        watched_paths.discard(watched_type_and_path[1])
+                    continue
+                if wd not in watched_dirs_by_wd:
+                    continue
+
+                watch_type, watched_path = watched_dirs_by_wd[wd]
+                if watch_type == 'root' and mask & IN_ISDIR:
+                    run_dirs_to_check.append(os.path.join(watched_path, name))
+                elif watch_type == 'run' and mask & IN_ISDIR and is_routine_nanopore_qc_output_dirname(name):
+                    run_dirs_to_check.append(watched_path)
+                elif watch_type == 'output' and name == ANALYSIS_COMPLETE_FILENAME:
+                    run_dirs_to_check.append(os.path.dirname(watched_path))
+
+            for run_dir_path in dict.fromkeys(run_dirs_to_check):
+                analysis_dir = check_run(run_dir_path)
+                if analysis_dir is not None:
+                    logging.info(json.dumps({"event_type": "analysis_complete_detected", "sequencing_run_id": os.path.basename(run_dir_path), "watch_mode": "inotify"}))
+                    yield analysis_dir
+    finally:
+        os.close(inotify_fd)
+
+
+def watch_poll(config, scan_state, discovered_runs, duration_seconds):
+    """
+    Watch for runs whose analysis completes, by re-checking candidate runs at a fixed interval
+    ('watch_poll_interval_seconds' in the config, default 30s). Used when inotify isn't available,
+    or for network filesystems where inotify doesn't see changes made on other hosts.
+
+    Only runs whose analysis was incomplete at the last full scan are checked, along with any new
+    run dirs. The analysis_by_run dirs are only listed (to find new run dirs) when their modification
+    time changes, so each poll costs a few stats per incomplete run, rather than a full scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `core.load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param discovered_runs: Runs, as returned by `core.discover_runs`.
+    :type discovered_runs: list[core.RunRecord]
+    :param duration_seconds: How long to watch for.
+    :type duration_seconds: float
+    :return: Analysis dirs that are ready to collect.
+    :rtype: Iterator[dict[str, str]]
+    """
+    try:
+        poll_interval_seconds = float(str(config.get('watch_poll_interval_seconds', DEFAULT_WATCH_POLL_INTERVAL_SECONDS)))
+    except ValueError as e:
+        poll_interval_seconds = DEFAULT_WATCH_POLL_INTERVAL_SECONDS
+
+    known_run_ids = set(run['run_id'] for run in discovered_runs)
+    candidate_run_dir_paths = {run['run_id']: run['path'] for run in discovered_runs if not run['excluded'] and not run['analysis_complete']}
+    # The analysis_by_run dirs are listed on the first poll, in case runs were added since the full scan.
+    analysis_root_mtimes_ns = {analysis_root: None for analysis_root in core.get_analysis_roots(config)}
+    logging.info(json.dumps({"event_type": "watch_start", "watch_mode": "poll", "poll_interval_seconds": poll_interval_seconds, "num_candidate_runs": len(candidate_run_dir_paths), "duration_seconds": duration_seconds}))
+
+    deadline = time.monotonic() + duration_seconds
+    while True:
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            break
+        time.sleep(min(poll_interval_seconds, remaining_seconds))
+
+        analysis_roots_changed = False
+        for analysis_root, previous_mtime_ns in analysis_root_mtimes_ns.items():
+            try:
+                mtime_ns = os.stat(analysis_root).st_mtime_ns
+            except OSError as e:
+                continue
+            if mtime_ns != previous_mtime_ns:
+                analysis_root_mtimes_ns[analysis_root] = mtime_ns
+                analysis_roots_changed = True
+        if analysis_roots_changed:
+            for run_dir_path in list_new_run_dirs(config, known_run_ids):
+                run_id = os.path.basename(run_dir_path)
+                known_run_ids.add(run_id)
+                candidate_run_dir_paths[run_id] = run_dir_path
+
+        for run_id, run_dir_path in list(candidate_run_dir_paths.items()):
+            try:
+                analysis_dir = get_ready_analysis_dir(config, scan_state, run_dir_path)
+            except FileNotFoundError as e:
+                # The run dir was removed.
+                candidate_run_dir_paths.pop(run_id)
+                known_run_ids.discard(run_id)
+                continue
+            if analysis_dir is None:
+                continue
+            candidate_run_dir_paths.pop(run_id)
+            logging.info(json.dumps({"event_type": "analysis_complete_detected", "sequencing_run_id": run_id, "watch_mode": "poll"}))
+            yield analysis_dir
+
+
+def watch_for_completed_runs(config, scan_state, discovered_runs, duration_seconds) -> Iterator[dict[str, str]]:
+    """
+    Watch the analysis_by_run dirs for runs whose analysis completes, for up to `duration_seconds`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, as returned by `core.load_scan_state`. Updated in place.
+    :type scan_state: dict[str, object]
+    :param discovered_runs: Runs, as returned by `core.discover_runs` at the most recent full scan.
+    :type discovered_runs: list[core.RunRecord]
+    :param duration_seconds: How long to watch for.
+    :type duration_seconds: float
+    :return: Analysis dirs that are ready to collect.
+    :rtype: Iterator[dict[str, str]]
+    """
+    if get_watch_mode(config) == 'inotify':
+        yield from watch_inotify(config, scan_state, discovered_runs, duration_seconds)
+    else:
+        yield from watch_poll(config, scan_state, discovered_runs, duration_seconds)
@@ -0,0 +1,181 @@
+import contextlib
+import gzip
+import io
+import json
+import logging
+import os
+import socket
+import threading
+
+import routine_nanopore_qc_collector.metrics as metrics
+
+
+DEFAULT_OUTPUT_FORMAT = 'json'
+
+# File extension for each output format.
+OUTPUT_FORMATS = {
+    'json': '.json',
+    'json_compact': '.json',
+    'ndjson': '.ndjson',
+}
+
+OUTPUT_COMPRESSIONS = {
+    'none': '',
+    'gzip': '.gz',
+}
+
+
+def get_output_format(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Output format ('json', 'json_compact' or 'ndjson') and compression ('none' or 'gzip').
+    :rtype: tuple[str, str]
+    """
+    output_format = config.get('output_format', DEFAULT_OUTPUT_FORMAT)
+    if output_format not in OUTPUT_FORMATS:
+        logging.error(json.dumps({"event_type": "invalid_output_format", "output_format": output_format, "default": DEFAULT_OUTPUT_FORMAT}))
+        output_format = DEFAULT_OUTPUT_FORMAT
+    output_compression = config.get('output_compression', 'none')
+    if output_compression not in OUTPUT_COMPRESSIONS:
+        logging.error(json.dumps({"event_type": "invalid_output_compression", "output_compression": output_compression, "default": 'none'}))
+        output_compression = 'none'
+
+    return output_format, output_compression
+
+
+def get_output_path(config, dst_dir, name):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param dst_dir: Directory for the output file.
+    :type dst_dir: str
+    :param name: Output file name, without extension (eg. '<run_id>_library_qc').
+    :type name: str
+    :return: Path to the output file, with the extension for the configured format (eg. '.json', '.ndjson.gz').
+    :rtype: str
+    """
+    output_format, output_compression = get_output_format(config)
+
+    return os.path.join(dst_dir, name + OUTPUT_FORMATS[output_format] + OUTPUT_COMPRESSIONS[output_compression])
+
+
+@contextlib.contextmanager
+def atomic_writer(dst_path, compression='none', binary=False):
+    """
+    Open a file for writing, so that readers never see a partial file. Data is written to a
+    temporary file in the same directory, which is renamed to the destination when the block
+    completes. If the block raises, the temporary file is removed and the destination is untouched.
+    The temporary file's name is unique to the host, process and thread, as other workers or nodes
+    may be writing the same file.
+
+    :param dst_path: Path to write to.
+    :type dst_path: str
+    :param compression: 'none', or 'gzip' to compress the file.
+    :type compression: str
+    :param binary: Open the file in binary mode, rather than as UTF-8 text.
+    :type binary: bool
+    :return: File object.
+    :rtype: Iterator[Union[TextIO, BinaryIO]]
+    """
+    dst_dir, dst_filename = os.path.split(os.path.abspath(dst_path))
+    tmp_path = os.path.join(dst_dir, '.' + dst_filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+    try:
+        with open(tmp_path, 'wb') as raw_file:
+            if compression == 'gzip':
+                # mtime=0 keeps the compressed output identical for identical content.
+                with gzip.GzipFile(filename='', fileobj=raw_file, mode='wb', mtime=0) as gzip_file:
+                    if binary:
+                        yield gzip_file
+                    else:
+                        with io.TextIOWrapper(gzip_file, encoding='utf-8') as f:
+                            yield f
+            elif binary:
+                yield raw_file
+            else:
+                with io.TextIOWrapper(raw_file, encoding='utf-8') as f:
+                    yield f
+        os.replace(tmp_path, dst_path)
+    except BaseException as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@metrics.timed('write_records')
+def write_records(dst_path, records, output_format=DEFAULT_OUTPUT_FORMAT, compression='none'):
+    """
+    Write records to a file atomically (see `atomic_writer`), one at a time as they are produced.
+
+    Formats:
+      - 'json': A pretty-printed json array, identical to `json.dump(records, f, indent=2)`.
+      - 'json_compact': A json array without whitespace.
+      - 'ndjson': One compact json object per line.
+
+    :param dst_path: Path to write to.
+    :type dst_path: str
+    :param records: Records to write.
+    :type records: Iterable[dict[str, object]]
+    :param output_format: Output format ('json', 'json_compact' or 'ndjson').
+    :type output_format: str
+    :param compression: 'none', or 'gzip' to compress the file.
+    :type compression: str
+    :return: Number of records written.
+    :rtype: int
+    """
+    num_records = 0
+    with atomic_writer(dst_path, compression) as f:
+        for record in records:
+            if output_format == 'ndjson':
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            elif output_format == 'json_compact':
+                f.write(('[' if num_records == 0 else ',') + json.dumps(record, separators=(',', ':')))
+            else:
+                serialized_record = json.dumps(record, indent=2)
+                f.write(('[\n  ' if num_records == 0 else ',\n  ') + serialized_record.replace('\n', '\n  '))
+            num_records += 1
+
+        if output_format == 'json_compact':
+            f.write(']' if num_records > 0 else '[]')
+        elif output_format == 'json':
+            f.write('\n]' if num_records > 0 else '[]')
+
+    return num_records
+
+
+def write_output(config, dst_path, records):
+    """
+    Write records to an output file, in the format set by 'output_format' and 'output_compression' in the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param dst_path: Path to write to, as returned by `get_output_path`.
+    :type dst_path: str
+    :param records: Records to write.
+    :type records: Iterable[dict[str, object]]
+    :return: Number of records written.
+    :rtype: int
+    """
+    output_format, output_compression = get_output_format(config)
+
+    return write_records(dst_path, records, output_format, output_compression)
+
+
+def read_records(path):
+    """
+    Read the records from an output file written by `write_records`, in any format.
+    The format is determined from the file extension.
+
+    :param path: Path to the output file.
+    :type path: str
+    :return: Records.
+    :rtype: list[dict[str, object]]
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt', encoding='utf-8')
+    else:
+        f = open(path, 'r', encoding='utf-8')
+    with f:
+        if path.endswith('.ndjson') or path.endswith('.ndjson.gz'):
+            return [json.loads(line) for line in f if line.strip() != '']
+        return json.load(f)
@@ -4,7 +4,7 @@ from setuptools import setup, find_namespace_packages
 setup(
     name='routine-nanopore-qc-collector',
     version='0.1.0',
-    packages=find_namespace_packages(),
+    packages=find_namespace_packages(include=['routine_nanopore_qc_collector*']),
     entry_points={
         "console_scripts": [
             "routine-nanopore-qc-collector = routine_nanopore_qc_collector.__main__:main",
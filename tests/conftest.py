@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+import routine_nanopore_qc_collector.config
+import routine_nanopore_qc_collector.core as core
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import generate_analysis_by_run
+
+
+@pytest.fixture
+def analysis_config(tmp_path):
+    """
+    Config for a small synthetic analysis_by_run tree (see `benchmarks/generate_analysis_by_run.py`),
+    with four complete runs of three libraries each. The first run is excluded.
+    """
+    core._collected_runs.clear()
+    tree = generate_analysis_by_run.generate_analysis_by_run(str(tmp_path), num_runs=4, libraries_per_run=3, incomplete_fraction=0.0, num_kraken_records=8)
+    config = routine_nanopore_qc_collector.config.load_config(tree['config_path'])
+    core.create_output_dirs(config)
+    yield config
+    core._collected_runs.clear()
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import routine_nanopore_qc_collector.api as api
+
+
+RUN_ID = '20230101_1200_X1_FAV12345_abcd1234'
+
+
+@pytest.fixture
+def index():
+    api._index = api.init_index()
+    api.set_run_records(api._index, RUN_ID, [
+        {'run_id': RUN_ID, 'library_id': 'LIB001', 'inferred_species_name': 'Escherichia coli', 'inferred_species_estimated_depth': 50.0},
+        {'run_id': RUN_ID, 'library_id': 'LIB002', 'inferred_species_name': 'Salmonella enterica', 'inferred_species_estimated_depth': None},
+    ], [])
+    api.clear_response_cache()
+    yield api._index
+    api._index = None
+    api.clear_response_cache()
+
+
+def test_is_etag_match():
+    etag = '"0123abcd"'
+
+    assert not api.is_etag_match(None, etag)
+    assert api.is_etag_match('"0123abcd"', etag)
+    assert api.is_etag_match('W/"0123abcd"', etag)
+    assert api.is_etag_match('"0123abcd-gzip"', etag)
+    assert api.is_etag_match('"other", "0123abcd"', etag)
+    assert api.is_etag_match('*', etag)
+    assert not api.is_etag_match('"other"', etag)
+
+
+def test_parse_query():
+    assert api.parse_query('/library-qc', 'species=Escherichia%20coli&min_depth=10&limit=5') == ({'species': 'Escherichia coli', 'min_depth': 10.0}, 0, 5)
+    for query_string in ['unknown=1', 'run_id=a&run_id=b', 'start_date=2023-1-1', 'limit=0', 'offset=-1', 'min_depth=deep']:
+        with pytest.raises(ValueError):
+            api.parse_query('/library-qc', query_string)
+
+
+def test_get_response_filters_records(index):
+    status, body, etag = api.get_response('/library-qc?species=Escherichia%20coli')
+    page = json.loads(body)
+
+    assert status == 200
+    assert [record['library_id'] for record in page['records']] == ['LIB001']
+    assert json.loads(api.get_response('/library-qc?min_depth=60')[1])['total'] == 0
+    assert api.get_response('/unknown')[0] == 404
+    assert api.get_response('/library-qc?limit=x')[0] == 400
+
+
+def test_etag_changes_only_when_records_change(index):
+    etag = api.get_response('/library-qc')[2]
+    assert api.get_response('/library-qc')[2] == etag
+
+    # A new generation with the same records gives the same ETag.
+    index['generation'] += 1
+    assert api.get_response('/library-qc')[2] == etag
+
+    api.set_run_records(index, RUN_ID, [{'run_id': RUN_ID, 'library_id': 'LIB001', 'inferred_species_name': 'Escherichia coli'}], [])
+    index['generation'] += 1
+    assert api.get_response('/library-qc')[2] != etag
@@ -0,0 +1,81 @@
+import os
+import types
+
+import pytest
+
+import routine_nanopore_qc_collector.config as config_module
+
+
+@pytest.fixture
+def config(tmp_path):
+    config_module._reference_file_cache.clear()
+    excluded_runs_list = str(tmp_path / 'excluded_runs.txt')
+    with open(excluded_runs_list, 'w') as f:
+        f.write('# Excluded runs\nrun-1\n')
+    yield {'excluded_runs_list': excluded_runs_list}
+    config_module._reference_file_cache.clear()
+
+
+@pytest.fixture
+def parse_count():
+    parse_count = {'count': 0}
+
+    def get_excluded_runs(config):
+        parse_count['count'] += 1
+        return config_module.get_excluded_runs(config)
+
+    parse_count['parse_fn'] = get_excluded_runs
+
+    return parse_count
+
+
+def set_mtime_ns(path, mtime_ns):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_unchanged_reference_file_is_not_reparsed(config, parse_count):
+    excluded_runs = config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn'])
+
+    assert config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn']) is excluded_runs
+    assert excluded_runs == frozenset(['run-1'])
+    assert parse_count['count'] == 1
+
+
+def test_reference_is_reparsed_when_mtime_changes(config, parse_count):
+    path = config['excluded_runs_list']
+    mtime_ns = os.stat(path).st_mtime_ns
+    config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn'])
+
+    # Same size, new contents.
+    with open(path, 'w') as f:
+        f.write('# Excluded runs\nrun-2\n')
+    set_mtime_ns(path, mtime_ns)
+    assert config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn']) == frozenset(['run-1'])
+
+    set_mtime_ns(path, mtime_ns + 1000000000)
+    assert config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn']) == frozenset(['run-2'])
+    assert parse_count['count'] == 2
+
+
+def test_reference_is_reparsed_when_size_changes(config, parse_count):
+    path = config['excluded_runs_list']
+    mtime_ns = os.stat(path).st_mtime_ns
+    config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn'])
+
+    with open(path, 'a') as f:
+        f.write('run-3\n')
+    set_mtime_ns(path, mtime_ns)
+
+    assert config_module.get_cached_reference(config, 'excluded_runs_list', parse_count['parse_fn']) == frozenset(['run-1', 'run-3'])
+    assert parse_count['count'] == 2
+
+
+def test_freeze_shares_repeated_objects():
+    species = {'species_name': 'Escherichia coli', 'genome_size_mb': 5.0}
+    frozen = config_module.freeze({'562': species, 'Escherichia coli': species, 'runs': {'run-1'}})
+
+    assert isinstance(frozen, types.MappingProxyType)
+    assert frozen['562'] is frozen['Escherichia coli']
+    assert frozen['runs'] == frozenset(['run-1'])
+    with pytest.raises(TypeError):
+        frozen['562']['genome_size_mb'] = 6.0
@@ -0,0 +1,68 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+import routine_nanopore_qc_collector.core as core
+
+
+@pytest.fixture
+def two_root_config(analysis_config, tmp_path):
+    """
+    Config with a second analysis root, holding a copy of every run in the first.
+    """
+    first_root = os.path.abspath(analysis_config['analysis_by_run_dir'])
+    second_root = str(tmp_path / 'analysis_by_run_b')
+    shutil.copytree(first_root, second_root)
+
+    return dict(analysis_config, analysis_by_run_dir=[first_root, second_root])
+
+
+def get_run_ids(config):
+    return sorted(run_id for run_id in os.listdir(config['analysis_by_run_dir'][0]) if core.get_sequencer_type(run_id) is not None)
+
+
+def test_duplicate_runs_are_included_once(two_root_config, caplog):
+    first_root, second_root = two_root_config['analysis_by_run_dir']
+    run_ids = get_run_ids(two_root_config)
+    # Incomplete in the first root, so the complete copy in the second root is used.
+    incomplete_run_status = core.get_run_status({'runs': {}}, os.path.join(first_root, run_ids[1]))
+    os.remove(os.path.join(incomplete_run_status['routine_nanopore_qc_output_path'], 'analysis_complete.json'))
+    # Only in the second root.
+    shutil.rmtree(os.path.join(first_root, run_ids[2]))
+
+    runs = core.discover_runs(two_root_config)
+
+    assert [run['run_id'] for run in runs] == run_ids
+    roots_by_run_id = {run['run_id']: os.path.dirname(run['path']) for run in runs}
+    assert roots_by_run_id == {run_ids[0]: first_root, run_ids[1]: second_root, run_ids[2]: second_root, run_ids[3]: first_root}
+    assert all(run['analysis_complete'] for run in runs if not run['excluded'])
+    assert 'duplicate_run_found' in caplog.text
+
+
+def test_slow_root_falls_back_to_scan_state(two_root_config, monkeypatch, caplog):
+    first_root, second_root = two_root_config['analysis_by_run_dir']
+    run_ids = get_run_ids(two_root_config)
+    shutil.rmtree(os.path.join(first_root, run_ids[2]))
+    scan_state = core.load_scan_state(two_root_config)
+    expected_runs = core.discover_runs(two_root_config, scan_state)
+
+    release_second_root = threading.Event()
+    discover_root_runs = core.discover_root_runs
+
+    def slow_discover_root_runs(config, analysis_root, root_scan_state):
+        if analysis_root == second_root:
+            release_second_root.wait(10)
+        return discover_root_runs(config, analysis_root, root_scan_state)
+
+    monkeypatch.setattr(core, 'discover_root_runs', slow_discover_root_runs)
+    config = dict(two_root_config, analysis_root_timeout_seconds=0.2)
+    try:
+        runs = core.discover_runs(config, scan_state)
+    finally:
+        release_second_root.set()
+
+    assert runs == expected_runs
+    assert os.path.dirname([run for run in runs if run['run_id'] == run_ids[2]][0]['path']) == second_root
+    assert 'discover_root_runs_timeout' in caplog.text
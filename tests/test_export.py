@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.export as export
+import routine_nanopore_qc_collector.qc_index as qc_index
+
+
+@pytest.fixture
+def config(analysis_config):
+    analysis_config['export_format'] = 'csv'
+    for analysis_dir in core.scan(analysis_config):
+        if analysis_dir is not None:
+            core.collect_outputs(analysis_config, analysis_dir)
+
+    return analysis_config
+
+
+def read_part(config, table, run_id):
+    with open(export.get_part_path(config, table, run_id), 'r') as f:
+        return f.read()
+
+
+def test_each_run_has_its_own_part(config):
+    run_ids = sorted(qc_index.get_indexed_run_ids(config, 'library_qc'))
+    assert len(run_ids) == 3
+    for run_id in run_ids:
+        lines = read_part(config, 'library_qc', run_id).splitlines()
+        assert lines[0].split(',') == [column_name for column_name, _ in export.EXPORT_COLUMNS['library_qc']]
+        assert len(lines) == 4
+        assert all(line.startswith(run_id + ',') for line in lines[1:])
+
+
+def test_export_run_only_rewrites_its_part(config):
+    run_ids = sorted(qc_index.get_indexed_run_ids(config, 'library_qc'))
+    part_mtimes = {run_id: os.stat(export.get_part_path(config, 'library_qc', run_id)).st_mtime_ns for run_id in run_ids}
+    for run_id in run_ids:
+        os.utime(export.get_part_path(config, 'library_qc', run_id), ns=(part_mtimes[run_id] - 1000, part_mtimes[run_id] - 1000))
+
+    export.export_run(config, run_ids[0])
+
+    assert os.stat(export.get_part_path(config, 'library_qc', run_ids[0])).st_mtime_ns > part_mtimes[run_ids[0]] - 1000
+    assert all(os.stat(export.get_part_path(config, 'library_qc', run_id)).st_mtime_ns == part_mtimes[run_id] - 1000 for run_id in run_ids[1:])
+
+
+def test_ensure_exported_fills_in_missing_parts(config):
+    export.ensure_exported(config)
+    run_ids = sorted(qc_index.get_indexed_run_ids(config, 'library_qc'))
+    expected_part = read_part(config, 'library_qc', run_ids[0])
+    os.remove(export.get_part_path(config, 'library_qc', run_ids[0]))
+    # A partition file from before runs were exported separately.
+    legacy_path = os.path.join(os.path.dirname(export.get_part_path(config, 'species_abundance', run_ids[1])), 'data.csv')
+    with open(legacy_path, 'w') as f:
+        f.write('run_id\n')
+
+    export.ensure_exported(config)
+
+    assert read_part(config, 'library_qc', run_ids[0]) == expected_part
+    assert not os.path.exists(legacy_path)
+    assert os.path.exists(export.get_part_path(config, 'species_abundance', run_ids[1]))
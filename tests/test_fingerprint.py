@@ -0,0 +1,93 @@
+import os
+
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.fingerprint as fingerprint
+import routine_nanopore_qc_collector.writers as writers
+
+
+def collect_all(config, force=False):
+    return {summary['sequencing_run_id']: summary for summary in (core.collect_outputs(config, analysis_dir, force) for analysis_dir in core.scan(config) if analysis_dir is not None)}
+
+
+def get_library_dir(config, run_id, library_num):
+    output_path = core.find_latest_routine_nanopore_qc_output(os.path.join(config['analysis_by_run_dir'], run_id))
+    library_id = sorted(name for name in os.listdir(output_path) if os.path.isdir(os.path.join(output_path, name)))[library_num]
+    return os.path.join(output_path, library_id), library_id
+
+
+def read_library_qc(config, run_id):
+    library_qc_path = writers.get_output_path(config, os.path.join(config['output_dir'], 'library-qc'), run_id + '_library_qc')
+    return {record['library_id']: record for record in writers.read_records(library_qc_path) if 'library_id' in record}
+
+
+def test_unchanged_runs_are_skipped(analysis_config):
+    summaries = collect_all(analysis_config)
+    assert len(summaries) == 3
+    assert all(summary['library_qc_written'] for summary in summaries.values())
+    manifest_mtimes = {run_id: os.stat(fingerprint.get_manifest_path(analysis_config, run_id)).st_mtime_ns for run_id in summaries}
+
+    for summary in collect_all(analysis_config).values():
+        assert summary['num_libraries'] == 3
+        assert summary['num_libraries_collected'] == 0
+        assert not summary['species_abundance_written'] and not summary['library_qc_written']
+
+    # A new process has no record of what it collected, and relies on the manifests.
+    core._collected_runs.clear()
+    for summary in collect_all(analysis_config).values():
+        assert summary['num_libraries_collected'] == 0
+    assert {run_id: os.stat(fingerprint.get_manifest_path(analysis_config, run_id)).st_mtime_ns for run_id in summaries} == manifest_mtimes
+
+
+def test_modified_source_file_is_recollected(analysis_config):
+    run_id = sorted(collect_all(analysis_config).keys())[0]
+    library_dir, library_id = get_library_dir(analysis_config, run_id, 0)
+    nanoq_path = os.path.join(library_dir, library_id + '_nanoq.csv')
+    with open(nanoq_path, 'r') as f:
+        header, values = f.read().splitlines()
+    values = values.split(',')
+    values[1] = '12345678'
+    with open(nanoq_path, 'w') as f:
+        f.write(header + '\n' + ','.join(values) + '\n')
+    # Files changed in place don't change the output dir's mtime, so this is only picked up when verifying.
+    summaries = collect_all(analysis_config)
+    assert summaries[run_id]['num_libraries_collected'] == 0
+
+    summaries = collect_all(dict(analysis_config, verify_source_fingerprints=True))
+    assert summaries[run_id]['num_libraries_collected'] == 1
+    assert summaries[run_id]['library_qc_written']
+    assert not summaries[run_id]['species_abundance_written']
+    assert read_library_qc(analysis_config, run_id)[library_id]['num_bases'] == 12345678
+    assert all(summary['num_libraries_collected'] == 0 for other_run_id, summary in summaries.items() if other_run_id != run_id)
+
+
+def test_added_source_file_is_recollected(analysis_config):
+    run_id = sorted(collect_all(analysis_config).keys())[0]
+    library_dir, library_id = get_library_dir(analysis_config, run_id, 0)
+    os.rename(os.path.join(library_dir, library_id + '_nanoq.csv'), os.path.join(library_dir, library_id + '_nanoq.csv.bak'))
+    summaries = collect_all(analysis_config, force=True)
+    assert summaries[run_id]['incomplete_library_ids'] == [library_id]
+    assert library_id not in read_library_qc(analysis_config, run_id)
+
+    # Runs with incomplete libraries are re-checked on every scan, until the missing file appears.
+    os.rename(os.path.join(library_dir, library_id + '_nanoq.csv.bak'), os.path.join(library_dir, library_id + '_nanoq.csv'))
+    summaries = collect_all(analysis_config)
+    assert summaries[run_id]['num_libraries_collected'] == 1
+    assert summaries[run_id]['incomplete_library_ids'] == []
+    assert read_library_qc(analysis_config, run_id)[library_id]['num_bases'] > 0
+
+
+def test_new_library_is_collected(analysis_config):
+    run_id = sorted(collect_all(analysis_config).keys())[0]
+    library_dir, library_id = get_library_dir(analysis_config, run_id, 0)
+    new_library_id = library_id[:-3] + '099'
+    new_library_dir = os.path.join(os.path.dirname(library_dir), new_library_id)
+    os.makedirs(new_library_dir)
+    for suffix in ['_nanoq.csv', '_kraken2_species.csv']:
+        with open(os.path.join(library_dir, library_id + suffix), 'r') as src, open(os.path.join(new_library_dir, new_library_id + suffix), 'w') as dst:
+            dst.write(src.read())
+
+    summaries = collect_all(analysis_config)
+    assert summaries[run_id]['num_libraries'] == 4
+    assert summaries[run_id]['num_libraries_collected'] == 1
+    library_qc = read_library_qc(analysis_config, run_id)
+    assert library_qc[new_library_id]['num_bases'] == library_qc[library_id]['num_bases']
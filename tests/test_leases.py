@@ -0,0 +1,109 @@
+import json
+import os
+import time
+
+import pytest
+
+import routine_nanopore_qc_collector.leases as leases
+
+
+@pytest.fixture
+def config(tmp_path):
+    leases._held_leases.clear()
+    leases._observed_leases.clear()
+    yield {
+        'output_dir': str(tmp_path),
+        'leases_enabled': True,
+        'lease_ttl_seconds': 0.2,
+        'node_id': 'node-a',
+    }
+    leases._held_leases.clear()
+    leases._observed_leases.clear()
+
+
+def write_foreign_lease(config, name, token='foreign-token'):
+    lease_path = leases.get_lease_path(config, name)
+    os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+    with open(lease_path, 'w') as f:
+        json.dump({'name': name, 'node_id': 'node-b', 'token': token, 'acquired': 0.0}, f)
+
+    return lease_path
+
+
+def test_acquire_and_release(config):
+    lease = leases.acquire_lease(config, 'run-1')
+    assert lease is not None
+    assert leases.is_lease_held(config, lease)
+    assert leases.acquire_lease(config, 'run-1') is None
+
+    leases.release_lease(config, lease)
+    assert not os.path.exists(leases.get_lease_path(config, 'run-1'))
+    assert leases.acquire_lease(config, 'run-1') is not None
+
+
+def test_held_lease_is_not_expired_on_first_sight(config):
+    lease_path = write_foreign_lease(config, 'run-1')
+    # An mtime far in the past (eg. clock skew) doesn't make a lease expired.
+    os.utime(lease_path, (0, 0))
+
+    assert leases.acquire_lease(config, 'run-1') is None
+
+
+def test_unrenewed_lease_is_taken_over_after_ttl(config):
+    write_foreign_lease(config, 'run-1')
+    assert leases.acquire_lease(config, 'run-1') is None
+    time.sleep(0.3)
+
+    lease = leases.acquire_lease(config, 'run-1')
+    assert lease is not None
+    assert lease['node_id'] == 'node-a'
+
+
+def test_renewed_lease_is_not_taken_over(config):
+    lease_path = write_foreign_lease(config, 'run-1')
+    assert leases.acquire_lease(config, 'run-1') is None
+    time.sleep(0.3)
+    os.utime(lease_path, ns=(time.time_ns(), time.time_ns() + 1000))
+
+    assert leases.acquire_lease(config, 'run-1') is None
+
+
+def test_lost_lease_is_not_removed_on_release(config):
+    lease = leases.acquire_lease(config, 'run-1')
+    lease_path = write_foreign_lease(config, 'run-1', token='new-token')
+
+    leases.release_lease(config, lease)
+    assert os.path.exists(lease_path)
+    assert leases.read_lease(lease_path)[0]['token'] == 'new-token'
+
+
+def test_renew_forgets_lost_leases(config):
+    lease = leases.acquire_lease(config, 'run-1')
+    write_foreign_lease(config, 'run-1', token='new-token')
+
+    leases.renew_leases(config)
+    assert leases.get_lease_path(config, 'run-1') not in leases._held_leases
+
+
+def test_lease_context_manager(config):
+    with leases.lease(config, 'run-1') as acquired:
+        assert acquired
+        assert os.path.exists(leases.get_lease_path(config, 'run-1'))
+    assert not os.path.exists(leases.get_lease_path(config, 'run-1'))
+
+    write_foreign_lease(config, 'run-2')
+    with leases.lease(config, 'run-2') as acquired:
+        assert not acquired
+
+
+def test_lease_waits_for_abandoned_lease(config):
+    write_foreign_lease(config, 'run-1')
+    with leases.lease(config, 'run-1', wait_seconds=None) as acquired:
+        assert acquired
+
+
+def test_lease_disabled(config):
+    config['leases_enabled'] = False
+    write_foreign_lease(config, 'run-1')
+    with leases.lease(config, 'run-1') as acquired:
+        assert acquired
@@ -0,0 +1,66 @@
+import csv
+
+import pytest
+
+import routine_nanopore_qc_collector.parsers as parsers
+
+
+KRAKEN_SPECIES_HEADER = ['percent_seqs_in_clade', 'num_seqs_in_clade', 'num_seqs_this_taxon', 'rank_code', 'ncbi_taxonomy_id', 'taxon_name']
+
+NUM_KRAKEN_SPECIES_ROWS = 2 * parsers.PARSE_CHUNK_SIZE + 10
+
+
+@pytest.fixture
+def kraken_species_path(tmp_path):
+    kraken_species_path = str(tmp_path / 'LIB001_kraken2_species.csv')
+    with open(kraken_species_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(KRAKEN_SPECIES_HEADER)
+        for row_num in range(NUM_KRAKEN_SPECIES_ROWS):
+            writer.writerow([str(round(50.0 / (row_num + 1), 2)), str(1000 - row_num), str(900 - row_num), 'S', str(562 + row_num), 'Species ' + str(row_num)])
+            if row_num == 3:
+                # Blank lines are skipped, short rows are padded, and unconvertible numbers are None.
+                writer.writerow([])
+                writer.writerow(['0.01', 'n/a', '5', 'S'])
+
+    return kraken_species_path
+
+
+def parse_with_dict_reader(kraken_species_path):
+    records = []
+    with open(kraken_species_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            record = dict(row)
+            for field, converter in parsers.KRAKEN_SPECIES_CONVERTERS.items():
+                record[field] = converter(record[field])
+            records.append(record)
+
+    return records
+
+
+@pytest.mark.parametrize('top_n', [0, 1, 5, 7, parsers.PARSE_CHUNK_SIZE, parsers.PARSE_CHUNK_SIZE + 1, NUM_KRAKEN_SPECIES_ROWS + 1, None])
+def test_top_n_matches_full_parse(kraken_species_path, top_n):
+    full_records = parsers.parse_kraken_species(kraken_species_path)
+    assert full_records == parse_with_dict_reader(kraken_species_path)
+    assert len(full_records) == NUM_KRAKEN_SPECIES_ROWS + 1
+    assert full_records[4] == {'percent_seqs_in_clade': 0.01, 'num_seqs_in_clade': None, 'num_seqs_this_taxon': 5, 'rank_code': 'S', 'ncbi_taxonomy_id': None, 'taxon_name': None}
+
+    with open(kraken_species_path, 'rb') as f:
+        content = f.read()
+    expected_records = full_records if top_n is None else full_records[:top_n]
+    assert parsers.parse_kraken_species(kraken_species_path, top_n=top_n) == expected_records
+    assert parsers.parse_kraken_species(kraken_species_path, top_n=top_n, content=content) == expected_records
+
+
+def test_missing_columns_and_empty_file(tmp_path):
+    nanoq_path = str(tmp_path / 'LIB001_nanoq.csv')
+    with open(nanoq_path, 'w') as f:
+        f.write('reads,bases,n50,median_quality\n10,12345,2000,14.5\n')
+
+    assert parsers.parse_nanoq(nanoq_path) == [{
+        'reads': 10, 'bases': 12345, 'n50': 2000, 'longest': None, 'shortest': None,
+        'mean_length': None, 'median_length': None, 'mean_quality': None, 'median_quality': 14.5,
+    }]
+    with open(nanoq_path, 'w') as f:
+        pass
+    assert parsers.parse_nanoq(nanoq_path) == []
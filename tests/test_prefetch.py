@@ -0,0 +1,91 @@
+import builtins
+import hashlib
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.fingerprint as fingerprint
+import routine_nanopore_qc_collector.parsers as parsers
+import routine_nanopore_qc_collector.prefetch as prefetch
+
+
+LIBRARY_IDS = ['LIB001', 'LIB002', 'LIB003']
+KRAKEN_SPECIES = (
+    'percent_seqs_in_clade,num_seqs_in_clade,num_seqs_this_taxon,rank_code,ncbi_taxonomy_id,taxon_name\n'
+    '5.00,50,50,U,0,unclassified\n'
+    '80.00,800,800,S,562,Escherichia coli\n'
+    '15.00,150,150,S,28901,Salmonella enterica\n'
+)
+NANOQ = 'reads,bases,n50,longest,shortest,mean_length,median_length,mean_quality,median_quality\n1000,5000000,6000,40000,100,5000,4500,12.5,13.0\n'
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    for library_id in LIBRARY_IDS:
+        os.makedirs(os.path.join(str(tmp_path), library_id))
+        with open(os.path.join(str(tmp_path), library_id, library_id + '_kraken2_species.csv'), 'w') as f:
+            f.write(KRAKEN_SPECIES)
+        if library_id != 'LIB003':
+            with open(os.path.join(str(tmp_path), library_id, library_id + '_nanoq.csv'), 'w') as f:
+                f.write(NANOQ)
+
+    return str(tmp_path)
+
+
+def test_files_are_fingerprinted_without_reading_them(output_path, monkeypatch):
+    def no_open(*args, **kwargs):
+        raise AssertionError('source file opened')
+    monkeypatch.setattr(builtins, 'open', no_open)
+
+    source_files_by_library_id = prefetch.prefetch_source_files({}, output_path, LIBRARY_IDS, {})
+
+    kraken_species_file = source_files_by_library_id['LIB001']['kraken2_species']
+    assert kraken_species_file['content'] is None
+    assert kraken_species_file['fingerprint'] == {'size': len(KRAKEN_SPECIES), 'mtime_ns': os.stat(kraken_species_file['path']).st_mtime_ns, 'sha256': None}
+    assert source_files_by_library_id['LIB003']['nanoq']['fingerprint'] is None
+
+
+def test_changed_files_are_hashed_when_verifying(output_path):
+    config = {'verify_source_fingerprints': True}
+    source_files_by_library_id = prefetch.prefetch_source_files(config, output_path, LIBRARY_IDS, {})
+    kraken_species_file = source_files_by_library_id['LIB001']['kraken2_species']
+    assert kraken_species_file['content'] == KRAKEN_SPECIES.encode('utf-8')
+    assert kraken_species_file['fingerprint']['sha256'] == hashlib.sha256(KRAKEN_SPECIES.encode('utf-8')).hexdigest()
+
+    # Files whose size and modification time are unchanged keep their hash, and aren't read again.
+    previous_source_fingerprints = {library_id: {source_type: source_file['fingerprint'] for source_type, source_file in source_files.items()} for library_id, source_files in source_files_by_library_id.items()}
+    with open(os.path.join(output_path, 'LIB002', 'LIB002_nanoq.csv'), 'a') as f:
+        f.write('\n')
+    source_files_by_library_id = prefetch.prefetch_source_files(config, output_path, LIBRARY_IDS, previous_source_fingerprints)
+
+    assert source_files_by_library_id['LIB001']['kraken2_species']['content'] is None
+    assert source_files_by_library_id['LIB001']['kraken2_species']['fingerprint'] == previous_source_fingerprints['LIB001']['kraken2_species']
+    assert source_files_by_library_id['LIB002']['nanoq']['content'] == (NANOQ + '\n').encode('utf-8')
+    assert not fingerprint.same_content(source_files_by_library_id['LIB002']['nanoq']['fingerprint'], previous_source_fingerprints['LIB002']['nanoq'])
+
+
+def test_same_content_without_hashes():
+    previous_fingerprint = {'size': 10, 'mtime_ns': 1000, 'sha256': None}
+
+    assert fingerprint.same_content({'size': 10, 'mtime_ns': 1000, 'sha256': 'abcd'}, previous_fingerprint)
+    assert not fingerprint.same_content({'size': 10, 'mtime_ns': 2000, 'sha256': None}, previous_fingerprint)
+    assert not fingerprint.same_content(None, previous_fingerprint)
+    assert fingerprint.same_content(None, None)
+    # With both hashed, files that were only touched are unchanged.
+    assert fingerprint.same_content({'size': 10, 'mtime_ns': 2000, 'sha256': 'abcd'}, {'size': 10, 'mtime_ns': 1000, 'sha256': 'abcd'})
+
+
+def test_parse_source_files(output_path):
+    source_files_by_library_id = prefetch.prefetch_source_files({}, output_path, LIBRARY_IDS, {})
+    kraken_species_files = [source_files_by_library_id[library_id]['kraken2_species'] for library_id in LIBRARY_IDS]
+    os.remove(kraken_species_files[2]['path'])
+
+    kraken_species_reports = prefetch.parse_source_files({}, kraken_species_files, lambda path, content: parsers.parse_kraken_species(path, top_n=2, content=content))
+
+    assert [len(kraken_species) for kraken_species in kraken_species_reports[0:2]] == [2, 2]
+    assert kraken_species_reports[0][1]['taxon_name'] == 'Escherichia coli'
+    assert kraken_species_reports[2] is None
+    nanoq_reports = prefetch.parse_source_files({}, [source_files_by_library_id[library_id]['nanoq'] for library_id in LIBRARY_IDS], lambda path, content: parsers.parse_nanoq(path, content=content))
+    assert nanoq_reports[0] == nanoq_reports[1]
+    assert nanoq_reports[0][0]['bases'] == 5000000
+    assert nanoq_reports[2] is None
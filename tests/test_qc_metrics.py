@@ -0,0 +1,101 @@
+import routine_nanopore_qc_collector.core as core
+import routine_nanopore_qc_collector.qc_metrics as qc_metrics
+
+
+def make_species_abundance(library_id, abundances):
+    species_abundance = {'library_id': library_id}
+    for rank, (name, genus_name, fraction_total_reads) in enumerate(abundances, start=1):
+        key_prefix = 'abundance_' + str(rank) + '_'
+        species_abundance[key_prefix + 'name'] = name
+        species_abundance[key_prefix + 'genus_name'] = genus_name
+        species_abundance[key_prefix + 'fraction_total_reads'] = fraction_total_reads
+
+    return species_abundance
+
+
+SPECIES_ABUNDANCES = [
+    make_species_abundance('LIB001', [
+        ('Escherichia coli', 'Escherichia', 0.8),
+        ('Escherichia fergusonii', 'Escherichia', 0.1),
+        ('Salmonella enterica', 'Salmonella', 0.05),
+    ]),
+    # Ties go to the lower-ranked species. Klebsiella pneumoniae also occurs at a second rank.
+    make_species_abundance('LIB002', [
+        ('Klebsiella pneumoniae', 'Klebsiella', 0.3),
+        ('Klebsiella variicola', 'Klebsiella', 0.3),
+        ('Klebsiella pneumoniae', 'Klebsiella', 0.2),
+        ('Enterobacter cloacae', 'Enterobacter', 0.1),
+        ('Enterobacter hormaechei', 'Enterobacter', 0.1),
+    ]),
+    # Homo sapiens is never inferred, even when it's the most abundant.
+    make_species_abundance('LIB003', [
+        ('Homo sapiens', 'Homo', 0.9),
+        ('Staphylococcus aureus', 'Staphylococcus', 0.05),
+        ('Staphylococcus epidermidis', 'Staphylococcus', 0.05),
+    ]),
+    # Missing genus, from a taxid with no genus in its lineage or from a failed lookup.
+    make_species_abundance('LIB004', [
+        ('Enterobacteriaceae bacterium X', '', 0.6),
+        ('Unknown species', None, 0.2),
+        ('Escherichia coli', 'Escherichia', 0.1),
+    ]),
+    make_species_abundance('LIB005', [
+        ('Unknown species', None, 0.5),
+        ('Other unknown species', None, 0.5),
+    ]),
+    # Empty abundances: no kraken report, or only Homo sapiens and zero-fraction species.
+    {'library_id': 'LIB006'},
+    make_species_abundance('LIB007', [('Homo sapiens', 'Homo', 1.0)]),
+    make_species_abundance('LIB008', [('Escherichia coli', 'Escherichia', 0.0)]),
+]
+
+
+def test_column_loops_match_per_library_functions():
+    columns_by_rank = qc_metrics.load_abundance_columns(SPECIES_ABUNDANCES)
+
+    inferred_species = qc_metrics.infer_species(columns_by_rank, len(SPECIES_ABUNDANCES))
+    assert inferred_species == [core.infer_species({}, species_abundance) for species_abundance in SPECIES_ABUNDANCES]
+    assert inferred_species == [
+        'Escherichia coli', 'Klebsiella variicola', 'Staphylococcus epidermidis', 'Enterobacteriaceae bacterium X',
+        'Other unknown species', None, None, None,
+    ]
+
+    inferred_genus = qc_metrics.infer_genus(columns_by_rank, inferred_species)
+    assert inferred_genus == [
+        core.infer_genus({}, species_abundance, species_name)
+        for species_abundance, species_name in zip(SPECIES_ABUNDANCES, inferred_species)
+    ]
+
+    for species_names in [inferred_species, ['Escherichia coli'] * len(SPECIES_ABUNDANCES)]:
+        assert qc_metrics.get_percent_reads_by_species_name(columns_by_rank, species_names) == [
+            core.get_percent_reads_by_species_name(species_abundance, species_name)
+            for species_abundance, species_name in zip(SPECIES_ABUNDANCES, species_names)
+        ]
+
+    for genus_names in [inferred_genus, ['Escherichia'] * len(SPECIES_ABUNDANCES)]:
+        assert qc_metrics.get_percent_reads_by_genus_name(columns_by_rank, genus_names) == [
+            core.get_percent_reads_by_genus_name(species_abundance, genus_name)
+            for species_abundance, genus_name in zip(SPECIES_ABUNDANCES, genus_names)
+        ]
+
+
+def test_compute_inferred_metrics():
+    config = {'known_species': {'Escherichia coli': {'genome_size_mb': 5.0}}}
+    columns_by_rank = qc_metrics.load_abundance_columns(SPECIES_ABUNDANCES)
+    num_bases = [500000000, 1000] + [None] * (len(SPECIES_ABUNDANCES) - 2)
+
+    inferred_metrics = qc_metrics.compute_inferred_metrics(config, columns_by_rank, num_bases)
+
+    assert inferred_metrics[0] == {
+        'inferred_species_name': 'Escherichia coli',
+        'inferred_genus_name': 'Escherichia',
+        'inferred_species_percent': 80.0,
+        'inferred_genus_percent': 90.0,
+        'inferred_species_genome_size_mb': 5.0,
+        'inferred_species_estimated_depth': 80.0,
+        'inferred_genus_estimated_depth': 90.0,
+    }
+    assert inferred_metrics[1]['inferred_species_percent'] == 30.0
+    assert inferred_metrics[1]['inferred_genus_percent'] == 80.0
+    assert inferred_metrics[4]['inferred_genus_percent'] == 100.0
+    assert inferred_metrics[5:] == [{}, {}, {}]
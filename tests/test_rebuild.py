@@ -0,0 +1,92 @@
+import logging
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.rebuild as rebuild
+
+
+RUN_IDS = [
+    '20230101_1200_X1_FAV12345_abcd1234',
+    '20230115_1200_X1_FAV12346_bcde2345',
+    '20230201_1200_X1_FAV12347_cdef3456',
+]
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'output_dir': str(tmp_path)}
+
+
+@pytest.fixture
+def rebuilt_runs(monkeypatch):
+    """
+    Replace `core.collect_outputs`, recording the IDs of the runs rebuilt. Runs in 'failing_run_ids' raise instead.
+    """
+    rebuilt_runs = {'run_ids': [], 'failing_run_ids': set()}
+
+    def collect_outputs(config, analysis_dir, force=False):
+        run_id = os.path.basename(analysis_dir['path'])
+        if run_id in rebuilt_runs['failing_run_ids']:
+            raise RuntimeError('collection failed')
+        rebuilt_runs['run_ids'].append(run_id)
+        return {'num_libraries': 2}
+
+    monkeypatch.setattr(rebuild.core, 'collect_outputs', collect_outputs)
+
+    return rebuilt_runs
+
+
+@pytest.fixture
+def runs():
+    return [
+        {
+            'run_id': run_id,
+            'path': os.path.join('/sequencer', run_id),
+            'sequencer_type': 'promethion',
+            'routine_nanopore_qc_output_path': os.path.join('/analysis', run_id),
+            'excluded': False,
+            'analysis_complete': True,
+        }
+        for run_id in RUN_IDS
+    ]
+
+
+def test_interrupted_rebuild_resumes_from_checkpoint(config, runs, rebuilt_runs):
+    selection = {'run_ids': None, 'start_date': '2023-01-01', 'end_date': None}
+    rebuilt_runs['failing_run_ids'].add(RUN_IDS[1])
+    summary = rebuild.rebuild(config, runs, selection=selection)
+    assert summary['num_runs'] == 2
+    assert summary['num_failed'] == 1
+    assert os.path.exists(rebuild.get_checkpoint_path(config))
+
+    rebuilt_runs['failing_run_ids'].clear()
+    rebuilt_runs['run_ids'].clear()
+    summary = rebuild.rebuild(config, runs, selection=selection)
+
+    assert rebuilt_runs['run_ids'] == [RUN_IDS[1]]
+    assert summary['num_runs'] == 1
+    assert summary['num_libraries'] == 2
+    assert not os.path.exists(rebuild.get_checkpoint_path(config))
+
+
+def test_checkpoint_is_ignored_when_selection_changes(config, runs, rebuilt_runs, caplog):
+    rebuilt_runs['failing_run_ids'].add(RUN_IDS[1])
+    rebuild.rebuild(config, runs, selection={'run_ids': None, 'start_date': '2023-01-01', 'end_date': None})
+
+    rebuilt_runs['failing_run_ids'].clear()
+    rebuilt_runs['run_ids'].clear()
+    caplog.set_level(logging.INFO)
+    rebuild.rebuild(config, runs, selection={'run_ids': None, 'start_date': '2022-01-01', 'end_date': None})
+
+    assert sorted(rebuilt_runs['run_ids']) == RUN_IDS
+    assert 'rebuild_checkpoint_ignored' in caplog.text
+
+
+def test_select_runs(runs):
+    runs[0]['excluded'] = True
+    runs[1]['analysis_complete'] = False
+
+    assert rebuild.select_runs(runs) == runs[2:]
+    runs[0]['excluded'] = False
+    assert rebuild.select_runs(runs, run_ids={RUN_IDS[0], RUN_IDS[2]}, end_date='2023-01-31') == runs[0:1]
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.runs_index as runs_index
+
+
+RUNS = [
+    {'run_id': '20230101_1200_X1_FAV12345_abcd1234'},
+    {'run_id': '20230115_1200_X1_FAV12346_bcde2345'},
+    {'run_id': '20230201_1200_X1_FAV12347_cdef3456'},
+]
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'output_dir': str(tmp_path)}
+
+
+def get_mtimes_ns(config):
+    runs_index_dir = runs_index.get_runs_index_dir(config)
+    paths = [os.path.join(runs_index_dir, filename) for filename in os.listdir(runs_index_dir)] + [os.path.join(config['output_dir'], 'runs.json')]
+
+    return {path: os.stat(path).st_mtime_ns for path in paths}
+
+
+def backdate(config):
+    for path, mtime_ns in get_mtimes_ns(config).items():
+        os.utime(path, ns=(mtime_ns - 1000000000, mtime_ns - 1000000000))
+
+
+def test_unchanged_runs_leave_index_untouched(config):
+    first_index = runs_index.update_runs_index(config, RUNS)
+    assert sorted(first_index['shards'].keys()) == ['2023-01', '2023-02']
+    backdate(config)
+    mtimes_ns = get_mtimes_ns(config)
+
+    second_index = runs_index.update_runs_index(config, [dict(run) for run in RUNS])
+
+    assert second_index['sequence'] == first_index['sequence'] == 1
+    assert second_index['etag'] == first_index['etag']
+    assert second_index['shards'] == first_index['shards']
+    assert get_mtimes_ns(config) == mtimes_ns
+
+
+def test_only_changed_shard_is_rewritten(config):
+    runs_index.update_runs_index(config, RUNS)
+    backdate(config)
+    mtimes_ns = get_mtimes_ns(config)
+    runs_index_dir = runs_index.get_runs_index_dir(config)
+
+    runs = RUNS[0:2] + [dict(RUNS[2], run_dir='/sequencer/' + RUNS[2]['run_id'])]
+    updated_index = runs_index.update_runs_index(config, runs)
+
+    assert updated_index['sequence'] == 2
+    assert updated_index['shards']['2023-01']['sequence'] == 1
+    assert updated_index['shards']['2023-02']['sequence'] == 2
+    assert updated_index['changes'][-1] == {
+        'sequence': 2, 'month': '2023-02', 'added_run_ids': [], 'removed_run_ids': [], 'updated_run_ids': [RUNS[2]['run_id']],
+    }
+    shard_path = os.path.join(runs_index_dir, '2023-01.json')
+    assert os.stat(shard_path).st_mtime_ns == mtimes_ns[shard_path]
+    with open(os.path.join(runs_index_dir, 'index.json'), 'r') as f:
+        assert json.load(f) == updated_index
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+import routine_nanopore_qc_collector.samplesheet as samplesheet
+
+
+RUN_ID = '20230101_1200_X1_FAV12345_abcd1234'
+NEW_RUN_ID = '20230201_1200_X1_FAV12345_bcde2345'
+
+
+@pytest.fixture
+def config(tmp_path):
+    samplesheet._samplesheet_index = None
+    sequencer_output_dir = os.path.join(str(tmp_path), 'sequencer')
+    os.makedirs(os.path.join(sequencer_output_dir, RUN_ID))
+    write_samplesheet(os.path.join(sequencer_output_dir, RUN_ID, 'sample_sheet_a.csv'), [('LIB001', 'proj-a'), ('LIB002', '')])
+    output_dir = os.path.join(str(tmp_path), 'out')
+    os.makedirs(output_dir)
+    yield {
+        'output_dir': output_dir,
+        'sequencer_output_dirs': sequencer_output_dir,
+        'projects': {
+            'proj-a': {'samplesheet_project_id': 'proj-a', 'translated_project_id': 'project_a', 'project_species_name': 'Escherichia coli'},
+        },
+    }
+    samplesheet._samplesheet_index = None
+
+
+def write_samplesheet(samplesheet_path, libraries):
+    with open(samplesheet_path, 'w') as f:
+        f.write('flow_cell_id,Alias,barcode,Project_ID\n')
+        for library_id, project_id in libraries:
+            f.write('FAV12345,' + library_id + ',barcode01,' + project_id + '\n')
+
+
+def touch(path, offset_seconds):
+    timestamp = time.time() + offset_seconds
+    os.utime(path, (timestamp, timestamp))
+
+
+def test_parse_samplesheet(config):
+    samplesheet_path = os.path.join(config['sequencer_output_dirs'], RUN_ID, 'sample_sheet_a.csv')
+
+    assert samplesheet.parse_samplesheet(samplesheet_path) == [
+        {'library_id': 'LIB001', 'project_id': 'proj-a', 'barcode': 'barcode01'},
+        {'library_id': 'LIB002', 'project_id': None, 'barcode': 'barcode01'},
+    ]
+
+
+def test_get_library_projects(config):
+    assert samplesheet.get_library_projects(config, RUN_ID) == {
+        'LIB001': {'project_id': 'project_a', 'project_species_name': 'Escherichia coli'},
+    }
+    assert samplesheet.get_library_projects(config, NEW_RUN_ID) == {}
+
+
+def test_newest_samplesheet_is_used(config):
+    run_dir = os.path.join(config['sequencer_output_dirs'], RUN_ID)
+    write_samplesheet(os.path.join(run_dir, 'sample_sheet_b.csv'), [('LIB001', 'proj-b')])
+    touch(os.path.join(run_dir, 'sample_sheet_b.csv'), 10)
+
+    assert samplesheet.find_samplesheet_for_run(config, RUN_ID) == os.path.join(run_dir, 'sample_sheet_b.csv')
+
+
+def test_index_picks_up_new_runs_and_late_samplesheets(config):
+    samplesheet.update_samplesheet_index(config)
+    new_run_dir = os.path.join(config['sequencer_output_dirs'], NEW_RUN_ID)
+    os.makedirs(new_run_dir)
+    touch(config['sequencer_output_dirs'], 10)
+    samplesheet.update_samplesheet_index(config)
+    assert samplesheet.find_samplesheet_for_run(config, NEW_RUN_ID) is None
+
+    # A run dir without a samplesheet is re-checked once it changes, without re-listing the sequencer output dir.
+    write_samplesheet(os.path.join(new_run_dir, 'sample_sheet_a.csv'), [('LIB003', 'proj-a')])
+    touch(new_run_dir, 20)
+    samplesheet.update_samplesheet_index(config)
+    assert samplesheet.find_samplesheet_for_run(config, NEW_RUN_ID) == os.path.join(new_run_dir, 'sample_sheet_a.csv')
+
+
+def test_index_is_saved_and_reloaded(config):
+    samplesheet.update_samplesheet_index(config)
+    with open(samplesheet.get_samplesheet_index_path(config), 'r') as f:
+        saved_index = json.load(f)
+    samplesheet._samplesheet_index = None
+
+    assert samplesheet.load_samplesheet_index(config) == saved_index
+    assert saved_index['sequencer_output_dirs'][os.path.abspath(config['sequencer_output_dirs'])]['runs'][RUN_ID]['samplesheet_path'] is not None
+
+
+def test_nested_run_dir_is_not_found_and_logged(config, caplog):
+    nested_run_dir = os.path.join(config['sequencer_output_dirs'], 'experiment', 'sample', NEW_RUN_ID)
+    os.makedirs(nested_run_dir)
+    write_samplesheet(os.path.join(nested_run_dir, 'sample_sheet_a.csv'), [('LIB003', 'proj-a')])
+
+    assert samplesheet.get_library_projects(config, NEW_RUN_ID) == {}
+    assert 'samplesheet_not_found' in caplog.text
+    assert NEW_RUN_ID in caplog.text
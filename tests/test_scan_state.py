@@ -0,0 +1,54 @@
+import builtins
+import collections
+import os
+import sqlite3
+
+import pytest
+
+import routine_nanopore_qc_collector.core as core
+
+
+def scan_and_collect(config):
+    scan_state = core.load_scan_state(config)
+    discovered_runs = core.discover_runs(config, scan_state)
+    summaries = [core.collect_outputs(config, analysis_dir) for analysis_dir in core.find_analysis_dirs(config, scan_state=scan_state, discovered_runs=discovered_runs) if analysis_dir is not None]
+    core.save_scan_state(config, scan_state)
+    return summaries
+
+
+@pytest.fixture
+def filesystem_calls(monkeypatch):
+    """
+    Count calls to the functions that touch the filesystem, by the path they were called with.
+    """
+    calls = collections.Counter()
+
+    def counted(name, fn):
+        def counted_fn(path, *args, **kwargs):
+            calls[(name, str(path))] += 1
+            return fn(path, *args, **kwargs)
+        return counted_fn
+
+    for module, name in [(os, 'stat'), (os, 'lstat'), (os, 'scandir'), (os, 'listdir'), (builtins, 'open'), (sqlite3, 'connect')]:
+        monkeypatch.setattr(module, name, counted(name, getattr(module, name)))
+
+    return calls
+
+
+def test_unchanged_scan_only_stats_run_and_output_dirs(analysis_config, filesystem_calls):
+    scan_and_collect(analysis_config)
+    scan_state = core.load_scan_state(analysis_config)
+    filesystem_calls.clear()
+
+    summaries = scan_and_collect(analysis_config)
+
+    assert len(summaries) == 3
+    expected_calls = {('scandir', analysis_config['analysis_by_run_dir']): 1}
+    for run_id, run_status in scan_state['runs'].items():
+        expected_calls[('stat', run_status['run_dir_path'])] = 1
+        expected_calls[('stat', run_status['routine_nanopore_qc_output_path'])] = 1
+    # The scan state is read once, and not re-written.
+    scan_state_path = os.path.join(analysis_config['output_dir'], 'scan_state.json')
+    expected_calls[('stat', scan_state_path)] = 1
+    expected_calls[('open', scan_state_path)] = 1
+    assert dict(filesystem_calls) == expected_calls
@@ -0,0 +1,118 @@
+import time
+
+import routine_nanopore_qc_collector.scheduler as scheduler
+
+
+def make_analysis_dir(run_id, sequencer_type='gridion', output_path='output-v1'):
+    return {
+        'path': '/analysis_by_run/' + run_id,
+        'sequencer_type': sequencer_type,
+        'routine_nanopore_qc_output_path': '/analysis_by_run/' + run_id + '/' + output_path,
+    }
+
+
+def get_run_ids(analysis_dirs):
+    return [analysis_dir['path'].split('/')[-1] for analysis_dir in analysis_dirs]
+
+
+def test_get_run_start():
+    assert scheduler.get_run_start('20230131_1530_X1_FAV12345_a1b2c3d4') == 202301311530
+    assert scheduler.get_run_start('not_a_run') == 0
+
+
+def test_queue_order_newest_first_by_sequencer_priority():
+    config = {'sequencer_priority': {'promethion': 1}}
+    scheduler_state = scheduler.init_scheduler_state()
+    scheduler.enqueue(config, scheduler_state, [
+        make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa'),
+        make_analysis_dir('20230301_1200_X1_FAV00003_cccccccc'),
+        make_analysis_dir('20230201_1200_P2S_PAV00002_bbbbbbbb', 'promethion'),
+        None,
+    ])
+
+    assert get_run_ids(scheduler.iter_queue(scheduler_state)) == [
+        '20230201_1200_P2S_PAV00002_bbbbbbbb',
+        '20230301_1200_X1_FAV00003_cccccccc',
+        '20230101_1200_X1_FAV00001_aaaaaaaa',
+    ]
+
+
+def test_enqueue_skips_queued_runs():
+    scheduler_state = scheduler.init_scheduler_state()
+    analysis_dir = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa')
+
+    assert scheduler.enqueue({}, scheduler_state, [analysis_dir]) == 1
+    assert scheduler.enqueue({}, scheduler_state, [analysis_dir]) == 0
+
+
+def test_retry_backoff_doubles_up_to_max():
+    config = {'retry_initial_backoff_seconds': 10, 'retry_max_backoff_seconds': 50}
+
+    assert [scheduler.get_retry_backoff_seconds(config, num_attempts) for num_attempts in range(1, 5)] == [10, 20, 40, 50]
+
+
+def test_failed_run_is_deferred_until_retry_is_due():
+    config = {'retry_initial_backoff_seconds': 60}
+    scheduler_state = scheduler.init_scheduler_state()
+    analysis_dir = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa')
+    scheduler.record_result(config, scheduler_state, analysis_dir, error=RuntimeError())
+
+    assert scheduler.get_num_pending_retries(scheduler_state) == 1
+    assert scheduler.enqueue(config, scheduler_state, [analysis_dir]) == 0
+
+    scheduler_state['retries']['20230101_1200_X1_FAV00001_aaaaaaaa']['next_attempt_timestamp'] = time.time() - 1
+    assert scheduler.get_seconds_until_next_retry(scheduler_state) == 0.0
+    assert scheduler.enqueue(config, scheduler_state, [analysis_dir]) == 1
+
+
+def test_incomplete_libraries_are_retried_and_success_clears_retry():
+    scheduler_state = scheduler.init_scheduler_state()
+    analysis_dir = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa')
+    scheduler.record_result({}, scheduler_state, analysis_dir, {'incomplete_library_ids': ['LIB001']})
+    assert scheduler_state['retries']['20230101_1200_X1_FAV00001_aaaaaaaa']['reason'] == 'incomplete_libraries'
+
+    scheduler.record_result({}, scheduler_state, analysis_dir, {'incomplete_library_ids': []})
+    assert scheduler_state['retries'] == {}
+    assert scheduler.get_seconds_until_next_retry(scheduler_state) is None
+
+
+def test_exhausted_run_is_not_requeued_until_its_output_changes():
+    config = {'retry_max_attempts': 2, 'retry_initial_backoff_seconds': 0}
+    scheduler_state = scheduler.init_scheduler_state()
+    analysis_dir = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa')
+    for _ in range(3):
+        scheduler.record_result(config, scheduler_state, analysis_dir, error=RuntimeError())
+
+    assert scheduler.get_num_pending_retries(scheduler_state) == 0
+    assert scheduler.enqueue(config, scheduler_state, [analysis_dir]) == 0
+
+    rerun_analysis_dir = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa', output_path='output-v2')
+    assert scheduler.enqueue(config, scheduler_state, [rerun_analysis_dir]) == 1
+    list(scheduler.iter_queue(scheduler_state))
+    scheduler.record_result(config, scheduler_state, rerun_analysis_dir, error=RuntimeError())
+    assert scheduler_state['retries']['20230101_1200_X1_FAV00001_aaaaaaaa']['num_attempts'] == 1
+
+
+def test_iter_queue_refreshes_while_draining():
+    config = {'queue_refresh_interval_seconds': 0}
+    scheduler_state = scheduler.init_scheduler_state()
+    old_run = make_analysis_dir('20230101_1200_X1_FAV00001_aaaaaaaa')
+    older_run = make_analysis_dir('20221201_1200_X1_FAV00000_00000000')
+    new_run = make_analysis_dir('20230301_1200_X1_FAV00003_cccccccc')
+    scheduler.enqueue(config, scheduler_state, [old_run, older_run])
+
+    num_refreshes = [0]
+
+    def find_analysis_dirs():
+        # The new run completes after the first refresh.
+        num_refreshes[0] += 1
+        if num_refreshes[0] == 1:
+            return [old_run, older_run]
+        return [old_run, older_run, new_run]
+
+    # The new run is collected before the older run, and runs already collected are not added again.
+    assert get_run_ids(scheduler.iter_queue(scheduler_state, config, find_analysis_dirs)) == [
+        '20230101_1200_X1_FAV00001_aaaaaaaa',
+        '20230301_1200_X1_FAV00003_cccccccc',
+        '20221201_1200_X1_FAV00000_00000000',
+    ]
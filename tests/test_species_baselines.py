@@ -0,0 +1,161 @@
+import json
+import math
+import os
+import random
+import statistics
+
+import pytest
+
+import routine_nanopore_qc_collector.species_baselines as species_baselines
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        'output_dir': str(tmp_path),
+        'species_baselines_enabled': True,
+        'species_baseline_min_count': 3,
+    }
+
+
+def make_library_qc(library_id, read_n50, species_name='Escherichia coli'):
+    return {
+        'library_id': library_id,
+        'inferred_species_name': species_name,
+        'read_n50': read_n50,
+        'median_quality': 15.0,
+        'num_bases': read_n50 * 100,
+        'inferred_species_estimated_depth': None,
+    }
+
+
+def load_baseline(config, species_name):
+    with open(species_baselines.get_species_baseline_path(config, species_name), 'r') as f:
+        return json.load(f)['baselines']
+
+
+def test_welford_add_and_remove():
+    values = [random.Random(i).uniform(1, 1000) for i in range(50)] + [0.0]
+    baseline = species_baselines.init_baseline()
+    for value in values:
+        species_baselines.add_value(baseline, value)
+
+    assert baseline['count'] == len(values)
+    assert baseline['mean'] == pytest.approx(statistics.mean(values))
+    assert baseline['m2'] / (baseline['count'] - 1) == pytest.approx(statistics.variance(values))
+    assert baseline['zero_count'] == 1
+    assert sum(baseline['bins'].values()) == len(values) - 1
+
+    for value in values[:10]:
+        species_baselines.remove_value(baseline, value)
+    assert baseline['mean'] == pytest.approx(statistics.mean(values[10:]))
+    assert baseline['m2'] / (baseline['count'] - 1) == pytest.approx(statistics.variance(values[10:]))
+
+    for value in values[10:]:
+        species_baselines.remove_value(baseline, value)
+    assert baseline == species_baselines.init_baseline()
+
+
+def test_sketch_bin_relative_accuracy():
+    for value in [0.5, 1.0, 7.3, 1234.5, 1e9]:
+        bin_index = species_baselines.get_bin_index(value)
+        lower = species_baselines.SKETCH_GAMMA ** (bin_index - 1)
+        upper = species_baselines.SKETCH_GAMMA ** bin_index
+        assert lower < value <= upper * (1 + 1e-12)
+        # Any value in the bin is within the relative accuracy of the bin's midpoint.
+        midpoint = 2 * lower * upper / (lower + upper)
+        assert abs(value - midpoint) / value <= species_baselines.SKETCH_RELATIVE_ACCURACY + 1e-12
+
+
+def test_percentile_and_zscore():
+    baseline = species_baselines.init_baseline()
+    for value in range(1, 101):
+        species_baselines.add_value(baseline, value)
+
+    assert species_baselines.get_percentile(baseline, 50) == pytest.approx(49.5, abs=1.0)
+    assert species_baselines.get_percentile(baseline, 1000) == 100.0
+    assert species_baselines.get_zscore(baseline, 50.5) == pytest.approx(0.0)
+    assert species_baselines.get_zscore(baseline, 50.5 + statistics.stdev(range(1, 101))) == pytest.approx(1.0)
+
+
+def test_get_library_values_skips_non_numeric():
+    library_qc = {'read_n50': 1000, 'median_quality': True, 'num_bases': math.nan, 'inferred_species_estimated_depth': 'x'}
+
+    assert species_baselines.get_library_values(library_qc) == [1000, None, None, None]
+
+
+def test_update_annotates_once_species_has_min_count(config):
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB00' + str(i), 1000 + i) for i in range(3)], [])
+    library_qc = make_library_qc('LIB001', 5000)
+    species_baselines.update_run_library_qc(config, 'run-2', [library_qc], [])
+
+    assert library_qc['read_n50_species_percentile'] == 100.0
+    assert library_qc['read_n50_species_zscore'] > 3
+    assert library_qc['species_baseline_outliers'] == ['read_n50', 'num_bases']
+    assert 'inferred_species_estimated_depth_species_zscore' not in library_qc
+
+
+def test_recollected_library_replaces_its_contribution(config):
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1000), make_library_qc('LIB002', 2000)], [])
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 3000)], [])
+    baseline = load_baseline(config, 'Escherichia coli')['read_n50']
+    assert baseline['count'] == 2
+    assert baseline['mean'] == pytest.approx(2500)
+
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 3000, species_name='Salmonella enterica')], ['LIB002'])
+    assert load_baseline(config, 'Escherichia coli')['read_n50']['count'] == 0
+    assert load_baseline(config, 'Salmonella enterica')['read_n50']['count'] == 1
+
+
+def test_updates_from_several_collectors_are_kept(config):
+    other_config = dict(config, node_id='node-b')
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1000)], [])
+    species_baselines.update_run_library_qc(other_config, 'run-2', [make_library_qc('LIB001', 2000)], [])
+    species_baselines.update_run_library_qc(config, 'run-3', [make_library_qc('LIB001', 3000)], [])
+
+    assert load_baseline(config, 'Escherichia coli')['read_n50']['count'] == 3
+    # The species baselines file only records the format of the baselines.
+    with open(species_baselines.get_species_baselines_path(config), 'r') as f:
+        assert sorted(json.load(f).keys()) == ['metrics', 'sketch_relative_accuracy', 'species_baselines_version']
+
+
+def test_only_the_run_species_are_rewritten(config):
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1000), make_library_qc('LIB002', 2000, species_name='Salmonella enterica')], [])
+    salmonella_path = species_baselines.get_species_baseline_path(config, 'Salmonella enterica')
+    salmonella_mtime_ns = os.stat(salmonella_path).st_mtime_ns - 1000
+    os.utime(salmonella_path, ns=(salmonella_mtime_ns, salmonella_mtime_ns))
+
+    species_baselines.update_run_library_qc(config, 'run-2', [make_library_qc('LIB001', 3000)], [])
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1500)], [])
+
+    assert os.stat(salmonella_path).st_mtime_ns == salmonella_mtime_ns
+    assert load_baseline(config, 'Escherichia coli')['read_n50']['mean'] == pytest.approx(2250)
+
+
+def test_interrupted_update_is_completed(config, monkeypatch):
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1000)], [])
+
+    # As if the collector stopped after writing the update, but before applying it.
+    with monkeypatch.context() as m:
+        m.setattr(species_baselines, 'apply_pending_update', lambda config: False)
+        species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 2000), make_library_qc('LIB002', 4000)], [])
+    assert os.path.exists(species_baselines.get_pending_update_path(config))
+    assert load_baseline(config, 'Escherichia coli')['read_n50']['mean'] == pytest.approx(1000)
+
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 3000)], [])
+    baseline = load_baseline(config, 'Escherichia coli')['read_n50']
+    assert baseline['count'] == 2
+    assert baseline['mean'] == pytest.approx(3500)
+    assert not os.path.exists(species_baselines.get_pending_update_path(config))
+
+
+def test_unreadable_contribution_is_reseeded(config, monkeypatch):
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 1000)], [])
+    with open(species_baselines.get_run_contribution_path(config, 'run-1'), 'w') as f:
+        f.write('{')
+    monkeypatch.setattr(species_baselines.qc_index, 'get_run_records', lambda config, table: [dict(make_library_qc('LIB001', 1000), run_id='run-1')])
+
+    species_baselines.update_run_library_qc(config, 'run-1', [make_library_qc('LIB001', 2000)], [])
+    baseline = load_baseline(config, 'Escherichia coli')['read_n50']
+    assert baseline['count'] == 1
+    assert baseline['mean'] == pytest.approx(2000)
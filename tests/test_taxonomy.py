@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.taxonomy as taxonomy
+
+
+NODES = [
+    (1, 1, 'no rank', 'root'),
+    (2, 1, 'superkingdom', 'Bacteria'),
+    (543, 2, 'family', 'Enterobacteriaceae'),
+    (561, 543, 'genus', 'Escherichia'),
+    (562, 561, 'species', 'Escherichia coli'),
+    (83333, 562, 'strain', 'Escherichia coli K-12'),
+    (1000, 543, 'species', 'Enterobacteriaceae bacterium X'),
+    (1001, 1, 'no rank', 'unclassified entries'),
+]
+
+
+@pytest.fixture
+def taxdump_dir(tmp_path):
+    with open(os.path.join(str(tmp_path), 'nodes.dmp'), 'w') as f:
+        for taxid, parent, rank, _ in NODES:
+            f.write(str(taxid) + '\t|\t' + str(parent) + '\t|\t' + rank + '\t|\t\t|\n')
+    with open(os.path.join(str(tmp_path), 'names.dmp'), 'w') as f:
+        for taxid, _, _, name in NODES:
+            f.write(str(taxid) + '\t|\t' + name + '\t|\t\t|\tscientific name\t|\n')
+            f.write(str(taxid) + '\t|\t' + name + ' synonym\t|\t\t|\tsynonym\t|\n')
+    with open(os.path.join(str(tmp_path), 'merged.dmp'), 'w') as f:
+        f.write('999\t|\t562\t|\n')
+
+    return str(tmp_path)
+
+
+def check_genera(taxonomy_tables):
+    assert taxonomy.get_genus(taxonomy_tables, '562') == {'genus_taxon_name': 'Escherichia', 'genus_ncbi_taxonomy_id': '561'}
+    assert taxonomy.get_genus(taxonomy_tables, '561') == {'genus_taxon_name': 'Escherichia', 'genus_ncbi_taxonomy_id': '561'}
+    assert taxonomy.get_genus(taxonomy_tables, '83333') == {'genus_taxon_name': 'Escherichia', 'genus_ncbi_taxonomy_id': '561'}
+    # Merged taxids are followed.
+    assert taxonomy.get_genus(taxonomy_tables, '999') == {'genus_taxon_name': 'Escherichia', 'genus_ncbi_taxonomy_id': '561'}
+    # Without a genus in the lineage, the genus is named after the nearest higher rank, with no taxid.
+    assert taxonomy.get_genus(taxonomy_tables, '1000') == {'genus_taxon_name': 'unclassified Enterobacteriaceae genus', 'genus_ncbi_taxonomy_id': ''}
+    assert taxonomy.get_genus(taxonomy_tables, '1001') == {'genus_taxon_name': '', 'genus_ncbi_taxonomy_id': ''}
+    for taxid in ['0', '123456', 'unclassified', '']:
+        assert taxonomy.get_genus(taxonomy_tables, taxid) == {'genus_taxon_name': '', 'genus_ncbi_taxonomy_id': ''}
+
+
+def test_get_genus(taxdump_dir):
+    taxonomy_tables = taxonomy.build_taxonomy(taxdump_dir)
+
+    assert taxonomy.get_taxon_name(taxonomy_tables, 562) == 'Escherichia coli'
+    check_genera(taxonomy_tables)
+
+
+def test_get_genus_from_index(taxdump_dir, tmp_path):
+    index_path = os.path.join(str(tmp_path), 'taxonomy.idx')
+    taxonomy.load_taxonomy(taxdump_dir, index_path)
+    taxonomy_tables = taxonomy.load_taxonomy(taxdump_dir, index_path)
+
+    assert 'mmap' in taxonomy_tables
+    check_genera(taxonomy_tables)
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')] == []
+
+
+def test_stale_index_is_rebuilt(taxdump_dir, tmp_path):
+    index_path = os.path.join(str(tmp_path), 'taxonomy.idx')
+    taxonomy.load_taxonomy(taxdump_dir, index_path)
+    with open(os.path.join(taxdump_dir, 'merged.dmp'), 'a') as f:
+        f.write('998\t|\t1000\t|\n')
+    taxonomy_tables = taxonomy.load_taxonomy(taxdump_dir, index_path)
+
+    assert 'mmap' not in taxonomy_tables
+    assert taxonomy.get_genus(taxonomy_tables, '998')['genus_taxon_name'] == 'unclassified Enterobacteriaceae genus'
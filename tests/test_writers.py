@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import routine_nanopore_qc_collector.writers as writers
+
+
+RECORDS = [
+    {'library_id': 'LIB001', 'read_n50': 1234, 'species': {'name': 'Escherichia coli', 'percent': 98.5}},
+    {'library_id': 'LIB002', 'read_n50': None, 'species': {}},
+]
+
+
+@pytest.mark.parametrize('records', [RECORDS, []])
+def test_json_format_matches_json_dump(tmp_path, records):
+    dst_path = str(tmp_path / 'library_qc.json')
+    writers.write_records(dst_path, iter(records))
+
+    with open(dst_path, 'r') as f:
+        assert f.read() == json.dumps(records, indent=2)
+
+
+@pytest.mark.parametrize('output_format', sorted(writers.OUTPUT_FORMATS.keys()))
+@pytest.mark.parametrize('output_compression', sorted(writers.OUTPUT_COMPRESSIONS.keys()))
+@pytest.mark.parametrize('records', [RECORDS, []])
+def test_round_trip(tmp_path, output_format, output_compression, records):
+    config = {'output_format': output_format, 'output_compression': output_compression}
+    dst_path = writers.get_output_path(config, str(tmp_path), 'run_library_qc')
+
+    assert writers.write_output(config, dst_path, iter(records)) == len(records)
+    assert writers.read_records(dst_path) == records
+
+
+def test_output_path_extensions():
+    assert writers.get_output_path({}, '/out', 'run_library_qc') == os.path.join('/out', 'run_library_qc.json')
+    assert writers.get_output_path({'output_format': 'ndjson', 'output_compression': 'gzip'}, '/out', 'run_library_qc') == os.path.join('/out', 'run_library_qc.ndjson.gz')
+
+
+def test_invalid_output_format_falls_back_to_default():
+    assert writers.get_output_format({'output_format': 'xml', 'output_compression': 'zip'}) == ('json', 'none')
+
+
+def test_gzip_output_is_reproducible(tmp_path):
+    dst_paths = [str(tmp_path / ('library_qc_' + str(i) + '.json.gz')) for i in range(2)]
+    for dst_path in dst_paths:
+        writers.write_records(dst_path, RECORDS, compression='gzip')
+
+    with open(dst_paths[0], 'rb') as f0, open(dst_paths[1], 'rb') as f1:
+        assert f0.read() == f1.read()
+
+
+def test_failed_write_leaves_destination_untouched(tmp_path):
+    dst_path = str(tmp_path / 'library_qc.json')
+    writers.write_records(dst_path, RECORDS)
+
+    def generate_records():
+        yield RECORDS[0]
+        raise RuntimeError('source file unreadable')
+
+    with pytest.raises(RuntimeError):
+        writers.write_records(dst_path, generate_records())
+
+    assert writers.read_records(dst_path) == RECORDS
+    assert os.listdir(str(tmp_path)) == ['library_qc.json']
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_binary_atomic_writer(tmp_path, compression):
+    dst_path = str(tmp_path / 'index.bin')
+    with writers.atomic_writer(dst_path, compression, binary=True) as f:
+        f.write(b'\0\1\2')
+
+    with (gzip.open if compression == 'gzip' else open)(dst_path, 'rb') as f:
+        assert f.read() == b'\0\1\2'
+    assert os.listdir(str(tmp_path)) == ['index.bin']